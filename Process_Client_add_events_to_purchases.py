@@ -1,6 +1,77 @@
 import pandas as pd
 import datetime
 import random
+from multiprocessing import Pool
+
+import numpy as np
+
+from pipeline_instrumentation import RunReport, TaskMeasurement, timed_stage
+from process_client_tree import available_processes
+from sorted_window_index import count_in_windows, window_label
+from table_schema import apply_schema, read_dtypes
+
+PURCHASE_COLUMNS = ["USER_CLIENT_NUMBER", "DATE", "PROPOSITION", "AMOUNT"]
+# the DATE of the purchase export is the local time of the shop without a time zone, while TIMESTAMP_EVENT is UTC.
+# The shop is Dutch (the weather is the weather of Utrecht), pass timezone="UTC" to purchase_timestamps if an export
+# is in UTC
+PURCHASE_TIMEZONE = "Europe/Amsterdam"
+
+
+def purchase_timestamps(purchase_dates, timezone=PURCHASE_TIMEZONE):
+    """
+    :param purchase_dates: the DATE column of the purchase export, for example 2024-11-18 14:11:05
+    :param timezone: the time zone of the purchase times. The hour that is repeated when the clocks go back is taken
+    as winter time
+    :return: the purchase times in UTC, so the windows shorter than a day compare them with TIMESTAMP_EVENT on the
+    same clock
+    """
+    timestamps = pd.to_datetime(pd.Series(purchase_dates), format="ISO8601")
+    if timestamps.dt.tz is None:
+        timestamps = timestamps.dt.tz_localize(timezone, ambiguous=False, nonexistent="shift_forward")
+    return timestamps.dt.tz_convert("UTC")
+
+
+def exposure_column_name(date_range):
+    """
+    :param date_range: the number of days or the timedelta to look back from the purchase date
+    :return: the name of the column with the number of times the proposition was seen, for example
+    NUMBER_OF_TIMES_SEEN_30_days or NUMBER_OF_TIMES_SEEN_2_hours
+    """
+    return f"NUMBER_OF_TIMES_SEEN_{window_label(date_range)}s"
+
+
+def count_exposures(purchases_table, events_table, date_ranges=(30, 7, 1), event_timestamp_column=None,
+                    purchase_timestamp_column=None):
+    """
+    Counts for every purchase the events of the same client and proposition from the purchase date minus the date
+    range up to and including the purchase date. The events are indexed once and every window is answered with
+    np.searchsorted
+    :param purchases_table: table with USER_CLIENT_NUMBER, PROPOSITION and DATE
+    :param events_table: table with USER_CLIENT_NUMBER, PROPOSITION and DATE
+    :param date_ranges: the numbers of days or the timedeltas to look back, for example (30, 7, pd.Timedelta(hours=2))
+    :param event_timestamp_column: the timestamp column of the events, for example TIMESTAMP_EVENT. Needed for the
+    timedelta date ranges, which are counted to the second instead of by day
+    :param purchase_timestamp_column: the timestamp column of the purchases, needed for the timedelta date ranges
+    :return: dict with the date range as key and a numpy array with a count per purchase as value
+    """
+    return count_in_windows(events_table, purchases_table, date_ranges, direction="before",
+                            timestamp_column=event_timestamp_column, query_timestamp_column=purchase_timestamp_column)
+
+
+def process_clients_chunk_task(task):
+    """
+    Processes a chunk of clients in a worker process
+    :param task: tuple of (list of clients, date ranges, event timestamp column, purchase timestamp column)
+    :return: tuple of (list with the processed purchase events table per client, list with the metrics of the
+    TaskMeasurement per client)
+    """
+    clients, date_ranges, event_timestamp_column, purchase_timestamp_column = task
+    client_metrics = [client.process_clients_chunk_measured(date_ranges, event_timestamp_column,
+                                                            purchase_timestamp_column)
+                      for client in clients]
+    return [client.processed_purchase_events for client in clients], client_metrics
+
+
 class Client:
     def __init__(self, client_id, client_purchases_table, client_events_table):
         self.client_id = client_id
@@ -10,30 +81,35 @@ class Client:
             columns=["USER_CLIENT_NUMBER", "DATE", "PROPOSITION", "AMOUNT", "NUMBER_OF_TIMES_SEEN_30_days",
                      "NUMBER_OF_TIMES_SEEN_7_days", "NUMBER_OF_TIMES_SEEN_1_days"])
 
-    def process_clients_chunk(self):
-
-        for index, row in self.client_purchases_table.iterrows():
-            user_id = row["USER_CLIENT_NUMBER"]
-            date = row["DATE"]
-            proposition_id = row["PROPOSITION"]
-            amount = row["AMOUNT"]
-            # Replace these with your actual function to calculate events prior to purchase date
-            events_30_day_prior = self.get_events_previous_on_purchase_date(self.client_events_table, user_id, date,
-                                                                       proposition_id, date_range=-30)
-            events_7_day_prior = self.get_events_previous_on_purchase_date(self.client_events_table, user_id, date,
-                                                                      proposition_id, date_range=-7)
-            events_1_day_prior = self.get_events_previous_on_purchase_date(self.client_events_table, user_id, date,
-                                                                      proposition_id, date_range=-1)
-
-            self.processed_purchase_events.loc[len(self.processed_purchase_events.index)] = [
-                user_id,
-                date,
-                proposition_id,
-                amount,
-                len(events_30_day_prior),
-                len(events_7_day_prior),
-                len(events_1_day_prior)
-            ]
+    def process_clients_chunk(self, date_ranges=(30, 7, 1), event_timestamp_column=None,
+                              purchase_timestamp_column=None):
+        """
+        Adds to every purchase of the client the number of times the proposition was seen in the date ranges before
+        the purchase. The counts of all purchases are computed at once, so the table is built in one go
+        :param date_ranges: the numbers of days or the timedeltas to look back
+        :param event_timestamp_column: the timestamp column of the events for the timedelta date ranges, see
+        count_exposures
+        :param purchase_timestamp_column: the timestamp column of the purchases for the timedelta date ranges
+        :return:
+        """
+        with timed_stage("exposure_counts", rows=len(self.client_purchases_table)):
+            exposure_counts = count_exposures(self.client_purchases_table, self.client_events_table, date_ranges,
+                                              event_timestamp_column, purchase_timestamp_column)
+        with timed_stage("build_table", rows=len(self.client_purchases_table)):
+            processed_purchase_events = self.client_purchases_table[PURCHASE_COLUMNS].reset_index(drop=True)
+            for date_range in date_ranges:
+                processed_purchase_events[exposure_column_name(date_range)] = exposure_counts[date_range]
+        self.processed_purchase_events = processed_purchase_events
+
+    def process_clients_chunk_measured(self, date_ranges=(30, 7, 1), event_timestamp_column=None,
+                                       purchase_timestamp_column=None):
+        """
+        process_clients_chunk in a TaskMeasurement, see pipeline_instrumentation.py
+        :return: the metrics of the client, with the purchases as rows
+        """
+        with TaskMeasurement(self.client_id, rows=len(self.client_purchases_table)) as measurement:
+            self.process_clients_chunk(date_ranges, event_timestamp_column, purchase_timestamp_column)
+        return measurement.metrics
 
     @staticmethod
     def get_events_previous_on_purchase_date(data_events, user_id, purchase_date, proposition_id, date_range=-30,
@@ -67,24 +143,42 @@ class Client:
 
 
 class Process_clients:
-    def __init__(self, purchase_data, events_data):
+    def __init__(self, purchase_data, events_data, date_ranges=(30, 7, 1), event_timestamp_column=None,
+                 purchase_timestamp_column=None):
+        """
+        :param purchase_data: the purchases table
+        :param events_data: the events table
+        :param date_ranges: the numbers of days or the timedeltas to look back from every purchase
+        :param event_timestamp_column: the timestamp column of the events for the timedelta date ranges, for example
+        TIMESTAMP_EVENT
+        :param purchase_timestamp_column: the timestamp column of the purchases for the timedelta date ranges
+        """
         self.purchase_events_table = purchase_data
         self.events_table = events_data
+        self.date_ranges = date_ranges
+        self.event_timestamp_column = event_timestamp_column
+        self.purchase_timestamp_column = purchase_timestamp_column
         self.unique_clients = self.purchase_events_table["USER_CLIENT_NUMBER"].unique()
         self.clients = []
         self.process_clients_setup()
         self.chunks = self.setup_chunks()
 
     def process_clients_setup(self):
+        """
+        Splits the tables in a table per client. Both tables are grouped once, instead of being filtered once per
+        client
+        :return:
+        """
+        purchase_rows_per_client = self.purchase_events_table.groupby("USER_CLIENT_NUMBER", sort=False).indices
+        event_rows_per_client = self.events_table.groupby("USER_CLIENT_NUMBER", sort=False).indices
+        no_rows = np.array([], dtype=np.int64)
+
         for index, client_id in enumerate(self.unique_clients):
-            if index % 10 == 0:
+            if index % 1000 == 0:
                 print("Setting up client number: ", index)
-            data_events_related_to_client = self.events_table[
-                self.events_table["USER_CLIENT_NUMBER"] == client_id]
-
-            purchase_events_related_to_client = self.purchase_events_table[
-                self.purchase_events_table["USER_CLIENT_NUMBER"] == client_id]
-
+            purchase_events_related_to_client = self.purchase_events_table.take(
+                purchase_rows_per_client.get(client_id, no_rows))
+            data_events_related_to_client = self.events_table.take(event_rows_per_client.get(client_id, no_rows))
 
             client = Client(client_id=client_id,
                             client_purchases_table=purchase_events_related_to_client,
@@ -100,38 +194,51 @@ class Process_clients:
         """
         This function will process the clients in the chunk
         :param chunk:
-        :return:
+        :return: list with the metrics per client
         """
-        for index, client in enumerate(chunk):
-            if index % 2 == 0:
-                print("Processing client number: ", index)
-            client.process_clients_chunk()
+        return [client.process_clients_chunk_measured(self.date_ranges, self.event_timestamp_column,
+                                                      self.purchase_timestamp_column)
+                for client in chunk]
 
-    def process_client_chunks(self):
+    def process_client_chunks(self, processes=None, report_path=None):
         """
-        This function will process the clients in the chunk using threading
-        :param chunk:
-        :return:
+        This function will process the chunks of clients in parallel with multiprocessing
+        :param processes: number of processes, by default the available cores. 1 processes the chunks in this process
+        :param report_path: optional json file to write the RunReport of the run to, with the timings per stage, the
+        rates and the peak memory per worker, and a csv with a row per client next to it
+        :return: the RunReport of the run
         """
-        for chunk in self.chunks:
-            self.process_clients_in_chunk(chunk)
+        processes = processes or available_processes()
+        run_report = RunReport("process_client_chunks")
+        if processes == 1:
+            for index, chunk in enumerate(self.chunks):
+                print("Processing chunk number: ", index, run_report.progress())
+                for metrics in self.process_clients_in_chunk(chunk):
+                    run_report.add(metrics)
+        else:
+            tasks = [(chunk, self.date_ranges, self.event_timestamp_column, self.purchase_timestamp_column)
+                     for chunk in self.chunks]
+            with Pool(processes=processes) as pool:
+                for index, (chunk, (processed_tables, client_metrics)) in enumerate(
+                        zip(self.chunks, pool.imap(process_clients_chunk_task, tasks))):
+                    print("Processed chunk number: ", index, run_report.progress())
+                    for client, processed_purchase_events in zip(chunk, processed_tables):
+                        client.processed_purchase_events = processed_purchase_events
+                    for metrics in client_metrics:
+                        run_report.add(metrics)
+
+        run_report.print_summary()
+        if report_path is not None:
+            run_report.write(report_path)
+        return run_report
 
     def aggregate_client_tables(self, file_name="processed_purchase_events.csv"):
         """
         This function will aggregate all the processed purchase events from all the clients
         :return:
         """
-        processed_payment_table_combined = pd.DataFrame(columns=["USER_CLIENT_NUMBER", "DATE", "PROPOSITION",
-                                                                 "AMOUNT",
-                                                        "NUMBER_OF_TIMES_SEEN_30_days",
-                                                        "NUMBER_OF_TIMES_SEEN_7_days", "NUMBER_OF_TIMES_SEEN_1_days"])
-        for index, chunk in enumerate(self.chunks):
-            print("Aggregating chunk number: ", index)
-            for client in chunk:
-                processed_payment_table_combined = pd.concat([
-                    processed_payment_table_combined,
-                    client.processed_purchase_events
-                ])
+        processed_payment_table_combined = pd.concat(
+            [client.processed_purchase_events for client in self.clients], ignore_index=True)
 
         processed_payment_table_combined.to_csv(file_name, index=False, sep="|")
 
@@ -141,16 +248,23 @@ class Process_clients:
 
 
 if __name__ == "__main__":
-    data_events = pd.read_csv("data/Data_eventsID.csv", delimiter="|")
-    purchase_events = pd.read_csv("data/Purchase_events_ID.csv", delimiter="|")
+    data_events = pd.read_csv("data/Data_eventsID.csv", delimiter="|", dtype=read_dtypes())
+    purchase_events = pd.read_csv("data/Purchase_events_ID.csv", delimiter="|", dtype=read_dtypes())
 
     # I am going to transform the data_event and the purchase_event to separate the date and time
-    data_events["DATE"] = data_events["TIMESTAMP_EVENT"].apply(lambda x: x.split("T")[0])
-    data_events["TIME"] = data_events["TIMESTAMP_EVENT"].apply(lambda x: x.split("T")[1][:-1])
+    # the timestamps are kept, so the exposures can also be counted in windows shorter than a day
+    data_events["DATE"] = data_events["TIMESTAMP_EVENT"].str.split("T").str[0]
+    data_events["TIME"] = data_events["TIMESTAMP_EVENT"].str.split("T").str[1].str[:-1]
 
-    purchase_events["DATE"] = purchase_events["DATE"].apply(lambda x: x.split(" ")[0])
+    purchase_events["TIMESTAMP_PURCHASE"] = purchase_timestamps(purchase_events["DATE"], timezone=PURCHASE_TIMEZONE)
+    purchase_events["DATE"] = purchase_events["DATE"].str.split(" ").str[0]
+    data_events = apply_schema(data_events, report=True, name="events")
+    purchase_events = apply_schema(purchase_events, report=True, name="purchases")
 
-    processor = Process_clients(purchase_events, data_events)
+    processor = Process_clients(purchase_events, data_events,
+                                date_ranges=(30, 7, 1, pd.Timedelta(hours=2)),
+                                event_timestamp_column="TIMESTAMP_EVENT",
+                                purchase_timestamp_column="TIMESTAMP_PURCHASE")
     processor.process_client_chunks()
     processed_payment_table = processor.aggregate_client_tables()
     print(processed_payment_table.head())
@@ -0,0 +1,464 @@
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+from benchmark_evaluator import list_benchmark_files, segment_of_benchmark_file
+from process_client_tree import available_processes
+from table_storage import get_table_storage_for_file
+
+# the columns of the RFM features and the quantiles that split them into the scores 1 to 4
+RFM_COLUMNS = {"Recency": "R_Score", "Total_Purchases": "F_Score", "Total_Spent": "M_Score"}
+RFM_QUANTILES = [0.25, 0.5, 0.75]
+RFM_SCORE_LEVELS = len(RFM_QUANTILES) + 1
+
+# the recommendations of segmentation.ipynb, in the order of the LabelEncoder of the notebook, and the benchmark
+# segment of every recommendation
+RECOMMENDATIONS = ["Premium Product Line", "Re-engagement Campaign", "Regular Promotions"]
+SEGMENT_OF_RECOMMENDATION = {
+    "Premium Product Line": "premium",
+    "Re-engagement Campaign": "re-engagement",
+    "Regular Promotions": "regular",
+}
+
+
+def user_rfm_features(purchases_table, reference_date=None):
+    """
+    the recency, frequency and monetary features of every client, like the groupby of segmentation.ipynb
+    :param purchases_table: purchases with the USER_CLIENT_NUMBER, DATE, PROPOSITION and AMOUNT columns
+    :param reference_date: the date the recency is counted from, by default the last date of the purchases
+    :return: table per USER_CLIENT_NUMBER with the Recent_Purchase_Date, Total_Purchases, Total_Spent and Recency
+    """
+    purchases_table = purchases_table.assign(DATE=pd.to_datetime(purchases_table["DATE"]))
+    user_data = purchases_table.groupby("USER_CLIENT_NUMBER").agg(
+        Recent_Purchase_Date=("DATE", "max"), Total_Purchases=("PROPOSITION", "count"), Total_Spent=("AMOUNT", "sum"))
+    reference_date = purchases_table["DATE"].max() if reference_date is None else pd.Timestamp(reference_date)
+    user_data["Recency"] = (reference_date - user_data["Recent_Purchase_Date"]).dt.days
+    return user_data
+
+
+def rfm_quantiles(user_data):
+    """
+    :param user_data: table with the RFM feature columns
+    :return: table with the 0.25, 0.5 and 0.75 quantile of every RFM feature
+    """
+    return user_data[list(RFM_COLUMNS)].quantile(q=RFM_QUANTILES)
+
+
+def rfm_scores(values, quantile_values):
+    """
+    Vectorized rfm_segment of segmentation.ipynb: a value gets score 1 up to and including the first quantile, 2 up
+    to the second, 3 up to the third and 4 above it. Missing values get 4, like in the notebook
+    :param values: the values of one RFM feature
+    :param quantile_values: the sorted quantiles of the feature
+    :return: int8 array with the score of every value
+    """
+    return (np.digitize(np.asarray(values, dtype=np.float64), np.asarray(quantile_values, dtype=np.float64),
+                        right=True) + 1).astype(np.int8)
+
+
+def score_rfm(user_data, quantiles=None):
+    """
+    adds the R_Score, F_Score and M_Score columns
+    :param user_data: table with the RFM feature columns
+    :param quantiles: the quantiles of the features, by default the quantiles of user_data itself
+    :return: the table with the scores
+    """
+    quantiles = rfm_quantiles(user_data) if quantiles is None else quantiles
+    return user_data.assign(**{score_column: rfm_scores(user_data[feature_column], quantiles[feature_column])
+                               for feature_column, score_column in RFM_COLUMNS.items()})
+
+
+def recommendation_codes(r_scores, f_scores, m_scores):
+    """
+    Vectorized assign_recommendations of segmentation.ipynb
+    :return: int array with the position in RECOMMENDATIONS of the recommendation of every client
+    """
+    r_scores, f_scores, m_scores = np.asarray(r_scores), np.asarray(f_scores), np.asarray(m_scores)
+    top = RFM_SCORE_LEVELS
+    return np.select([(r_scores == top) & (f_scores == top) & (m_scores == top), (r_scores == 1) & (f_scores >= 3)],
+                     [RECOMMENDATIONS.index("Premium Product Line"), RECOMMENDATIONS.index("Re-engagement Campaign")],
+                     default=RECOMMENDATIONS.index("Regular Promotions"))
+
+
+def assign_recommendations(user_data):
+    """
+    :param user_data: table with the R_Score, F_Score and M_Score columns
+    :return: the table with the Recommendations column
+    """
+    codes = recommendation_codes(user_data["R_Score"], user_data["F_Score"], user_data["M_Score"])
+    return user_data.assign(Recommendations=np.asarray(RECOMMENDATIONS, dtype=object).take(codes))
+
+
+def rfm_context_ids(r_scores, f_scores, m_scores):
+    """
+    :return: the context of every client, one number for every combination of the three scores
+    """
+    return ((np.asarray(r_scores, dtype=np.int64) - 1) * RFM_SCORE_LEVELS ** 2
+            + (np.asarray(f_scores, dtype=np.int64) - 1) * RFM_SCORE_LEVELS
+            + np.asarray(m_scores, dtype=np.int64) - 1)
+
+
+def rfm_context_scores(context_ids):
+    """
+    :param context_ids: contexts of rfm_context_ids
+    :return: tuple of the R, F and M scores of the contexts
+    """
+    context_ids = np.asarray(context_ids, dtype=np.int64)
+    return (context_ids // RFM_SCORE_LEVELS ** 2 + 1, context_ids // RFM_SCORE_LEVELS % RFM_SCORE_LEVELS + 1,
+            context_ids % RFM_SCORE_LEVELS + 1)
+
+
+class ArrayBanditPolicy:
+    """
+    Contextual bandit policy of which the state of all simulation replicas is kept in arrays with one row per
+    replica, one row per context and one column per action, instead of the per context dicts of the bandits in
+    segmentation.ipynb. A batch of rounds of every replica is selected and updated at once.
+    """
+
+    def __init__(self, n_replicas, n_contexts, n_actions, random_generator):
+        """
+        :param n_replicas: the number of independent simulation replicas
+        :param n_contexts: the number of contexts
+        :param n_actions: the number of actions
+        :param random_generator: numpy Generator of the replicas
+        """
+        self.n_replicas = n_replicas
+        self.n_contexts = n_contexts
+        self.n_actions = n_actions
+        self.random_generator = random_generator
+        self.counts = np.zeros((n_replicas, n_contexts, n_actions))
+        self.reward_sums = np.zeros((n_replicas, n_contexts, n_actions))
+
+    def context_state(self, state, contexts):
+        """
+        :param state: the counts or reward sums
+        :param contexts: array of (replicas, rounds) with the context of every round
+        :return: array of (replicas, rounds, actions) with the state of the context of every round
+        """
+        return state[np.arange(self.n_replicas)[:, None], contexts]
+
+    def select_actions(self, contexts):
+        """
+        :param contexts: array of (replicas, rounds) with the context of every round
+        :return: array of (replicas, rounds) with the chosen action of every round
+        """
+        raise NotImplementedError
+
+    def update(self, contexts, actions, rewards):
+        """
+        adds the rewards of a batch of rounds to the counts and reward sums. With one round per batch this is the
+        online update of the notebook bandits, larger batches update once after all of their rounds
+        :param contexts: array of (replicas, rounds) with the context of every round
+        :param actions: array of (replicas, rounds) with the chosen action of every round
+        :param rewards: array of (replicas, rounds) with the reward of every round
+        """
+        flat_positions = ((np.arange(self.n_replicas)[:, None] * self.n_contexts + contexts) * self.n_actions
+                          + actions).ravel()
+        size = self.counts.size
+        self.counts += np.bincount(flat_positions, minlength=size).reshape(self.counts.shape)
+        self.reward_sums += np.bincount(flat_positions, weights=rewards.ravel(), minlength=size).reshape(
+            self.reward_sums.shape)
+
+    def random_actions(self, shape):
+        return self.random_generator.integers(self.n_actions, size=shape)
+
+
+class EpsilonGreedyPolicy(ArrayBanditPolicy):
+    """
+    ContextualEpsilonGreedyBandit of segmentation.ipynb: the action with the highest mean reward in the context, a
+    random action with probability epsilon and in contexts that were not seen yet
+    """
+
+    def __init__(self, n_replicas, n_contexts, n_actions, random_generator, epsilon=0.1):
+        super().__init__(n_replicas, n_contexts, n_actions, random_generator)
+        self.epsilon = epsilon
+
+    def select_actions(self, contexts):
+        counts = self.context_state(self.counts, contexts)
+        mean_rewards = self.context_state(self.reward_sums, contexts) / np.maximum(counts, 1)
+        explore = ((self.random_generator.random(contexts.shape) < self.epsilon)
+                   | (counts.sum(axis=2) == 0))
+        return np.where(explore, self.random_actions(contexts.shape), mean_rewards.argmax(axis=2))
+
+
+class UCBPolicy(ArrayBanditPolicy):
+    """
+    UCB1 per context: the mean reward plus exploration * sqrt(2 ln(rounds of the context) / rounds of the action).
+    Actions that were not tried in the context yet are chosen first
+    """
+
+    def __init__(self, n_replicas, n_contexts, n_actions, random_generator, exploration=1.0):
+        super().__init__(n_replicas, n_contexts, n_actions, random_generator)
+        self.exploration = exploration
+
+    def select_actions(self, contexts):
+        counts = self.context_state(self.counts, contexts)
+        context_rounds = np.maximum(counts.sum(axis=2, keepdims=True), 1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            upper_bounds = (self.context_state(self.reward_sums, contexts) / counts
+                            + self.exploration * np.sqrt(2 * np.log(context_rounds) / counts))
+        return np.where(counts == 0, np.inf, upper_bounds).argmax(axis=2)
+
+
+class ThompsonSamplingPolicy(ArrayBanditPolicy):
+    """
+    ContextualThompsonSamplingBandit of segmentation.ipynb: a Beta(1 + rewards, 1 + rounds - rewards) sample per
+    action in the context and the action with the highest sample. The rewards must be between 0 and 1
+    """
+
+    def select_actions(self, contexts):
+        counts = self.context_state(self.counts, contexts)
+        reward_sums = self.context_state(self.reward_sums, contexts)
+        return self.random_generator.beta(1 + reward_sums, 1 + counts - reward_sums).argmax(axis=2)
+
+
+class RfmRulePolicy(ArrayBanditPolicy):
+    """
+    The fixed recommendation of assign_recommendations for the RFM scores of the context, the baseline the bandits
+    are compared with. It does not learn
+    """
+
+    def __init__(self, n_replicas, n_contexts, n_actions, random_generator):
+        super().__init__(n_replicas, n_contexts, n_actions, random_generator)
+        self.context_actions = recommendation_codes(*rfm_context_scores(np.arange(n_contexts)))
+
+    def select_actions(self, contexts):
+        return self.context_actions[contexts]
+
+    def update(self, contexts, actions, rewards):
+        pass
+
+
+POLICIES = {
+    "epsilon_greedy": EpsilonGreedyPolicy,
+    "ucb": UCBPolicy,
+    "thompson_sampling": ThompsonSamplingPolicy,
+    "rfm_rule": RfmRulePolicy,
+}
+
+
+def policy_label(policy_name, parameters):
+    """
+    :return: the name of a policy with its parameters, for example epsilon_greedy(epsilon=0.1)
+    """
+    if not parameters:
+        return policy_name
+    return policy_name + "(" + ", ".join(f"{key}={value}" for key, value in sorted(parameters.items())) + ")"
+
+
+def simulate_replicas_task(task):
+    """
+    Simulates a group of replicas of every policy. All policies get the same clients and reward draws, so their
+    differences are not hidden by the noise of the simulation
+    :param task: tuple of (list of (policy name, parameters), expected rewards per client and action, context of
+    every client, number of contexts, number of rounds, number of replicas, rounds per batch, binary rewards, seed)
+    :return: tuple of (number of replicas, dict per policy label with the reward and regret sums per round over the
+    replicas and the number of times every action was chosen)
+    """
+    (policy_specs, expected_rewards, client_contexts, n_contexts, n_rounds, n_replicas, batch_size, binary_rewards,
+     seed) = task
+    random_generator = np.random.default_rng(seed)
+    n_actions = expected_rewards.shape[1]
+    best_rewards = expected_rewards.max(axis=1)
+    policies = {}
+    totals = {}
+    for policy_name, parameters in policy_specs:
+        label = policy_label(policy_name, parameters)
+        policies[label] = POLICIES[policy_name](n_replicas, n_contexts, n_actions,
+                                                np.random.default_rng(random_generator.integers(2 ** 63)),
+                                                **parameters)
+        totals[label] = {"reward_sums": np.zeros(n_rounds), "regret_sums": np.zeros(n_rounds),
+                         "action_counts": np.zeros(n_actions, dtype=np.int64)}
+
+    for batch_start in range(0, n_rounds, batch_size):
+        batch_end = min(batch_start + batch_size, n_rounds)
+        clients = random_generator.integers(len(client_contexts), size=(n_replicas, batch_end - batch_start))
+        contexts = client_contexts[clients]
+        # one uniform number per round and action, a binary reward is 1 when it is below the expected reward
+        reward_draws = random_generator.random(clients.shape + (n_actions,)) if binary_rewards else None
+        for label, policy in policies.items():
+            actions = policy.select_actions(contexts)
+            chosen_rewards = expected_rewards[clients, actions]
+            if binary_rewards:
+                rewards = (np.take_along_axis(reward_draws, actions[..., None], axis=2)[..., 0]
+                           < chosen_rewards).astype(np.float64)
+            else:
+                rewards = chosen_rewards
+            policy.update(contexts, actions, rewards)
+            totals[label]["reward_sums"][batch_start:batch_end] += rewards.sum(axis=0)
+            totals[label]["regret_sums"][batch_start:batch_end] += (best_rewards[clients] - chosen_rewards).sum(axis=0)
+            totals[label]["action_counts"] += np.bincount(actions.ravel(), minlength=n_actions)
+    return n_replicas, totals
+
+
+def segment_reward_matrix(reward_predictor, benchmark_folder="benchmark_data", ranking_system=None,
+                          chunk_size=100_000):
+    """
+    The expected reward of every action for every client, from the benchmark file of the segment of the action:
+    the mean reward that the reward predictor gives the rows of the client in the file. The files are scored in
+    chunks with one predict call per chunk
+    :param reward_predictor: the RewardPredictor
+    :param benchmark_folder: the folder with a folder of benchmark files per ranking system
+    :param ranking_system: the folder of the ranking system to take the files from, by default the first
+    :param chunk_size: the number of rows that are scored at once
+    :return: table with a row per USER_CLIENT_NUMBER and a column per recommendation. Clients that are not in the
+    file of an action get the mean reward of that action
+    """
+    benchmark_files = list_benchmark_files(benchmark_folder)
+    ranking_system = ranking_system or benchmark_files[0][0]
+    file_of_segment = {segment_of_benchmark_file(file_name): path
+                       for folder, file_name, path in benchmark_files if folder == ranking_system}
+    action_rewards = {}
+    for recommendation in RECOMMENDATIONS:
+        path = file_of_segment[SEGMENT_OF_RECOMMENDATION[recommendation]]
+        reward_sums = []
+        for chunk in get_table_storage_for_file(path).read_chunks(path, chunk_size=chunk_size):
+            rewards = reward_predictor.predict_reward(reward_predictor.preprocessing_data(chunk))
+            reward_sums.append(pd.DataFrame({"USER_CLIENT_NUMBER": chunk["USER_CLIENT_NUMBER"].to_numpy(),
+                                             "reward": rewards, "rows": 1}).groupby("USER_CLIENT_NUMBER").sum())
+        reward_sums = pd.concat(reward_sums).groupby(level=0).sum()
+        action_rewards[recommendation] = reward_sums["reward"] / reward_sums["rows"]
+    reward_matrix = pd.DataFrame(action_rewards)
+    return reward_matrix.fillna(reward_matrix.mean())
+
+
+class BanditSimulator:
+    """
+    Compares contextual bandit policies for the RFM recommendations of segmentation.ipynb over many simulated
+    rounds. Every round a client is drawn, the context is the combination of its R, F and M scores and the policy
+    chooses one of the recommendations. The reward is the expected reward of the recommendation for the client,
+    which comes from the reward predictor, or a 0/1 draw with that probability.
+
+    Many independent replicas of every policy are simulated at once with array operations, and groups of replicas
+    are simulated in parallel worker processes. The results are the reward and regret per round averaged over the
+    replicas.
+    """
+
+    def __init__(self, expected_rewards, client_contexts, n_contexts=RFM_SCORE_LEVELS ** 3, binary_rewards=True,
+                 batch_size=100, seed=0):
+        """
+        :param expected_rewards: array or table of (clients, actions) with the expected reward of every action
+        :param client_contexts: the context of every client, in the order of the rows of expected_rewards
+        :param n_contexts: the number of contexts
+        :param binary_rewards: if True the rewards are 0/1 draws with the expected reward as probability, which
+        requires expected rewards between 0 and 1
+        :param batch_size: the number of rounds a policy chooses before it is updated, 1 updates after every round
+        :param seed: seed of the simulation, every group of replicas gets its own stream
+        """
+        self.expected_rewards = np.asarray(expected_rewards, dtype=np.float64)
+        self.client_contexts = np.asarray(client_contexts, dtype=np.int64)
+        self.n_contexts = n_contexts
+        self.binary_rewards = binary_rewards
+        self.batch_size = batch_size
+        self.seed = seed
+        if binary_rewards:
+            self.expected_rewards = np.clip(self.expected_rewards, 0, 1)
+
+    @classmethod
+    def from_rfm(cls, user_data, reward_matrix, **kwargs):
+        """
+        :param user_data: the RFM features per USER_CLIENT_NUMBER, see user_rfm_features
+        :param reward_matrix: the expected rewards per USER_CLIENT_NUMBER, see segment_reward_matrix
+        :return: BanditSimulator of the clients of the reward matrix. Clients without purchases get the lowest
+        frequency and monetary score and the longest recency
+        """
+        quantiles = rfm_quantiles(user_data)
+        client_data = user_data.reindex(reward_matrix.index).fillna(
+            {"Total_Purchases": 0, "Total_Spent": 0, "Recency": user_data["Recency"].max()})
+        client_data = score_rfm(client_data, quantiles)
+        return cls(reward_matrix[RECOMMENDATIONS].to_numpy(),
+                   rfm_context_ids(client_data["R_Score"], client_data["F_Score"], client_data["M_Score"]), **kwargs)
+
+    def simulation_tasks(self, policy_specs, n_rounds, n_replicas, replicas_per_task):
+        """
+        :return: list of simulate_replicas_task tasks, every task has at most replicas_per_task replicas
+        """
+        task_replicas = [min(replicas_per_task, n_replicas - start) for start in range(0, n_replicas, replicas_per_task)]
+        task_seeds = np.random.SeedSequence(self.seed).spawn(len(task_replicas))
+        return [(policy_specs, self.expected_rewards, self.client_contexts, self.n_contexts, n_rounds, replicas,
+                 self.batch_size, self.binary_rewards, task_seed)
+                for replicas, task_seed in zip(task_replicas, task_seeds)]
+
+    def simulate(self, policy_specs, n_rounds=10_000, n_replicas=100, replicas_per_task=25, processes=None):
+        """
+        :param policy_specs: list of (policy name, parameters) tuples, the names are the keys of POLICIES, for
+        example [("epsilon_greedy", {"epsilon": 0.1}), ("ucb", {}), ("thompson_sampling", {})]
+        :param n_rounds: the number of rounds of every replica
+        :param n_replicas: the number of replicas of every policy
+        :param replicas_per_task: the number of replicas that are simulated at once in a task
+        :param processes: number of worker processes, by default the available cores. With 1 process the replicas
+        are simulated without a pool
+        :return: dict per policy label with the mean reward and regret per round over the replicas, the running
+        mean reward and regret of the notebook plots, the total reward and regret per replica and the share of every
+        action
+        """
+        start_time = time.perf_counter()
+        tasks = self.simulation_tasks(policy_specs, n_rounds, n_replicas, replicas_per_task)
+        simulated_replicas = 0
+        totals = {}
+        if processes == 1:
+            for task in tasks:
+                simulated_replicas += self.add_task_totals(totals, simulate_replicas_task(task))
+        else:
+            with Pool(processes=min(processes or available_processes(), len(tasks))) as pool:
+                for task_result in pool.imap_unordered(simulate_replicas_task, tasks):
+                    simulated_replicas += self.add_task_totals(totals, task_result)
+        print(f"Simulated {simulated_replicas} replicas of {n_rounds} rounds of {len(totals)} policies in "
+              f"{time.perf_counter() - start_time:.2f}s")
+        return {label: self.summarize(policy_totals, simulated_replicas) for label, policy_totals in totals.items()}
+
+    @staticmethod
+    def add_task_totals(totals, task_result):
+        """
+        adds the totals of a task to the totals of all tasks
+        :param totals: dict per policy label with the summed totals, it is updated
+        :param task_result: the result of simulate_replicas_task
+        :return: the number of replicas of the task
+        """
+        task_replicas, task_totals = task_result
+        for label, policy_totals in task_totals.items():
+            if label not in totals:
+                totals[label] = policy_totals
+            else:
+                for key, values in policy_totals.items():
+                    totals[label][key] += values
+        return task_replicas
+
+    @staticmethod
+    def summarize(policy_totals, n_replicas):
+        """
+        :param policy_totals: the summed totals of a policy of simulate_replicas_task
+        :param n_replicas: the number of replicas the totals are summed over
+        :return: dict with the results of the policy
+        """
+        rounds = np.arange(1, len(policy_totals["reward_sums"]) + 1)
+        rewards = policy_totals["reward_sums"] / n_replicas
+        regrets = policy_totals["regret_sums"] / n_replicas
+        return {
+            "rewards": rewards,
+            "regrets": regrets,
+            "mean_rewards": np.cumsum(rewards) / rounds,
+            "mean_regrets": np.cumsum(regrets) / rounds,
+            "total_reward": float(rewards.sum()),
+            "total_regret": float(regrets.sum()),
+            "action_shares": dict(zip(RECOMMENDATIONS, (policy_totals["action_counts"]
+                                                        / policy_totals["action_counts"].sum()).tolist())),
+        }
+
+
+if __name__ == "__main__":
+    # compares the bandits of segmentation.ipynb with the RFM rule on the rewards of the current ranking system
+    from rewardRandomForest import RewardPredictor
+
+    purchases = get_table_storage_for_file("processed_data/processed_purchase_events.csv").read(
+        "processed_data/processed_purchase_events.csv")
+    reward_matrix = segment_reward_matrix(RewardPredictor(), ranking_system="benchmark_bidfood_current_prediction_system")
+    simulator = BanditSimulator.from_rfm(user_rfm_features(purchases), reward_matrix)
+    simulation_results = simulator.simulate([("epsilon_greedy", {"epsilon": 0.1}), ("ucb", {}),
+                                             ("thompson_sampling", {}), ("rfm_rule", {})],
+                                            n_rounds=100_000, n_replicas=100)
+    for label, policy_results in simulation_results.items():
+        print(f"{label}: mean reward {policy_results['total_reward'] / len(policy_results['rewards']):.4f}, "
+              f"total regret {policy_results['total_regret']:.1f}, actions {policy_results['action_shares']}")
@@ -0,0 +1,270 @@
+import json
+import os
+from multiprocessing import Pool
+
+import numpy as np
+
+from pipeline_instrumentation import RunReport, TaskMeasurement, timed_stage
+from process_client_tree import available_processes
+from rewardRandomForest import RewardPredictor
+from shared_tables import SharedArrays, attach_arrays
+from table_storage import get_table_storage_for_file
+
+# the segment of a benchmark file is found from its file name
+BENCHMARK_SEGMENTS = {
+    "premium": "premium",
+    "re_engagement": "re-engagement",
+    "regular": "regular",
+}
+
+# the number of rows the bootstrap weights are drawn for at once, so the weights of a chunk take about
+# n_bootstrap * BOOTSTRAP_BLOCK_ROWS * 8 bytes whatever the chunk size is
+BOOTSTRAP_BLOCK_ROWS = 2048
+
+# the reward predictor of a worker process, it is loaded once per process by init_evaluation_worker
+worker_reward_predictor = None
+
+
+def segment_of_benchmark_file(file_name):
+    """
+    :param file_name: name of the benchmark file, for example updated_premium_product_line_session_related.csv
+    :return: the segment of the file (premium, re-engagement or regular), or the file name without extension
+    """
+    for name_part, segment in BENCHMARK_SEGMENTS.items():
+        if name_part in file_name:
+            return segment
+    return os.path.splitext(file_name)[0]
+
+
+def list_benchmark_files(benchmark_folder="benchmark_data"):
+    """
+    :param benchmark_folder: the folder with a folder of benchmark files per ranking system
+    :return: list of (folder, file name, path) tuples
+    """
+    benchmark_files = []
+    for folder in sorted(os.listdir(benchmark_folder)):
+        folder_path = os.path.join(benchmark_folder, folder)
+        if not os.path.isdir(folder_path):
+            continue
+        for file_name in sorted(os.listdir(folder_path)):
+            if ".DS_Store" in file_name:
+                continue
+            benchmark_files.append((folder, file_name, os.path.join(folder_path, file_name)))
+    return benchmark_files
+
+
+class RewardAccumulator:
+    """
+    Running sums of the predicted rewards of a benchmark file, segment or ranking system. Only the sums are kept, so
+    the per row rewards can be thrown away after every chunk.
+
+    The confidence intervals come from a Poisson bootstrap: every row gets a Poisson(1) weight per bootstrap
+    replicate, which is the streaming version of resampling the rows with replacement. Accumulators of different
+    files can be merged by adding their sums.
+    """
+
+    def __init__(self, n_bootstrap=1000):
+        """
+        :param n_bootstrap: the number of bootstrap replicates
+        """
+        self.n_bootstrap = n_bootstrap
+        self.rows = 0
+        self.reward_sum = 0.0
+        self.reward_square_sum = 0.0
+        self.bootstrap_sums = np.zeros(n_bootstrap, dtype=np.float64)
+        self.bootstrap_rows = np.zeros(n_bootstrap, dtype=np.float64)
+
+    def add(self, rewards, random_generator):
+        """
+        adds the rewards of a chunk
+        :param rewards: array with the predicted reward per row
+        :param random_generator: numpy Generator for the bootstrap weights
+        :return:
+        """
+        rewards = np.asarray(rewards, dtype=np.float64)
+        self.rows += len(rewards)
+        self.reward_sum += float(rewards.sum())
+        self.reward_square_sum += float(np.square(rewards).sum())
+        if self.n_bootstrap:
+            for block_start in range(0, len(rewards), BOOTSTRAP_BLOCK_ROWS):
+                reward_block = rewards[block_start:block_start + BOOTSTRAP_BLOCK_ROWS]
+                weights = random_generator.poisson(1.0, size=(self.n_bootstrap, len(reward_block))).astype(np.float64)
+                self.bootstrap_sums += weights @ reward_block
+                self.bootstrap_rows += weights.sum(axis=1)
+
+    def merge(self, other):
+        """
+        adds the sums of another accumulator with the same number of bootstrap replicates
+        :return: the accumulator
+        """
+        self.rows += other.rows
+        self.reward_sum += other.reward_sum
+        self.reward_square_sum += other.reward_square_sum
+        self.bootstrap_sums += other.bootstrap_sums
+        self.bootstrap_rows += other.bootstrap_rows
+        return self
+
+    def summary(self, confidence=0.95):
+        """
+        :param confidence: the confidence level of the intervals
+        :return: dict with the number of rows, the summed and mean reward and their bootstrap confidence intervals
+        """
+        reward_mean = self.reward_sum / self.rows if self.rows else 0.0
+        reward_std = np.sqrt(max(self.reward_square_sum / self.rows - reward_mean ** 2, 0.0)) if self.rows else 0.0
+        summary = {
+            "rows": self.rows,
+            "reward_sum": self.reward_sum,
+            "reward_mean": reward_mean,
+            "reward_std": float(reward_std),
+        }
+        if self.n_bootstrap:
+            quantiles = [(1 - confidence) / 2, 1 - (1 - confidence) / 2]
+            bootstrap_means = self.bootstrap_sums / np.maximum(self.bootstrap_rows, 1)
+            summary["reward_sum_ci"] = np.quantile(self.bootstrap_sums, quantiles).tolist()
+            summary["reward_mean_ci"] = np.quantile(bootstrap_means, quantiles).tolist()
+        return summary
+
+
+def init_evaluation_worker(model_location, predictor_descriptors=None):
+    """
+    loads the reward predictor once per worker process
+    :param model_location: the model to load, a pickle or an exported .forest folder
+    :param predictor_descriptors: optional descriptors of the model arrays in shared memory, see
+    RewardPredictor.shared_arrays. The worker attaches to them instead of loading its own copy of the model
+    """
+    global worker_reward_predictor
+    if predictor_descriptors is None:
+        worker_reward_predictor = RewardPredictor(model_location)
+    else:
+        worker_reward_predictor = RewardPredictor.from_shared_arrays(model_location,
+                                                                     attach_arrays(predictor_descriptors))
+
+
+def evaluate_benchmark_file_task(task):
+    """
+    Scores one benchmark file chunk by chunk with the reward predictor of the worker
+    :param task: tuple of (folder, file name, path, chunk size, number of bootstrap replicates, seed)
+    :return: tuple of (folder, file name, RewardAccumulator, wall time, metrics of the TaskMeasurement of the file)
+    """
+    folder, file_name, path, chunk_size, n_bootstrap, seed = task
+    with TaskMeasurement(f"{folder}/{file_name}") as measurement:
+        random_generator = np.random.default_rng(seed)
+        accumulator = RewardAccumulator(n_bootstrap)
+        for chunk in get_table_storage_for_file(path).read_chunks(path, chunk_size=chunk_size):
+            with timed_stage("preprocess", rows=len(chunk)):
+                chunk = worker_reward_predictor.preprocessing_data(chunk)
+            rewards = worker_reward_predictor.predict_reward(chunk)
+            accumulator.add(rewards, random_generator)
+        measurement.rows = accumulator.rows
+    return folder, file_name, accumulator, measurement.wall_seconds, measurement.metrics
+
+
+class BenchmarkEvaluator:
+    """
+    Parallel and streaming replacement of RewardPredictor.predict_ranking_complete_dataset. The benchmark files are
+    scored concurrently in worker processes, every file is read in chunks and only running sums of the rewards are
+    kept, so the size of the benchmark files is not limited by the memory.
+
+    The rewards are summarized per file, per segment (premium / re-engagement / regular) of every ranking system and
+    per ranking system. The separator of every csv file is detected from its header.
+    Chunks are encoded with the frozen categorical encoder of the model, a model without encoder would give every
+    chunk its own category numbers.
+    """
+
+    def __init__(self, model_location="models/reward_predictor_model_weather_0.pkl", benchmark_folder="benchmark_data",
+                 chunk_size=100_000, n_bootstrap=1000, confidence=0.95, seed=0, share_model=False):
+        """
+        :param model_location: the model to score with, a pickle or an exported .forest folder
+        :param benchmark_folder: the folder with a folder of benchmark files per ranking system
+        :param chunk_size: the number of rows that are scored at once
+        :param n_bootstrap: the number of bootstrap replicates for the confidence intervals, 0 skips them
+        :param confidence: the confidence level of the intervals
+        :param seed: seed of the bootstrap weights, every file gets its own stream so the results do not depend on
+        the order the workers finish in
+        :param share_model: if True the model is loaded once and put in shared memory as a CompactForest, so the memory
+        of the model does not grow with the number of workers. The rewards are the same, but a CompactForest
+        predicts slower than the scikit-learn forest
+        """
+        self.model_location = model_location
+        self.benchmark_folder = benchmark_folder
+        self.chunk_size = chunk_size
+        self.n_bootstrap = n_bootstrap
+        self.confidence = confidence
+        self.seed = seed
+        self.share_model = share_model
+
+    def evaluate(self, processes=None, report_path=None):
+        """
+        scores all benchmark files
+        :param processes: number of worker processes, by default the available cores
+        :param report_path: optional json file to write the RunReport of the files to, see pipeline_instrumentation.py
+        :return: dict with the summaries per file, per segment and per ranking system
+        """
+        benchmark_files = list_benchmark_files(self.benchmark_folder)
+        file_seeds = np.random.SeedSequence(self.seed).spawn(len(benchmark_files))
+        tasks = [(folder, file_name, path, self.chunk_size, self.n_bootstrap, file_seed)
+                 for (folder, file_name, path), file_seed in zip(benchmark_files, file_seeds)]
+
+        processes = min(processes or available_processes(), max(len(tasks), 1))
+        file_accumulators = {}
+        run_report = RunReport("benchmark_evaluation")
+        with SharedArrays() as shared_arrays:
+            predictor_descriptors = None
+            if self.share_model:
+                predictor_descriptors = shared_arrays.share(RewardPredictor(self.model_location).shared_arrays())
+            with Pool(processes=processes, initializer=init_evaluation_worker,
+                      initargs=(self.model_location, predictor_descriptors)) as pool:
+                for folder, file_name, accumulator, wall_time, metrics in pool.imap_unordered(
+                        evaluate_benchmark_file_task, tasks):
+                    print(f"Scored {folder}/{file_name}: {accumulator.rows} rows in {wall_time:.2f}s")
+                    file_accumulators[(folder, file_name)] = accumulator
+                    run_report.add(metrics)
+
+        if report_path is not None:
+            run_report.write(report_path)
+
+        return self.summarize(file_accumulators)
+
+    def summarize(self, file_accumulators):
+        """
+        merges the accumulators of the files per segment and per ranking system
+        :param file_accumulators: dict with a RewardAccumulator per (folder, file name)
+        :return: dict with the summaries per file, per segment and per ranking system
+        """
+        results = {"files": {}, "segments": {}, "systems": {}}
+        segment_accumulators = {}
+        system_accumulators = {}
+        for (folder, file_name), accumulator in sorted(file_accumulators.items()):
+            results["files"][f"{folder} - {file_name}"] = accumulator.summary(self.confidence)
+            segment = segment_of_benchmark_file(file_name)
+            segment_accumulators.setdefault((folder, segment), RewardAccumulator(self.n_bootstrap)).merge(accumulator)
+            system_accumulators.setdefault(folder, RewardAccumulator(self.n_bootstrap)).merge(accumulator)
+
+        for (folder, segment), accumulator in segment_accumulators.items():
+            results["segments"].setdefault(folder, {})[segment] = accumulator.summary(self.confidence)
+        for folder, accumulator in system_accumulators.items():
+            results["systems"][folder] = accumulator.summary(self.confidence)
+        return results
+
+    @staticmethod
+    def write_results(results, summed_rewards_file="rewards.json", breakdown_file="rewards_breakdown.json"):
+        """
+        writes the summed reward per file in the format of predict_ranking_complete_dataset and the full breakdown
+        :param results: the results of evaluate
+        :param summed_rewards_file: the json file with the summed reward per file
+        :param breakdown_file: the json file with the summaries per file, segment and ranking system
+        :return:
+        """
+        summed_rewards = {file_key: int(file_summary["reward_sum"])
+                          for file_key, file_summary in results["files"].items()}
+        with open(summed_rewards_file, "w") as file:
+            file.write(json.dumps(summed_rewards))
+        with open(breakdown_file, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    evaluator = BenchmarkEvaluator()
+    evaluation_results = evaluator.evaluate()
+    evaluator.write_results(evaluation_results)
+    print(json.dumps(evaluation_results["segments"], indent=2))
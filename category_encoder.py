@@ -0,0 +1,161 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+# the columns randomForestModelCreatorWeather.ipynb turns into category numbers before training
+TRAINING_CATEGORICAL_COLUMNS = ["PAGE_NAME", "PAGE_SECTION", "PRODUCT_TYPE", "DEVICE_INFO_BRAND", "DEVICE_INFO_TYPE",
+                                "DEVICE_INFO_BROWSER", "PROMOTION_LABEL", "USER_SALES_GROUP", "USER_SEGMENT",
+                                "USER_SALES_DISTRICT", "EVENT"]
+
+
+class CategoricalEncoder:
+    """
+    Frozen mapping of categorical values to category numbers. It is fitted once on the training data and saved next
+    to the model, so training, the evaluator notebook and the RewardPredictor all use the same numbers.
+
+    The numbers are given in order of first appearance, exactly like the transformation_dict of the training
+    notebook, so an encoder fitted on the training data reproduces the numbers the model was trained with.
+    Values that were not seen while fitting get the unknown_value, or raise a ValueError when handle_unknown is
+    "error".
+    """
+
+    def __init__(self, categories=None, unknown_value=-1, handle_unknown="code"):
+        """
+        :param categories: dict with per column the list of values, the position in the list is the category number
+        :param unknown_value: category number of the values that were not seen while fitting
+        :param handle_unknown: "code" gives unseen values the unknown_value, "error" raises a ValueError
+        """
+        if handle_unknown not in ("code", "error"):
+            raise ValueError("handle_unknown can only be code or error")
+        self.categories = {}
+        self.unknown_value = unknown_value
+        self.handle_unknown = handle_unknown
+        for column, values in (categories or {}).items():
+            self.categories[column] = pd.Index(values, dtype=object)
+
+    def fit(self, table, columns=TRAINING_CATEGORICAL_COLUMNS):
+        """
+        fits the category numbers on the values of the table in order of first appearance
+        :param table: the training data
+        :param columns: the categorical columns
+        :return: the encoder
+        """
+        for column in columns:
+            self.categories[column] = pd.Index(pd.unique(table[column]), dtype=object)
+        return self
+
+    def partial_fit(self, table, columns=TRAINING_CATEGORICAL_COLUMNS):
+        """
+        adds the values of the table that were not seen yet, after the values that were. Fitting the chunks of a
+        table one after the other gives the same category numbers as fitting the whole table at once
+        :param table: a chunk of the training data
+        :param columns: the categorical columns
+        :return: the encoder
+        """
+        for column in columns:
+            chunk_values = pd.Index(pd.unique(table[column]), dtype=object)
+            if column not in self.categories:
+                self.categories[column] = chunk_values
+                continue
+            self.categories[column] = self.categories[column].append(
+                chunk_values[self.categories[column].get_indexer(chunk_values) == -1])
+        return self
+
+    def transform(self, table, inplace=False):
+        """
+        replaces the values of the fitted columns that are in the table with their category number
+        :param table: the table to encode
+        :param inplace: if True, the columns of the table itself are replaced
+        :return: the encoded table
+        """
+        if not inplace:
+            table = table.copy()
+        for column, categories in self.categories.items():
+            if column not in table.columns:
+                continue
+            # only the few unique values of the column are looked up, the rows get their code with a take
+            value_codes, unique_values = pd.factorize(table[column], use_na_sentinel=False)
+            unique_codes = categories.get_indexer(pd.Index(unique_values, dtype=object))
+            unseen_values = unique_codes == -1
+            if unseen_values.any():
+                if self.handle_unknown == "error":
+                    raise ValueError(f"Unseen values in column {column}: "
+                                     f"{list(unique_values[unseen_values][:10])}")
+                unique_codes[unseen_values] = self.unknown_value
+            table[column] = unique_codes.take(value_codes)
+        return table
+
+    def inverse_transform(self, table, inplace=False):
+        """
+        replaces the category numbers of the fitted columns that are in the table with their values. The
+        unknown_value becomes NaN
+        :param table: the encoded table
+        :param inplace: if True, the columns of the table itself are replaced
+        :return: the decoded table
+        """
+        if not inplace:
+            table = table.copy()
+        for column, categories in self.categories.items():
+            if column not in table.columns:
+                continue
+            codes = table[column].to_numpy()
+            known_codes = (codes >= 0) & (codes < len(categories))
+            values = np.full(len(codes), np.nan, dtype=object)
+            values[known_codes] = categories.to_numpy().take(codes[known_codes])
+            table[column] = values
+        return table
+
+    def to_transformation_dict(self):
+        """
+        :return: the mapping in the format of the transformation_dict of the notebooks
+        """
+        return {column: {value: code for code, value in enumerate(categories)}
+                for column, categories in self.categories.items()}
+
+    def save(self, path):
+        """
+        saves the encoder as json
+        :param path: path of the json file, see encoder_path_for_model
+        :return:
+        """
+        with open(path, "w") as file:
+            json.dump({
+                "unknown_value": self.unknown_value,
+                "handle_unknown": self.handle_unknown,
+                "categories": {column: [self.to_json_value(value) for value in categories]
+                               for column, categories in self.categories.items()},
+            }, file)
+
+    @classmethod
+    def load(cls, path):
+        """
+        loads an encoder that was saved with save
+        :param path: path of the json file
+        :return: CategoricalEncoder
+        """
+        with open(path, "r") as file:
+            encoder_data = json.load(file)
+        return cls(categories=encoder_data["categories"],
+                   unknown_value=encoder_data["unknown_value"],
+                   handle_unknown=encoder_data["handle_unknown"])
+
+    @staticmethod
+    def to_json_value(value):
+        """
+        :return: the value as a python type json can write
+        """
+        if isinstance(value, np.generic):
+            return value.item()
+        return value
+
+    @staticmethod
+    def encoder_path_for_model(model_location):
+        """
+        :param model_location: the location of the model, for example models/reward_predictor_model_weather_0.pkl
+        :return: the location of the encoder next to it, for example
+        models/reward_predictor_model_weather_0.encoder.json
+        """
+        return os.path.splitext(model_location)[0] + ".encoder.json"
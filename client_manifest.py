@@ -0,0 +1,208 @@
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+
+FEATURE_PURCHASES = "purchases"
+FEATURE_TOTAL_PRODUCT_SPEND = "total_spend_on_product"
+FEATURE_TOTAL_CATEGORY_PRODUCT_SPEND = "total_spend_on_category_product"
+
+# the outcome of comparing a purchases file with the fingerprint in the manifest
+PURCHASES_UNCHANGED = "unchanged"
+PURCHASES_APPENDED = "appended"
+PURCHASES_REWRITTEN = "rewritten"
+
+
+def features_from_flags(add_purchases=True, add_total_product_spend=False, add_total_category_product_spend=False):
+    """
+    :return: the set of feature names that belongs to the feature flags of ProcessClientsFolderTree
+    """
+    features = set()
+    if add_purchases:
+        features.add(FEATURE_PURCHASES)
+    if add_total_product_spend:
+        features.add(FEATURE_TOTAL_PRODUCT_SPEND)
+    if add_total_category_product_spend:
+        features.add(FEATURE_TOTAL_CATEGORY_PRODUCT_SPEND)
+    return features
+
+
+def flags_from_features(features):
+    """
+    :return: the feature flags of ProcessClientsFolderTree that belong to the set of feature names
+    """
+    return {
+        "add_purchases": FEATURE_PURCHASES in features,
+        "add_total_product_spend": FEATURE_TOTAL_PRODUCT_SPEND in features,
+        "add_total_category_product_spend": FEATURE_TOTAL_CATEGORY_PRODUCT_SPEND in features,
+    }
+
+
+def file_sha1(path, size=None, block_size=1 << 20):
+    """
+    :param path: path of the file
+    :param size: if given, only the first size bytes are hashed
+    :return: sha1 hex digest of the file content
+    """
+    sha1 = hashlib.sha1()
+    remaining = os.path.getsize(path) if size is None else size
+    with open(path, "rb") as file:
+        while remaining > 0:
+            block = file.read(min(block_size, remaining))
+            if not block:
+                break
+            sha1.update(block)
+            remaining -= len(block)
+    return sha1.hexdigest()
+
+
+def file_fingerprint(path):
+    """
+    :param path: path of the file
+    :return: dict with the size, modification time and sha1 of the file
+    """
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha1": file_sha1(path)}
+
+
+def file_unchanged(path, fingerprint):
+    """
+    Compares the file with its fingerprint. The size and modification time are checked first, so unchanged files do
+    not have to be read
+    :param path: path of the file
+    :param fingerprint: fingerprint from file_fingerprint
+    :return: True if the file content is the same as when the fingerprint was taken
+    """
+    if fingerprint is None or not os.path.exists(path):
+        return False
+    stat = os.stat(path)
+    if stat.st_size != fingerprint["size"]:
+        return False
+    if stat.st_mtime_ns == fingerprint["mtime_ns"]:
+        return True
+    return file_sha1(path) == fingerprint["sha1"]
+
+
+def purchases_change(path, fingerprint):
+    """
+    Finds out how the purchases file changed since the fingerprint was taken. New purchases that are appended to
+    the end of the file can be processed incrementally, any other change needs a full recompute
+    :param path: path of the purchases file
+    :param fingerprint: fingerprint from file_fingerprint
+    :return: PURCHASES_UNCHANGED, PURCHASES_APPENDED or PURCHASES_REWRITTEN
+    """
+    if file_unchanged(path, fingerprint):
+        return PURCHASES_UNCHANGED
+    if fingerprint is None or not os.path.exists(path):
+        return PURCHASES_REWRITTEN
+    if os.path.getsize(path) > fingerprint["size"] and file_sha1(path, size=fingerprint["size"]) == fingerprint["sha1"]:
+        return PURCHASES_APPENDED
+    return PURCHASES_REWRITTEN
+
+
+def first_appended_purchase_date(purchases_table, previous_rows, date_column="DATE"):
+    """
+    :param purchases_table: the purchases table with the appended rows
+    :param previous_rows: the number of rows the table had when the manifest was written
+    :return: the earliest date of the appended purchases, or None if no rows were appended
+    """
+    appended_dates = pd.to_datetime(purchases_table[date_column].iloc[previous_rows:])
+    if appended_dates.notna().sum() == 0:
+        return None
+    return appended_dates.min().normalize()
+
+
+def appended_new_category_pairs(purchases_table, previous_rows):
+    """
+    The category spend of an event sums all purchases of the propositions bought in its category. When an appended
+    purchase puts a proposition in a category for the first time, the older purchases of that proposition start to
+    count as well, so the category spend of older events changes too
+    :param purchases_table: the purchases table with the appended rows
+    :param previous_rows: the number of rows the table had when the manifest was written
+    :return: True if the appended rows contain a (PROPOSITION, ARTICLE_CATEGORIE) pair that was not there before
+    """
+    if "ARTICLE_CATEGORIE" not in purchases_table.columns:
+        return False
+    pair_columns = ["PROPOSITION", "ARTICLE_CATEGORIE"]
+    previous_pairs = pd.MultiIndex.from_frame(purchases_table[pair_columns].iloc[:previous_rows].dropna())
+    appended_pairs = pd.MultiIndex.from_frame(purchases_table[pair_columns].iloc[previous_rows:].dropna())
+    return not appended_pairs.isin(previous_pairs).all()
+
+
+class ClientManifest:
+    """
+    Manifest of the client folder tree. It records per client the fingerprints of the events and purchases files and
+    the features that are already computed, so a run can skip the clients that did not change, resume after a crash
+    and only recompute the clients that got new purchases.
+    The manifest is saved with an atomic rename, so a crash while saving never leaves a broken manifest behind.
+    """
+
+    def __init__(self, manifest_path="client_data/manifest.json"):
+        """
+        :param manifest_path: the json file of the manifest. The name has a dot in it, so
+        ProcessClientsFolderTree.process_clients_setup skips it when it lists the clients
+        """
+        self.manifest_path = manifest_path
+        self.clients = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as file:
+                self.clients = json.load(file)
+
+    def get(self, client_id):
+        """
+        :return: the manifest entry of the client, or None if the client was never processed
+        """
+        return self.clients.get(str(client_id))
+
+    def record(self, client_id, entry):
+        """
+        Stores the manifest entry of a processed client
+        :param client_id: the id of the client
+        :param entry: the manifest entry from create_entry
+        :return:
+        """
+        self.clients[str(client_id)] = entry
+
+    def save(self):
+        """
+        writes the manifest to a temporary file and renames it over the manifest
+        :return:
+        """
+        temporary_path = self.manifest_path + ".tmp"
+        with open(temporary_path, "w") as file:
+            json.dump(self.clients, file)
+        os.replace(temporary_path, self.manifest_path)
+
+    @staticmethod
+    def create_entry(events_path, purchases_path, purchases_rows, features, date_ranges):
+        """
+        :param events_path: path of the written events file
+        :param purchases_path: path of the written purchases file
+        :param purchases_rows: number of rows in the purchases table
+        :param features: the features that are computed in the events file
+        :param date_ranges: the date ranges of the purchases_<date_range>_day_after columns
+        :return: the manifest entry of the client
+        """
+        purchases_fingerprint = file_fingerprint(purchases_path)
+        purchases_fingerprint["rows"] = int(purchases_rows)
+        return {
+            "events": file_fingerprint(events_path),
+            "purchases": purchases_fingerprint,
+            "features": sorted(features),
+            "date_ranges": list(date_ranges),
+        }
+
+    @staticmethod
+    def is_up_to_date(entry, events_path, purchases_path, features, date_ranges):
+        """
+        :return: True if the client does not have to be processed again for the requested features
+        """
+        if entry is None:
+            return False
+        if not features.issubset(entry["features"]):
+            return False
+        if FEATURE_PURCHASES in features and list(date_ranges) != entry["date_ranges"]:
+            return False
+        return file_unchanged(events_path, entry["events"]) and file_unchanged(purchases_path, entry["purchases"])
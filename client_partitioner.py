@@ -0,0 +1,152 @@
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+from process_client_tree import available_processes
+from table_storage import (HIVE_PARTITION_COLUMN, client_table_path, get_table_storage,
+                           get_table_storage_for_file)
+
+
+def write_client_partitions_task(task):
+    """
+    Writes the events and purchases of a chunk of clients
+    :param task: tuple of (client folder path, storage, layout, list of (client id, events, purchases) tuples)
+    :return: the number of written clients
+    """
+    client_folder_path, storage, layout, partitions = task
+    storage = get_table_storage(storage)
+    for client_id, client_events, client_purchases in partitions:
+        for table_name, table in (("events", client_events), ("purchases", client_purchases)):
+            path = client_table_path(client_folder_path, client_id, table_name, storage.extension, layout)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if layout == "hive":
+                # the value of the partition column is in the folder name
+                table = table.drop(columns=[HIVE_PARTITION_COLUMN])
+            storage.write(table, path)
+    return len(partitions)
+
+
+class ClientPartitioner:
+    """
+    Splits the processed events and purchases into the tables per client, replacing the loop of
+    save_clients_in_folder_structure_updated.ipynb that filtered the full tables once for every client.
+
+    Both tables are sorted on USER_CLIENT_NUMBER once, after which the rows of every client are a contiguous slice
+    that is found with a binary search. The slices are written by worker processes, a chunk of clients per task.
+    Only the clients with both events and purchases are written, like in the notebook.
+
+    The tables are written in the folder layout (client_data/<client id>/events.csv) or as Hive-style partitioned
+    datasets (client_data/events/USER_CLIENT_NUMBER=<client id>/part-0.csv). Client reads both layouts.
+    """
+
+    def __init__(self, client_folder_path="client_data", storage="csv", layout="folder"):
+        """
+        :param client_folder_path: the folder to write the client tables to
+        :param storage: the table storage backend of the client tables, csv or parquet
+        :param layout: folder or hive, see table_storage.client_table_layout
+        """
+        if layout not in ("folder", "hive"):
+            raise ValueError(f"Client table layout {layout} not recognized, use folder or hive")
+        self.client_folder_path = client_folder_path
+        self.storage = storage
+        self.layout = layout
+
+    @staticmethod
+    def load_table(path):
+        """
+        reads a processed table, without the unnamed index column some of the csv files have
+        :param path: path of the csv or parquet file
+        :return: the table
+        """
+        table = get_table_storage_for_file(path).read(path)
+        if "Unnamed: 0" in table.columns:
+            table = table.drop(columns=["Unnamed: 0"])
+        return table
+
+    @staticmethod
+    def clients_with_purchases_and_events(events_table, purchases_table):
+        """
+        :return: sorted array of the client ids that have both events and purchases
+        """
+        return np.intersect1d(pd.unique(events_table[HIVE_PARTITION_COLUMN]),
+                              pd.unique(purchases_table[HIVE_PARTITION_COLUMN]))
+
+    @staticmethod
+    def sort_on_client(table, client_ids):
+        """
+        Sorts the rows of the clients on the client id. The sort is stable, so the rows of a client keep the order
+        they have in the table
+        :param table: the events or purchases
+        :param client_ids: sorted array of the client ids to keep
+        :return: tuple of the sorted table and the start and end row of every client
+        """
+        client_column = table[HIVE_PARTITION_COLUMN].to_numpy()
+        kept_rows = np.flatnonzero(np.isin(client_column, client_ids))
+        order = kept_rows[np.argsort(client_column[kept_rows], kind="stable")]
+        sorted_clients = client_column[order]
+        return (table.take(order), np.searchsorted(sorted_clients, client_ids, side="left"),
+                np.searchsorted(sorted_clients, client_ids, side="right"))
+
+    def partition_tasks(self, events_table, purchases_table, client_ids, clients_per_task):
+        """
+        :return: iterator over the write tasks, every task has the slices of clients_per_task clients
+        """
+        sorted_events, event_starts, event_ends = self.sort_on_client(events_table, client_ids)
+        sorted_purchases, purchase_starts, purchase_ends = self.sort_on_client(purchases_table, client_ids)
+        for chunk_start in range(0, len(client_ids), clients_per_task):
+            partitions = []
+            for index in range(chunk_start, min(chunk_start + clients_per_task, len(client_ids))):
+                partitions.append((str(client_ids[index]),
+                                   sorted_events.iloc[event_starts[index]:event_ends[index]],
+                                   sorted_purchases.iloc[purchase_starts[index]:purchase_ends[index]]))
+            yield self.client_folder_path, self.storage, self.layout, partitions
+
+    def partition(self, events_table, purchases_table, processes=None, clients_per_task=100):
+        """
+        writes the events and purchases of every client with both events and purchases
+        :param events_table: the processed events
+        :param purchases_table: the purchases
+        :param processes: number of worker processes, by default the available cores. With 1 process the tables are
+        written without a pool
+        :param clients_per_task: the number of clients that are written per task
+        :return: the number of written clients
+        """
+        start_time = time.perf_counter()
+        client_ids = self.clients_with_purchases_and_events(events_table, purchases_table)
+        print("total clients with purchases and data events that will be saved: ", len(client_ids))
+        os.makedirs(self.client_folder_path, exist_ok=True)
+
+        tasks = self.partition_tasks(events_table, purchases_table, client_ids, clients_per_task)
+        written_clients = 0
+        if processes == 1:
+            for task in tasks:
+                written_clients += write_client_partitions_task(task)
+        else:
+            with Pool(processes=processes or available_processes()) as pool:
+                for task_index, chunk_clients in enumerate(pool.imap_unordered(write_client_partitions_task, tasks)):
+                    written_clients += chunk_clients
+                    if task_index % 10 == 0:
+                        print(f"Written {written_clients}/{len(client_ids)} clients")
+
+        print(f"Written {written_clients} clients in {time.perf_counter() - start_time:.2f}s")
+        return written_clients
+
+    def partition_files(self, events_path, purchases_path, processes=None, clients_per_task=100):
+        """
+        reads the processed events and purchases and writes the tables per client
+        :param events_path: path of the processed events, csv or parquet
+        :param purchases_path: path of the purchases, csv or parquet
+        :return: the number of written clients
+        """
+        return self.partition(self.load_table(events_path), self.load_table(purchases_path),
+                              processes=processes, clients_per_task=clients_per_task)
+
+
+if __name__ == "__main__":
+    # builds the client_data folder tree of save_clients_in_folder_structure_updated.ipynb
+    partitioner = ClientPartitioner("client_data", storage="csv", layout="folder")
+    partitioner.partition_files("processed_data/processed_events_final.csv",
+                                "processed_data/purchase_data_with_categories.csv")
@@ -0,0 +1,247 @@
+import json
+import os
+import pickle
+
+import numpy as np
+
+
+COMPACT_FOREST_EXTENSION = ".forest"
+COMPACT_FOREST_VERSION = 1
+
+# the node arrays of all trees, every array is saved as its own .npy file so it can be memory mapped
+NODE_ARRAYS = ["children_left", "children_right", "feature", "threshold", "missing_go_to_left", "value"]
+TREE_LEAF = -1
+
+
+def compact_forest_path_for_model(model_location):
+    """
+    :param model_location: the location of the pickled model, for example models/reward_predictor_model_weather_0.pkl
+    :return: the location of the exported forest, for example models/reward_predictor_model_weather_0.forest
+    """
+    return os.path.splitext(model_location)[0] + COMPACT_FOREST_EXTENSION
+
+
+def compact_forest_arrays(model):
+    """
+    Flattens the trees of a fitted RandomForestRegressor into contiguous arrays. The node numbers of every tree are
+    shifted by the number of nodes of the trees before it, so the children arrays point directly into the
+    concatenated arrays
+    :param model: fitted RandomForestRegressor
+    :return: tuple of (dict with the forest.json data, dict with the roots and the NODE_ARRAYS)
+    """
+    trees = [estimator.tree_ for estimator in model.estimators_]
+    node_counts = np.array([tree.node_count for tree in trees], dtype=np.int64)
+    roots = np.concatenate([[0], np.cumsum(node_counts)[:-1]]).astype(np.int64)
+
+    node_arrays = {name: [] for name in NODE_ARRAYS}
+    for root, tree in zip(roots, trees):
+        is_leaf = tree.children_left == TREE_LEAF
+        node_arrays["children_left"].append(np.where(is_leaf, TREE_LEAF, tree.children_left + root))
+        node_arrays["children_right"].append(np.where(is_leaf, TREE_LEAF, tree.children_right + root))
+        node_arrays["feature"].append(tree.feature)
+        node_arrays["threshold"].append(tree.threshold)
+        # trees of scikit-learn versions without missing value support send missing values to the right
+        node_arrays["missing_go_to_left"].append(getattr(tree, "missing_go_to_left", np.zeros(tree.node_count)))
+        # the value of a regression tree has the shape (nodes, outputs, 1)
+        node_arrays["value"].append(tree.value[:, :, 0])
+
+    arrays = {
+        "roots": roots,
+        "children_left": np.concatenate(node_arrays["children_left"]).astype(np.int64),
+        "children_right": np.concatenate(node_arrays["children_right"]).astype(np.int64),
+        "feature": np.concatenate(node_arrays["feature"]).astype(np.int64),
+        "threshold": np.concatenate(node_arrays["threshold"]).astype(np.float64),
+        "missing_go_to_left": np.concatenate(node_arrays["missing_go_to_left"]).astype(bool),
+        "value": np.concatenate(node_arrays["value"]).astype(np.float64),
+    }
+    feature_names = getattr(model, "feature_names_in_", None)
+    forest_data = {
+        "version": COMPACT_FOREST_VERSION,
+        "n_trees": len(trees),
+        "n_features": int(model.n_features_in_),
+        "n_outputs": int(model.n_outputs_),
+        "feature_names": None if feature_names is None else [str(name) for name in feature_names],
+    }
+    return forest_data, arrays
+
+
+def export_forest(model, forest_path):
+    """
+    Flattens the trees of a fitted RandomForestRegressor with compact_forest_arrays and saves them in the forest
+    folder
+    :param model: fitted RandomForestRegressor
+    :param forest_path: the folder to write the forest to, see compact_forest_path_for_model
+    :return: forest_path
+    """
+    forest_data, arrays = compact_forest_arrays(model)
+    os.makedirs(forest_path, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(forest_path, name + ".npy"), array)
+    with open(os.path.join(forest_path, "forest.json"), "w") as file:
+        json.dump(forest_data, file)
+    return forest_path
+
+
+def export_model_file(model_location, forest_path=None):
+    """
+    Exports a pickled model of the models folder
+    :param model_location: the location of the pickled model
+    :param forest_path: the folder to write the forest to, by default next to the model
+    :return: the folder of the forest
+    """
+    if forest_path is None:
+        forest_path = compact_forest_path_for_model(model_location)
+    with open(model_location, "rb") as pickle_file:
+        model = pickle.load(pickle_file)
+    return export_forest(model, forest_path)
+
+
+class CompactForest:
+    """
+    Predicts with a random forest that was exported with export_forest, without unpickling any scikit-learn
+    objects. The node arrays are memory mapped, so loading is almost instant and workers that load the same forest
+    share its pages instead of each holding a copy.
+
+    The predictions are bit-identical to RandomForestRegressor.predict (with the default n_jobs): the features are
+    cast to float32 like scikit-learn does, they are compared with the float64 thresholds, missing values follow
+    missing_go_to_left and the tree values are added up in tree order before they are divided by the number of
+    trees.
+    """
+
+    def __init__(self, forest_path, mmap_mode="r", chunk_rows=100_000):
+        """
+        :param forest_path: the folder of the exported forest
+        :param mmap_mode: mmap_mode of np.load, None loads the arrays in memory
+        :param chunk_rows: the number of rows that are walked through the trees at once
+        """
+        with open(os.path.join(forest_path, "forest.json"), "r") as file:
+            forest_data = json.load(file)
+        arrays = {name: np.load(os.path.join(forest_path, name + ".npy"), mmap_mode=mmap_mode)
+                  for name in ["roots"] + NODE_ARRAYS}
+        self.set_forest(forest_data, arrays, chunk_rows)
+        self.forest_path = forest_path
+
+    @classmethod
+    def from_arrays(cls, forest_data, arrays, chunk_rows=100_000):
+        """
+        :param forest_data: the forest.json data, see compact_forest_arrays
+        :param arrays: dict with the roots and the NODE_ARRAYS, they are used without a copy
+        :param chunk_rows: the number of rows that are walked through the trees at once
+        :return: CompactForest that is not saved in a folder
+        """
+        forest = cls.__new__(cls)
+        forest.set_forest(forest_data, arrays, chunk_rows)
+        forest.forest_path = None
+        return forest
+
+    @classmethod
+    def from_model(cls, model, chunk_rows=100_000):
+        """
+        :param model: fitted RandomForestRegressor
+        :return: CompactForest with the trees of the model, it predicts the same
+        """
+        return cls.from_arrays(*compact_forest_arrays(model), chunk_rows=chunk_rows)
+
+    def set_forest(self, forest_data, arrays, chunk_rows):
+        """
+        sets the metadata and the node arrays of the forest
+        """
+        if forest_data["version"] != COMPACT_FOREST_VERSION:
+            raise ValueError(f"Forest version {forest_data['version']} not supported")
+        self.forest_data = forest_data
+        self.n_trees = forest_data["n_trees"]
+        self.n_features_in_ = forest_data["n_features"]
+        self.n_outputs_ = forest_data["n_outputs"]
+        self.feature_names_in_ = forest_data["feature_names"]
+        self.chunk_rows = chunk_rows
+        self.roots = arrays["roots"]
+        for name in NODE_ARRAYS:
+            setattr(self, name, arrays[name])
+
+    def shared_arrays(self):
+        """
+        :return: dict with the node arrays and the forest.json data as a string, to put in shared memory with
+        shared_tables.SharedArrays
+        """
+        arrays = {name: getattr(self, name) for name in ["roots"] + NODE_ARRAYS}
+        arrays["forest_data"] = np.array(json.dumps(self.forest_data))
+        return arrays
+
+    @classmethod
+    def from_shared_arrays(cls, arrays, chunk_rows=100_000):
+        """
+        :param arrays: dict returned by shared_arrays, attached with shared_tables.attach_arrays
+        :return: CompactForest on the shared node arrays
+        """
+        node_arrays = {name: array for name, array in arrays.items() if name != "forest_data"}
+        return cls.from_arrays(json.loads(str(arrays["forest_data"])), node_arrays, chunk_rows=chunk_rows)
+
+    def feature_array(self, features):
+        """
+        :param features: table with the feature names the forest was trained with, or an array in the training order
+        :return: float32 array of the features in the training order
+        """
+        if self.feature_names_in_ is not None and hasattr(features, "columns"):
+            features = features[self.feature_names_in_]
+        features = np.asarray(features, dtype=np.float32)
+        if features.ndim != 2 or features.shape[1] != self.n_features_in_:
+            raise ValueError(f"Expected {self.n_features_in_} features, got an array with shape {features.shape}")
+        return features
+
+    def apply(self, features):
+        """
+        :param features: float32 array of the features, see feature_array
+        :return: array with per row and per tree the number of the leaf the row ends up in
+        """
+        n_rows, n_features = features.shape
+        flat_features = features.ravel()
+        row_starts = np.arange(n_rows) * n_features
+        has_missing_values = np.isnan(flat_features).any()
+
+        leaves = np.empty((n_rows, self.n_trees), dtype=np.int64)
+        for tree_index, root in enumerate(self.roots):
+            nodes = np.full(n_rows, root, dtype=np.int64)
+            # the rows that are not in a leaf yet and the node they are in
+            active_rows = np.arange(n_rows) if self.children_left[root] != TREE_LEAF else np.arange(0)
+            active_nodes = nodes[active_rows]
+            while active_rows.size:
+                values = flat_features.take(row_starts.take(active_rows) + self.feature.take(active_nodes))
+                go_left = values <= self.threshold.take(active_nodes)
+                if has_missing_values:
+                    missing_values = np.isnan(values)
+                    if missing_values.any():
+                        go_left[missing_values] = self.missing_go_to_left.take(active_nodes[missing_values])
+                next_nodes = np.where(go_left, self.children_left.take(active_nodes),
+                                      self.children_right.take(active_nodes))
+                nodes[active_rows] = next_nodes
+                not_in_leaf = self.children_left.take(next_nodes) != TREE_LEAF
+                active_rows = active_rows[not_in_leaf]
+                active_nodes = next_nodes[not_in_leaf]
+            leaves[:, tree_index] = nodes
+        return leaves
+
+    def predict(self, features):
+        """
+        :param features: table or array with the features the forest was trained with
+        :return: the predictions, with the shape of RandomForestRegressor.predict
+        """
+        features = self.feature_array(features)
+        predictions = np.zeros((features.shape[0], self.n_outputs_), dtype=np.float64)
+        for start in range(0, features.shape[0], self.chunk_rows):
+            leaf_values = self.value[self.apply(features[start:start + self.chunk_rows])]
+            chunk_predictions = predictions[start:start + self.chunk_rows]
+            for tree_index in range(self.n_trees):
+                chunk_predictions += leaf_values[:, tree_index]
+        predictions /= self.n_trees
+
+        if self.n_outputs_ == 1:
+            return predictions[:, 0]
+        return predictions
+
+
+if __name__ == "__main__":
+    # exports every pickled model of the models folder next to it
+    for file_name in sorted(os.listdir("models")):
+        if file_name.endswith(".pkl"):
+            print("Exporting model: ", file_name)
+            export_model_file(os.path.join("models", file_name))
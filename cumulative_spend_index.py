@@ -0,0 +1,79 @@
+from sorted_window_index import SortedWindowIndex
+
+
+class CumulativeSpendIndex:
+    """
+    Prefix-sum index over a purchases table that answers "how much was spent up to this date" for a whole events
+    table at once. It is built once per purchases table and can be shared by the process_client_add_total_spend_*
+    methods of a Client and by the notebooks.
+
+    The spend on a product is keyed by (USER_CLIENT_NUMBER, PROPOSITION). The spend on a category is keyed by
+    ARTICLE_CATEGORIE and sums the purchases of every proposition that was bought in that category, like
+    Client.total_amount_spend_on_category_product always did.
+    """
+
+    def __init__(self, purchases_table, category_key_columns=("ARTICLE_CATEGORIE",), date_column="DATE",
+                 amount_column="AMOUNT"):
+        """
+        :param purchases_table: the purchases table with the USER_CLIENT_NUMBER, PROPOSITION, DATE and AMOUNT columns
+        :param category_key_columns: the columns the category spend is keyed by. The default sums over the whole
+        purchases table of one client. Add USER_CLIENT_NUMBER to use one index for the purchases of all clients
+        :param date_column: the column with the date of the purchase
+        :param amount_column: the column with the amount spend on the purchase
+        """
+        self.category_key_columns = list(category_key_columns)
+        self.product_spend_index = SortedWindowIndex(purchases_table,
+                                                     key_columns=("USER_CLIENT_NUMBER", "PROPOSITION"),
+                                                     date_column=date_column,
+                                                     value_column=amount_column)
+
+        self.category_spend_index = None
+        if "ARTICLE_CATEGORIE" in purchases_table.columns:
+            self.category_spend_index = SortedWindowIndex(
+                self.purchases_per_category(purchases_table),
+                key_columns=self.category_key_columns,
+                date_column=date_column,
+                value_column=amount_column)
+
+    def purchases_per_category(self, purchases_table):
+        """
+        Pairs every purchase with each category its proposition was bought in, so the rows of one category are the
+        purchases of all the propositions bought in that category
+        :param purchases_table: the purchases table
+        :return: table with a row per (purchase, category) pair
+        """
+        proposition_key_columns = [column for column in self.category_key_columns if column != "ARTICLE_CATEGORIE"]
+        proposition_key_columns.append("PROPOSITION")
+
+        categories_of_proposition = purchases_table[
+            proposition_key_columns + ["ARTICLE_CATEGORIE"]
+        ].dropna(subset=["ARTICLE_CATEGORIE"]).drop_duplicates()
+
+        return purchases_table.drop(columns=["ARTICLE_CATEGORIE"]).merge(categories_of_proposition,
+                                                                         on=proposition_key_columns)
+
+    def spend_on_product(self, events_table):
+        """
+        Total amount spend by the client on the proposition of each event up to and including the event date
+        :param events_table: table with the USER_CLIENT_NUMBER, PROPOSITION and DATE columns
+        :return: numpy array with the total spend per event row
+        """
+        return self.product_spend_index.sum_until(events_table)
+
+    def spend_on_category_product(self, events_table):
+        """
+        Total amount spend on the propositions in the category of each event up to and including the event date
+        :param events_table: table with the ARTICLE_CATEGORIE and DATE columns (and USER_CLIENT_NUMBER when the
+        index is keyed by it)
+        :return: numpy array with the total spend per event row
+        """
+        if self.category_spend_index is None:
+            raise KeyError("ARTICLE_CATEGORIE")
+        return self.category_spend_index.sum_until(events_table)
+
+    def has_categories(self):
+        """
+        :return: True if the purchases table had an ARTICLE_CATEGORIE column to index
+        """
+        return self.category_spend_index is not None
+
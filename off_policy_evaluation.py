@@ -0,0 +1,712 @@
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+from process_client_tree import available_processes
+from rewardRandomForest import RewardPredictor
+from shared_tables import SharedArrays, attach_arrays
+from table_storage import get_table_storage_for_file
+from weather_features import WeatherFeatureStore
+
+# a slot is a (PROPOSITION, PAGE_SECTION_POSITION) pair, it is stored as one int64 key
+POSITION_KEY_SIZE = 1 << 20
+
+# the columns of the logged impressions that the evaluation needs next to the features of the reward model
+IMPRESSION_COLUMNS = ["USER_SESSION_ID", "PROPOSITION", "PAGE_SECTION_POSITION"]
+
+# the reward predictor, logging model, examination model and policies of a worker process, they are set once per
+# process by init_off_policy_worker
+worker_reward_predictor = None
+worker_logging_model = None
+worker_examination_model = None
+worker_policies = None
+
+
+def slot_keys(propositions, positions):
+    """
+    :param propositions: the proposition ids
+    :param positions: the PAGE_SECTION_POSITION of every proposition
+    :return: int64 array with the key of every (proposition, position) slot
+    """
+    return np.asarray(propositions, dtype=np.int64) * POSITION_KEY_SIZE + np.asarray(positions, dtype=np.int64)
+
+
+class LoggingPropensityModel:
+    """
+    Estimate of the logging policy, the ranking that produced the impressions in processed_events.csv. The events
+    have no logged propensities, so the model counts how often every proposition was shown at every
+    PAGE_SECTION_POSITION. The propensity that the logger showed a proposition at a position in a session comes from
+    the counts of all propositions of the session at all of its positions, see SessionSlots.logging_propensities.
+    """
+
+    def __init__(self, keys=None, counts=None, smoothing=1.0):
+        """
+        :param keys: sorted slot keys, see slot_keys
+        :param counts: the number of impressions of every slot
+        :param smoothing: added to every count, so propositions that were never logged at a position keep a small
+        propensity
+        """
+        self.keys = np.asarray(keys if keys is not None else [], dtype=np.int64)
+        self.counts = np.asarray(counts if counts is not None else [], dtype=np.float64)
+        self.smoothing = smoothing
+
+    def shared_arrays(self):
+        """
+        :return: dict with the arrays of the model, to put in shared memory with shared_tables.SharedArrays
+        """
+        return {"keys": self.keys, "counts": self.counts, "smoothing": np.array(self.smoothing)}
+
+    @classmethod
+    def from_shared_arrays(cls, arrays):
+        """
+        :param arrays: dict returned by shared_arrays, attached with shared_tables.attach_arrays
+        :return: LoggingPropensityModel on the shared arrays, they are not copied
+        """
+        return cls(keys=arrays["keys"], counts=arrays["counts"], smoothing=float(arrays["smoothing"]))
+
+    @classmethod
+    def build_from_file(cls, events_path, chunk_size=1_000_000, smoothing=1.0):
+        """
+        counts the impressions of an events file, which is read in chunks with only the two columns that are needed
+        :param events_path: path of the events, csv or parquet
+        :return: LoggingPropensityModel
+        """
+        logging_model = cls(smoothing=smoothing)
+        for chunk in get_table_storage_for_file(events_path).read_chunks(
+                events_path, chunk_size=chunk_size, columns=["PROPOSITION", "PAGE_SECTION_POSITION"]):
+            logging_model.add_events(chunk)
+        return logging_model
+
+    def add_events(self, events_table):
+        """
+        adds the impressions of the events to the counts
+        :param events_table: events with the PROPOSITION and PAGE_SECTION_POSITION columns
+        :return: the model
+        """
+        impressions = events_table[["PROPOSITION", "PAGE_SECTION_POSITION"]].dropna()
+        keys, counts = np.unique(slot_keys(impressions["PROPOSITION"], impressions["PAGE_SECTION_POSITION"]),
+                                 return_counts=True)
+        self.keys, key_positions = np.unique(np.concatenate((self.keys, keys)), return_inverse=True)
+        self.counts = np.bincount(key_positions, weights=np.concatenate((self.counts, counts)),
+                                  minlength=len(self.keys))
+        return self
+
+    def counts_of(self, propositions, positions):
+        """
+        :return: the smoothed number of impressions of every (proposition, position) slot
+        """
+        keys = slot_keys(propositions, positions)
+        if len(self.keys) == 0:
+            return np.full(len(keys), self.smoothing)
+        key_positions = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        found = self.keys.take(key_positions) == keys
+        return np.where(found, self.counts.take(key_positions), 0) + self.smoothing
+
+
+class PositionExaminationModel:
+    """
+    The reward rate of every PAGE_SECTION_POSITION in the logged impressions, relative to the reward rate of all
+    impressions. The reward model has no position feature, so its prediction is the reward of a proposition at an
+    average position, and the examination rate of a position scales it to the reward at that position. Without it
+    the direct method gives every ranking of the same candidates the same value.
+    """
+
+    def __init__(self, reward_column="purchases_7_day_after", binary_reward=True, smoothing=100.0):
+        """
+        :param reward_column: the column with the logged reward
+        :param binary_reward: if True the reward is 1 when the reward column is above 0
+        :param smoothing: the number of impressions at the overall reward rate that are added to every position, so
+        positions with few impressions get a rate close to 1
+        """
+        self.reward_column = reward_column
+        self.binary_reward = binary_reward
+        self.smoothing = smoothing
+        self.positions = np.zeros(0, dtype=np.int64)
+        self.impressions = np.zeros(0, dtype=np.float64)
+        self.reward_sums = np.zeros(0, dtype=np.float64)
+
+    def add_events(self, events_table):
+        """
+        adds the impressions and rewards of the events to the sums per position
+        :param events_table: events with the PAGE_SECTION_POSITION and reward column
+        :return: the model
+        """
+        events_table = events_table.dropna(subset=["PAGE_SECTION_POSITION"])
+        rewards = events_table[self.reward_column].to_numpy(dtype=np.float64, na_value=0)
+        if self.binary_reward:
+            rewards = (rewards > 0).astype(np.float64)
+        positions = events_table["PAGE_SECTION_POSITION"].to_numpy(dtype=np.int64)
+        known_positions = len(self.positions)
+        self.positions, position_codes = np.unique(np.concatenate((self.positions, positions)), return_inverse=True)
+        old_codes, new_codes = position_codes[:known_positions], position_codes[known_positions:]
+        self.impressions = (np.bincount(old_codes, weights=self.impressions, minlength=len(self.positions))
+                            + np.bincount(new_codes, minlength=len(self.positions)))
+        self.reward_sums = (np.bincount(old_codes, weights=self.reward_sums, minlength=len(self.positions))
+                            + np.bincount(new_codes, weights=rewards, minlength=len(self.positions)))
+        return self
+
+    def examination_rates(self, positions):
+        """
+        :param positions: PAGE_SECTION_POSITION values
+        :return: the smoothed reward rate of every position divided by the reward rate of all impressions, 1 for
+        positions that were never logged
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        impressions = self.impressions.sum()
+        if impressions == 0 or self.reward_sums.sum() == 0:
+            return np.ones(len(positions))
+        overall_rate = self.reward_sums.sum() / impressions
+        position_rates = (self.reward_sums + self.smoothing * overall_rate) / (self.impressions + self.smoothing)
+        found_positions = np.minimum(np.searchsorted(self.positions, positions), len(self.positions) - 1)
+        found = self.positions.take(found_positions) == positions
+        return np.where(found, position_rates.take(found_positions) / overall_rate, 1.0)
+
+
+class RankingPolicy:
+    """
+    A candidate ranking policy. It gives every proposition of a session a score and ranks the propositions of the
+    session on their score. With temperature 0 the ranking is deterministic, otherwise it is a Plackett-Luce
+    ranking: the propositions are drawn one position at a time with a probability of exp(score / temperature)
+    """
+
+    def __init__(self, name, temperature=0.0):
+        """
+        :param name: the name of the policy in the results
+        :param temperature: 0 for a deterministic ranking, higher temperatures rank more randomly
+        """
+        self.name = name
+        self.temperature = temperature
+
+    def scores(self, candidates, predicted_rewards):
+        """
+        :param candidates: table with one row per proposition of a session, the first impression of the proposition
+        :param predicted_rewards: the reward that the reward model predicts for every candidate
+        :return: array with the score of every candidate, higher is ranked first
+        """
+        raise NotImplementedError
+
+
+class LoggedRankingPolicy(RankingPolicy):
+    """
+    ranks the propositions on the position they were first logged at, a replay of the logged order. The logging
+    propensities are estimates, so only its SNIPS estimate is close to the mean logged reward. With reverse the
+    logged order is turned around, see check_direct_method_position
+    """
+
+    def __init__(self, name=None, temperature=0.0, reverse=False):
+        super().__init__(name or ("logged_reversed" if reverse else "logged"), temperature)
+        self.reverse = reverse
+
+    def scores(self, candidates, predicted_rewards):
+        positions = candidates["PAGE_SECTION_POSITION"].to_numpy(dtype=np.float64)
+        return positions if self.reverse else -positions
+
+
+class ColumnRankingPolicy(RankingPolicy):
+    """
+    ranks the propositions on a column of the events, for example total_spend_on_product or PRICE
+    """
+
+    def __init__(self, column, descending=True, name=None, temperature=0.0):
+        super().__init__(name or f"{column}_{'descending' if descending else 'ascending'}", temperature)
+        self.column = column
+        self.descending = descending
+
+    def scores(self, candidates, predicted_rewards):
+        values = candidates[self.column].to_numpy(dtype=np.float64, na_value=np.nan)
+        values = np.nan_to_num(values, nan=-np.inf if self.descending else np.inf)
+        return values if self.descending else -values
+
+
+class PredictedRewardRankingPolicy(RankingPolicy):
+    """
+    ranks the propositions on the reward that the reward model predicts
+    """
+
+    def __init__(self, name="predicted_reward", temperature=0.0):
+        super().__init__(name, temperature)
+
+    def scores(self, candidates, predicted_rewards):
+        return predicted_rewards
+
+
+class UniformRankingPolicy(RankingPolicy):
+    """
+    ranks the propositions of a session in a uniformly random order
+    """
+
+    def __init__(self, name="uniform"):
+        super().__init__(name, temperature=1.0)
+
+    def scores(self, candidates, predicted_rewards):
+        return np.zeros(len(candidates))
+
+
+class PolicyValueAccumulator:
+    """
+    Running sums of the per impression terms of the estimators of one policy. The sums of session partitions are
+    merged by adding them.
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.logged_reward_sum = 0.0
+        self.weight_sum = 0.0
+        self.squared_weight_sum = 0.0
+        self.ips_sum = 0.0
+        self.squared_ips_sum = 0.0
+        self.direct_method_sum = 0.0
+        self.doubly_robust_sum = 0.0
+        self.squared_doubly_robust_sum = 0.0
+
+    def add(self, rewards, weights, direct_method_values, doubly_robust_values):
+        """
+        :param rewards: the logged reward of every impression
+        :param weights: the importance weight of every impression
+        :param direct_method_values: the expected reward of the policy at the slot of every impression
+        :param doubly_robust_values: the doubly robust term of every impression
+        """
+        ips_values = weights * rewards
+        self.rows += len(rewards)
+        self.logged_reward_sum += float(rewards.sum())
+        self.weight_sum += float(weights.sum())
+        self.squared_weight_sum += float(np.square(weights).sum())
+        self.ips_sum += float(ips_values.sum())
+        self.squared_ips_sum += float(np.square(ips_values).sum())
+        self.direct_method_sum += float(direct_method_values.sum())
+        self.doubly_robust_sum += float(doubly_robust_values.sum())
+        self.squared_doubly_robust_sum += float(np.square(doubly_robust_values).sum())
+
+    def merge(self, other):
+        """
+        adds the sums of another accumulator
+        :return: the accumulator
+        """
+        for attribute, value in vars(other).items():
+            setattr(self, attribute, getattr(self, attribute) + value)
+        return self
+
+    def summary(self):
+        """
+        :return: dict with the IPS, SNIPS, direct method and doubly robust estimates of the mean reward per
+        impression, the standard errors of IPS and DR and the effective sample size of the weights
+        """
+        if self.rows == 0:
+            return {"rows": 0}
+
+        def standard_error(value_sum, squared_sum):
+            mean = value_sum / self.rows
+            return float(np.sqrt(max(squared_sum / self.rows - mean ** 2, 0) / self.rows))
+
+        return {
+            "rows": self.rows,
+            "logged_reward": self.logged_reward_sum / self.rows,
+            "ips": self.ips_sum / self.rows,
+            "ips_standard_error": standard_error(self.ips_sum, self.squared_ips_sum),
+            "snips": self.ips_sum / self.weight_sum if self.weight_sum else float("nan"),
+            "direct_method": self.direct_method_sum / self.rows,
+            "doubly_robust": self.doubly_robust_sum / self.rows,
+            "doubly_robust_standard_error": standard_error(self.doubly_robust_sum, self.squared_doubly_robust_sum),
+            "mean_weight": self.weight_sum / self.rows,
+            "effective_sample_size": (self.weight_sum ** 2 / self.squared_weight_sum
+                                      if self.squared_weight_sum else 0.0),
+        }
+
+
+class SessionSlots:
+    """
+    The impressions of a partition of sessions as arrays. The rows are grouped per session, every session has its
+    candidates (the distinct propositions it showed) in one contiguous block, so a ranking of all sessions is one
+    lexsort of the candidates.
+    """
+
+    def __init__(self, events_table):
+        """
+        :param events_table: the impressions of complete sessions, with the IMPRESSION_COLUMNS
+        """
+        events_table = events_table.dropna(subset=IMPRESSION_COLUMNS)
+        session_codes = pd.factorize(events_table["USER_SESSION_ID"])[0]
+        self.events = events_table.iloc[np.argsort(session_codes, kind="stable")]
+        self.row_sessions = np.sort(session_codes)
+        self.row_positions = self.events["PAGE_SECTION_POSITION"].to_numpy(dtype=np.int64)
+        self.row_propositions = self.events["PROPOSITION"].to_numpy(dtype=np.int64)
+
+        # the candidates are numbered in the order of their first impression, so the candidates of a session are
+        # next to each other
+        proposition_key_size = int(self.row_propositions.max()) + 1 if len(self.row_propositions) else 1
+        self.row_candidates = pd.factorize(self.row_sessions.astype(np.int64) * proposition_key_size
+                                           + self.row_propositions)[0]
+        first_rows = np.unique(self.row_candidates, return_index=True)[1]
+        self.candidates = self.events.iloc[first_rows]
+        self.candidate_sessions = self.row_sessions[first_rows]
+        self.candidate_propositions = self.row_propositions[first_rows]
+        n_sessions = int(self.row_sessions[-1]) + 1 if len(self.row_sessions) else 0
+        self.session_sizes = np.bincount(self.candidate_sessions, minlength=n_sessions)
+        self.session_starts = np.concatenate(([0], np.cumsum(self.session_sizes)[:-1])).astype(np.int64)
+        self.candidate_offsets = np.arange(len(self.candidate_sessions)) - self.session_starts[self.candidate_sessions]
+        largest_session = int(self.session_sizes.max()) if n_sessions else 0
+        self.padded_ranking = n_sessions * largest_session <= 4 * len(self.candidate_sessions)
+        self.padding_mask = np.arange(largest_session)[None, :] < self.session_sizes[:, None]
+
+    def __len__(self):
+        return len(self.row_candidates)
+
+    def logging_propensities(self, logging_model, sinkhorn_iterations=20):
+        """
+        :param logging_model: LoggingPropensityModel
+        :param sinkhorn_iterations: the number of times the propensities are scaled per slot and per candidate
+        :return: the propensity of every impression under the logging model
+        """
+        row_slots, slot_values = pd.factorize(self.row_sessions.astype(np.int64) * POSITION_KEY_SIZE
+                                              + self.row_positions)
+        slot_sessions = slot_values // POSITION_KEY_SIZE
+        slot_positions = slot_values % POSITION_KEY_SIZE
+        # every slot is paired with every candidate of its session
+        pair_counts = self.session_sizes[slot_sessions]
+        pair_slots = np.repeat(np.arange(len(slot_values)), pair_counts)
+        pair_offsets = np.arange(pair_counts.sum()) - np.repeat(np.cumsum(pair_counts) - pair_counts, pair_counts)
+        pair_candidates = self.session_starts[slot_sessions][pair_slots] + pair_offsets
+        pair_propensities = logging_model.counts_of(self.candidate_propositions[pair_candidates],
+                                                    slot_positions[pair_slots])
+
+        # the logger shows every candidate of a session at one of its positions, so the propensities are scaled to
+        # sum to 1 per slot and to the same share of the slots per candidate (Sinkhorn scaling)
+        slot_counts = np.bincount(slot_sessions, minlength=len(self.session_sizes))
+        candidate_share = (slot_counts / np.maximum(self.session_sizes, 1))[self.candidate_sessions[pair_candidates]]
+        for _ in range(sinkhorn_iterations):
+            pair_propensities /= np.bincount(pair_slots, weights=pair_propensities)[pair_slots]
+            pair_propensities *= candidate_share / np.bincount(
+                pair_candidates, weights=pair_propensities, minlength=len(self))[pair_candidates]
+        pair_propensities /= np.bincount(pair_slots, weights=pair_propensities)[pair_slots]
+
+        # the propensity of every impression is the propensity of the pair of its slot and its candidate
+        pair_positions = pd.Index(pair_slots * np.int64(len(self)) + pair_candidates)
+        return pair_propensities[pair_positions.get_indexer(row_slots * np.int64(len(self)) + self.row_candidates)]
+
+    def rank(self, scores):
+        """
+        :param scores: the score of every candidate
+        :return: tuple of the rank of every candidate in its session, 0 is the first position, and the candidates
+        in ranked order per session
+        """
+        if not self.padded_ranking:
+            ranking = np.lexsort((-scores, self.candidate_sessions))
+            ranks = np.empty(len(ranking), dtype=np.int64)
+            ranks[ranking] = np.arange(len(ranking)) - self.session_starts[self.candidate_sessions[ranking]]
+            return ranks, ranking
+
+        # the sessions are sorted as the rows of a matrix padded to the largest session, which is much faster than
+        # sorting all candidates at once. The padding sorts after the candidates of the session
+        padded_scores = np.full(self.padding_mask.shape, np.inf)
+        padded_scores[self.candidate_sessions, self.candidate_offsets] = -scores
+        padded_order = np.argsort(padded_scores, axis=1, kind="stable")
+        padded_ranks = np.empty_like(padded_order)
+        np.put_along_axis(padded_ranks, padded_order, np.arange(padded_order.shape[1])[None, :], axis=1)
+        ranking = (self.session_starts[:, None] + padded_order)[self.padding_mask]
+        return padded_ranks[self.candidate_sessions, self.candidate_offsets], ranking
+
+    def policy_terms(self, policy, predicted_rewards, examination_rates, n_samples, random_generator):
+        """
+        :param policy: RankingPolicy
+        :param predicted_rewards: the predicted reward of every candidate
+        :param examination_rates: the examination rate of the logged position of every impression, see
+        PositionExaminationModel
+        :param n_samples: the number of rankings that are drawn from a policy with a temperature
+        :param random_generator: numpy Generator of the draws
+        :return: tuple of the probability that the policy shows the logged proposition at the logged position of
+        every impression, and the expected reward of the proposition the policy shows at that position, its
+        predicted reward times the examination rate of the position
+        """
+        scores = np.asarray(policy.scores(self.candidates, predicted_rewards), dtype=np.float64)
+        n_samples = n_samples if policy.temperature > 0 else 1
+        logged_ranks = self.row_positions - 1
+        slot_in_session = (logged_ranks >= 0) & (logged_ranks < self.session_sizes[self.row_sessions])
+        ranked_positions = self.session_starts[self.row_sessions] + np.where(slot_in_session, logged_ranks, 0)
+
+        propensities = np.zeros(len(self))
+        expected_rewards = np.zeros(len(self))
+        for _ in range(n_samples):
+            sample_scores = scores
+            if policy.temperature > 0:
+                # adding Gumbel noise to the scores and sorting draws a Plackett-Luce ranking
+                sample_scores = scores / policy.temperature + random_generator.gumbel(size=len(scores))
+            ranks, ranking = self.rank(sample_scores)
+            propensities += ranks[self.row_candidates] == logged_ranks
+            expected_rewards += np.where(slot_in_session, predicted_rewards[ranking[ranked_positions]], 0)
+        return propensities / n_samples, examination_rates * expected_rewards / n_samples
+
+
+def session_partitions(chunks):
+    """
+    Cuts the chunks of an events table at session boundaries. The rows of the last session of a chunk are moved to
+    the next chunk, so every partition has complete sessions when the rows of a session are next to each other, like
+    in processed_events.csv where the events are written per client
+    :param chunks: iterator over the chunks of the events
+    :return: iterator over the partitions
+    """
+    remaining_rows = None
+    for chunk in chunks:
+        if remaining_rows is not None:
+            chunk = pd.concat([remaining_rows, chunk], ignore_index=True)
+        sessions = chunk["USER_SESSION_ID"].to_numpy()
+        other_sessions = np.flatnonzero(sessions != sessions[-1]) if len(sessions) else []
+        if len(other_sessions) == 0:
+            remaining_rows = chunk
+            continue
+        yield chunk.iloc[:other_sessions[-1] + 1]
+        remaining_rows = chunk.iloc[other_sessions[-1] + 1:]
+    if remaining_rows is not None and len(remaining_rows):
+        yield remaining_rows
+
+
+def init_off_policy_worker(model_location, weather_store_path, logging_model, examination_model, policies,
+                           shared_descriptors=None):
+    """
+    sets the reward predictor, the logging model, the examination model and the policies of the worker process
+    :param shared_descriptors: optional descriptors of arrays in shared memory, see OffPolicyEvaluator.shared_arrays.
+    The logging model, the weather store and the reward predictor that are in it are attached instead of loaded
+    """
+    global worker_reward_predictor, worker_logging_model, worker_examination_model, worker_policies
+    shared_arrays = attach_arrays(shared_descriptors or {})
+    if "reward_predictor" in shared_arrays:
+        worker_reward_predictor = RewardPredictor.from_shared_arrays(model_location, shared_arrays["reward_predictor"])
+    else:
+        weather_store = weather_store_path
+        if "weather" in shared_arrays:
+            weather_store = WeatherFeatureStore.from_shared_arrays(shared_arrays["weather"])
+        worker_reward_predictor = RewardPredictor(model_location, weather_store=weather_store)
+    worker_logging_model = logging_model
+    if "logging_model" in shared_arrays:
+        worker_logging_model = LoggingPropensityModel.from_shared_arrays(shared_arrays["logging_model"])
+    worker_examination_model = examination_model
+    worker_policies = policies
+
+
+def evaluate_sessions_task(task):
+    """
+    Evaluates all policies of the worker on a partition of sessions. The predicted rewards and the logging
+    propensities are computed once and shared by the policies
+    :param task: tuple of (events of complete sessions, reward column, binary reward, maximum weight, number of
+    ranking samples, seed)
+    :return: tuple of (number of impressions, dict with a PolicyValueAccumulator per policy name)
+    """
+    events_table, reward_column, binary_reward, max_weight, n_samples, seed = task
+    random_generator = np.random.default_rng(seed)
+    sessions = SessionSlots(events_table)
+    if len(sessions) == 0:
+        return 0, {policy.name: PolicyValueAccumulator() for policy in worker_policies}
+
+    rewards = sessions.events[reward_column].to_numpy(dtype=np.float64, na_value=0)
+    if binary_reward:
+        rewards = (rewards > 0).astype(np.float64)
+    predicted_rewards = np.asarray(worker_reward_predictor.predict_reward(
+        worker_reward_predictor.preprocessing_data(sessions.candidates)), dtype=np.float64)
+    examination_rates = worker_examination_model.examination_rates(sessions.row_positions)
+    # the direct method model of the logged slot, the prediction of the logged proposition at the logged position
+    logged_predicted_rewards = examination_rates * predicted_rewards[sessions.row_candidates]
+    logging_propensities = sessions.logging_propensities(worker_logging_model)
+
+    accumulators = {}
+    for policy in worker_policies:
+        propensities, direct_method_values = sessions.policy_terms(policy, predicted_rewards, examination_rates,
+                                                                   n_samples, random_generator)
+        weights = np.minimum(propensities / logging_propensities, max_weight)
+        accumulator = PolicyValueAccumulator()
+        accumulator.add(rewards, weights, direct_method_values,
+                        direct_method_values + weights * (rewards - logged_predicted_rewards))
+        accumulators[policy.name] = accumulator
+    return len(sessions), accumulators
+
+
+class OffPolicyEvaluator:
+    """
+    Off-policy evaluation of candidate ranking policies on the logged impressions of processed_events.csv, instead
+    of summing the predictions for the precomputed benchmark files.
+
+    Every impression is a slot: in its session the logger showed a proposition at a PAGE_SECTION_POSITION. A policy
+    ranks the propositions of the session, and the estimators reweight the logged rewards with the probability that
+    the policy shows the logged proposition at the logged position divided by the logging propensity (IPS, and the
+    self normalized SNIPS). The direct method takes the reward that the RewardPredictor predicts for the proposition
+    the policy shows at the slot, times the examination rate of the position of the slot (PositionExaminationModel),
+    and the doubly robust estimate corrects it with the weighted prediction error of the logged proposition. The
+    estimates are mean rewards per impression.
+
+    The events are read once, cut into partitions of complete sessions that are evaluated in worker processes, and
+    all policies are evaluated on a partition at once.
+    """
+
+    def __init__(self, policies, events_path="processed_data/processed_events_final.csv",
+                 model_location="models/reward_predictor_model_weather_0.pkl", weather_store_path=None,
+                 chunk_size=200_000, reward_column="purchases_7_day_after", binary_reward=True, max_weight=100.0,
+                 n_samples=32, logging_model=None, examination_model=None, seed=0, share_model=False):
+        """
+        :param policies: list of RankingPolicy, the names must be unique
+        :param events_path: the logged events, csv or parquet, with the rows of a session next to each other
+        :param model_location: the reward model of the direct method, a pickle or an exported .forest folder
+        :param weather_store_path: optional path of a saved WeatherFeatureStore, for events without weather columns
+        :param chunk_size: the number of rows that are read at once
+        :param reward_column: the column with the logged reward
+        :param binary_reward: if True the reward is 1 when the reward column is above 0, like the target of the
+        reward model
+        :param max_weight: the importance weights are clipped at this value
+        :param n_samples: the number of rankings that are drawn per session from policies with a temperature
+        :param logging_model: LoggingPropensityModel, by default it is built from the events
+        :param examination_model: PositionExaminationModel, by default it is built from the events
+        :param seed: seed of the ranking draws, every partition gets its own stream
+        :param share_model: if True the reward model is loaded once and put in shared memory as a CompactForest, so
+        the memory of the model does not grow with the number of workers. The rewards are the same, but a
+        CompactForest predicts slower than the scikit-learn forest. The logging model and the weather store are always
+        shared
+        """
+        policy_names = [policy.name for policy in policies]
+        if len(set(policy_names)) != len(policy_names):
+            raise ValueError(f"The names of the policies are not unique: {policy_names}")
+        self.policies = policies
+        self.events_path = events_path
+        self.model_location = model_location
+        self.weather_store_path = weather_store_path
+        self.chunk_size = chunk_size
+        self.reward_column = reward_column
+        self.binary_reward = binary_reward
+        self.max_weight = max_weight
+        self.n_samples = n_samples
+        self.logging_model = logging_model
+        self.examination_model = examination_model
+        self.seed = seed
+        self.share_model = share_model
+
+    def shared_arrays(self):
+        """
+        The read-only tables that the workers attach to instead of each getting a copy: the logging model, the
+        weather store and with share_model the reward predictor, which has the weather store in it
+        :return: dict of arrays for shared_tables.SharedArrays.share
+        """
+        arrays = {"logging_model": self.logging_model.shared_arrays()}
+        if self.share_model:
+            arrays["reward_predictor"] = RewardPredictor(self.model_location,
+                                                         weather_store=self.weather_store_path).shared_arrays()
+        elif self.weather_store_path is not None:
+            arrays["weather"] = WeatherFeatureStore.load(self.weather_store_path).shared_arrays()
+        return arrays
+
+    def partitions(self):
+        """
+        :return: iterator over the partitions of complete sessions of the events
+        """
+        return session_partitions(get_table_storage_for_file(self.events_path).read_chunks(
+            self.events_path, chunk_size=self.chunk_size))
+
+    def evaluate(self, processes=None, max_partitions_in_flight=None):
+        """
+        :param processes: number of worker processes, by default the available cores. With 1 process the partitions
+        are evaluated without a pool
+        :param max_partitions_in_flight: the maximum number of partitions that are read but not evaluated yet, by
+        default two per process
+        :return: dict per policy name with the estimates, see PolicyValueAccumulator.summary
+        """
+        start_time = time.perf_counter()
+        if self.logging_model is None or self.examination_model is None:
+            self.count_logged_impressions()
+
+        accumulators = {policy.name: PolicyValueAccumulator() for policy in self.policies}
+        rows = 0
+        if processes == 1:
+            init_off_policy_worker(self.model_location, self.weather_store_path, self.logging_model,
+                                   self.examination_model, self.policies)
+            for partition_number, partition in enumerate(self.partitions()):
+                rows += self.add_partition_result(evaluate_sessions_task(self.partition_task(partition,
+                                                                                             partition_number)),
+                                                  accumulators)
+        else:
+            processes = processes or available_processes()
+            max_partitions_in_flight = max_partitions_in_flight or 2 * processes
+            with SharedArrays() as shared_arrays:
+                # the workers get the tables from the shared memory instead of a copy in the initializer arguments
+                worker_arguments = (self.model_location, None, None, self.examination_model, self.policies,
+                                    shared_arrays.share(self.shared_arrays()))
+                with Pool(processes=processes, initializer=init_off_policy_worker, initargs=worker_arguments) as pool:
+                    in_flight = []
+                    for partition_number, partition in enumerate(self.partitions()):
+                        in_flight.append(pool.apply_async(evaluate_sessions_task,
+                                                          (self.partition_task(partition, partition_number),)))
+                        # the reading waits for the oldest partition, so only max_partitions_in_flight are in memory
+                        while len(in_flight) >= max_partitions_in_flight:
+                            rows += self.add_partition_result(in_flight.pop(0).get(), accumulators)
+                    while in_flight:
+                        rows += self.add_partition_result(in_flight.pop(0).get(), accumulators)
+
+        print(f"Evaluated {len(self.policies)} policies on {rows} impressions in "
+              f"{time.perf_counter() - start_time:.2f}s")
+        return {name: accumulator.summary() for name, accumulator in accumulators.items()}
+
+    def count_logged_impressions(self):
+        """
+        builds the logging model and the examination model that were not given in one pass over the events, only
+        the columns they need are read
+        :return:
+        """
+        print("Counting the logged impressions of", self.events_path)
+        logging_model = self.logging_model or LoggingPropensityModel()
+        examination_model = self.examination_model or PositionExaminationModel(self.reward_column,
+                                                                               self.binary_reward)
+        for chunk in get_table_storage_for_file(self.events_path).read_chunks(
+                self.events_path, chunk_size=1_000_000,
+                columns=["PROPOSITION", "PAGE_SECTION_POSITION", self.reward_column]):
+            if self.logging_model is None:
+                logging_model.add_events(chunk)
+            if self.examination_model is None:
+                examination_model.add_events(chunk)
+        self.logging_model = logging_model
+        self.examination_model = examination_model
+
+    def partition_task(self, partition, partition_number):
+        """
+        :return: the evaluate_sessions_task task of a partition
+        """
+        return (partition, self.reward_column, self.binary_reward, self.max_weight, self.n_samples,
+                [self.seed, partition_number])
+
+    @staticmethod
+    def add_partition_result(partition_result, accumulators):
+        """
+        adds the accumulators of a partition to the accumulators of all partitions
+        :return: the number of impressions of the partition
+        """
+        partition_rows, partition_accumulators = partition_result
+        for name, accumulator in partition_accumulators.items():
+            accumulators[name].merge(accumulator)
+        return partition_rows
+
+
+def check_direct_method_position(evaluation_results, logged_name="logged", reversed_name="logged_reversed"):
+    """
+    Checks that the direct method depends on the positions the policy shows the propositions at: the logged order
+    and the same order reversed show the same propositions, so their direct method estimates only differ through the
+    examination rates of the positions
+    :param evaluation_results: the result of OffPolicyEvaluator.evaluate with a LoggedRankingPolicy and a reversed one
+    :return: dict with the direct method estimate of both policies and if they differ
+    """
+    logged_value = evaluation_results[logged_name]["direct_method"]
+    reversed_value = evaluation_results[reversed_name]["direct_method"]
+    return {"logged_direct_method": logged_value, "reversed_direct_method": reversed_value,
+            "passed": not np.isclose(logged_value, reversed_value, rtol=1e-9, atol=0)}
+
+
+if __name__ == "__main__":
+    # compares the logged ranking with rankings on the reward model and the spend features
+    candidate_policies = [
+        LoggedRankingPolicy(),
+        LoggedRankingPolicy(reverse=True),
+        UniformRankingPolicy(),
+        PredictedRewardRankingPolicy(),
+        PredictedRewardRankingPolicy(name="predicted_reward_soft", temperature=0.05),
+        ColumnRankingPolicy("total_spend_on_product"),
+        ColumnRankingPolicy("total_spend_on_category_product"),
+        ColumnRankingPolicy("PRICE", descending=False),
+    ]
+    evaluation_results = OffPolicyEvaluator(candidate_policies).evaluate()
+    print(pd.DataFrame(evaluation_results).T.to_string())
+    if not check_direct_method_position(evaluation_results)["passed"]:
+        print("The direct method gives the logged order and its reverse the same value")
@@ -0,0 +1,445 @@
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import sklearn
+
+from client_partitioner import ClientPartitioner
+from compact_forest import compact_forest_path_for_model
+from off_policy_evaluation import LoggedRankingPolicy, OffPolicyEvaluator, check_direct_method_position
+from Process_Client_add_events_to_purchases import Process_clients
+from process_client_tree import Client, ProcessClientsFolderTree, available_processes
+from process_clients_columnar import ProcessClientsColumnar
+from reward_model_training import ChunkedRewardModelTrainer
+from rewardRandomForest import RewardPredictor
+from synthetic_data import SyntheticDataGenerator
+from table_storage import get_table_storage
+
+DEFAULT_SCALES = (1_000, 10_000, 100_000)
+DEFAULT_BASELINE_PATH = "benchmark_results/performance_baseline.json"
+# a case regresses when its rows per second are more than this share below the baseline
+DEFAULT_REGRESSION_THRESHOLD = 0.25
+# the client tree has a folder per client, above this many events only the cases without the tree are run
+DEFAULT_CLIENT_TREE_MAX_ROWS = 1_000_000
+# the small forest the inference cases score with, it is trained once per run on MODEL_TRAINING_ROWS events, so the
+# model is the same for every choice of scales
+MODEL_TRAINING_ROWS = 20_000
+BENCHMARK_FOREST_PARAMETERS = {"max_depth": 12, "min_samples_leaf": 3, "max_features": "sqrt", "bootstrap": False}
+# the share of the latest purchases that the refresh check appends after the first run
+REFRESH_CHECK_APPENDED_SHARE = 0.2
+
+
+class BenchmarkData:
+    """
+    The synthetic tables of one scale, in the forms the benchmarked code reads them: the events and purchases
+    files, the tables in memory and the client folder tree
+    """
+
+    def __init__(self, folder, n_events, storage="csv", seed=0, client_tree=True):
+        """
+        :param folder: the folder the files of this scale are written to
+        :param n_events: the number of event rows
+        :param storage: the table storage of the files and the client tree, csv or parquet
+        :param seed: the seed of the SyntheticDataGenerator
+        :param client_tree: if True, the client folder tree is written
+        """
+        self.folder = folder
+        self.storage = storage
+        self.generator = SyntheticDataGenerator(n_events=n_events, seed=seed)
+        self.events_path, self.purchases_path = self.generator.write(folder, storage=storage)
+        self.events, self.purchases = self.generator.tables()
+        self.processed_events_table = None
+        self.client_path = None
+        if client_tree:
+            self.client_path = os.path.join(folder, "client_data")
+            ClientPartitioner(self.client_path, storage=storage).partition(self.events, self.purchases, processes=1)
+
+    def client_ids(self):
+        return ProcessClientsFolderTree(self.client_path, storage=self.storage).clientid_list
+
+    def load_clients(self):
+        return [Client(client_id, client_folder_path=self.client_path, storage=self.storage)
+                for client_id in self.client_ids()]
+
+    def processed_events(self):
+        """
+        :return: the events with the purchases and total spend columns, like processed_events_final.csv
+        """
+        if self.processed_events_table is None:
+            process_clients = ProcessClientsColumnar(self.events_path, self.purchases_path)
+            self.processed_events_table = process_clients.process_clients(
+                add_purchases=True, add_total_product_spend=True, add_total_category_product_spend=True)
+        return self.processed_events_table
+
+
+class PerformanceBenchmark:
+    """
+    Times the feature methods of Client, the processing of the client tree, the in memory and columnar processing,
+    the aggregation of the client tree and the inference of the reward model on synthetic data of several scales.
+
+    Every case is run repeats times and the fastest run counts, as rows per second. The results are written as json
+    and compared with a baseline of an earlier run: a case regresses when its rows per second dropped more than the
+    threshold. The baseline should come from the same machine, the throughput of different machines can not be
+    compared.
+    """
+
+    def __init__(self, scales=DEFAULT_SCALES, cases=None, repeats=3, processes=1, storage="csv", seed=0,
+                 work_folder=None, client_tree_max_rows=DEFAULT_CLIENT_TREE_MAX_ROWS, check_refresh=True,
+                 check_off_policy=True):
+        """
+        :param scales: the numbers of event rows to benchmark
+        :param cases: the names of the cases to run, by default all of CASES
+        :param repeats: the number of runs per case, the fastest counts
+        :param processes: the number of worker processes of the cases that use a pool
+        :param storage: the table storage of the files, csv or parquet
+        :param seed: the seed of the synthetic data and the model
+        :param work_folder: the folder for the synthetic data, by default a temporary folder that is removed after
+        the run
+        :param client_tree_max_rows: the largest scale the client tree cases are run for
+        :param check_refresh: if True, every scale with a client tree also checks that an incremental refresh gives
+        the same client tables as a full recompute, see check_incremental_refresh. Only csv files can be appended to
+        :param check_off_policy: if True, the events the model is trained on also check that the direct method of
+        the off-policy evaluation depends on the positions, see check_off_policy_direct_method
+        """
+        unknown_cases = set(cases or []) - set(self.CASES)
+        if unknown_cases:
+            raise ValueError(f"Unknown benchmark cases {sorted(unknown_cases)}, choose from {list(self.CASES)}")
+        self.scales = sorted(int(scale) for scale in scales)
+        self.cases = list(cases or self.CASES)
+        self.repeats = repeats
+        self.processes = processes
+        self.storage = storage
+        self.seed = seed
+        self.work_folder = work_folder
+        self.client_tree_max_rows = client_tree_max_rows
+        self.check_refresh = check_refresh
+        self.check_off_policy = check_off_policy
+        self.model_location = None
+        self.training_events_path = None
+
+    def run(self):
+        """
+        runs all cases at all scales
+        :return: dict with the environment and a result per case and scale
+        """
+        work_folder = self.work_folder or tempfile.mkdtemp(prefix="performance_benchmark_")
+        results = []
+        checks = []
+        try:
+            for scale in self.scales:
+                client_tree = scale <= self.client_tree_max_rows
+                print(f"Generating {scale} events")
+                data = BenchmarkData(os.path.join(work_folder, f"events_{scale}"), scale, storage=self.storage,
+                                     seed=self.seed, client_tree=client_tree)
+                if self.model_location is None and {"reward_inference", "compact_forest_inference"} & set(self.cases):
+                    self.model_location = self.train_model(os.path.join(work_folder, "models"))
+                    if self.check_off_policy:
+                        check = check_off_policy_direct_method(self.training_events_path, self.model_location)
+                        checks.append(check)
+                        print(f"Direct method of the logged order {check['logged_direct_method']:.6f}, reversed "
+                              f"{check['reversed_direct_method']:.6f}")
+
+                for case in self.cases:
+                    setup, needs_client_tree = self.CASES[case]
+                    if needs_client_tree and not client_tree:
+                        continue
+                    result = self.time_case(case, setup, data)
+                    result["scale"] = scale
+                    results.append(result)
+                    print(f"{case} at {scale} events: {result['rows']} rows in {result['seconds']:.3f}s, "
+                          f"{result['rows_per_second']:.0f} rows/s")
+                if client_tree and self.check_refresh and self.storage == "csv":
+                    check = check_incremental_refresh(data, processes=self.processes)
+                    check["scale"] = scale
+                    checks.append(check)
+                    print(f"Incremental refresh at {scale} events: {len(check['mismatched_clients'])} of "
+                          f"{check['refreshed_clients']} refreshed clients differ from a full recompute")
+        finally:
+            if self.work_folder is None:
+                shutil.rmtree(work_folder, ignore_errors=True)
+        return {"environment": self.environment(), "results": results, "checks": checks}
+
+    def time_case(self, case, setup, data):
+        """
+        :param case: the name of the case
+        :param setup: the setup function of the case, it returns the function to time and the number of rows it
+        handles
+        :param data: the BenchmarkData of the scale
+        :return: dict with the rows and the seconds of the fastest of the repeats
+        """
+        run_case, rows = setup(self, data)
+        seconds = []
+        for _ in range(self.repeats):
+            gc.collect()
+            start_time = time.perf_counter()
+            run_case()
+            seconds.append(time.perf_counter() - start_time)
+        best_seconds = min(seconds)
+        return {"case": case, "rows": int(rows), "seconds": best_seconds,
+                "rows_per_second": rows / best_seconds if best_seconds > 0 else float("inf")}
+
+    def environment(self):
+        return {
+            "created": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "sklearn": sklearn.__version__,
+            "machine": platform.machine(),
+            "available_processes": available_processes(),
+            "processes": self.processes,
+            "repeats": self.repeats,
+            "storage": self.storage,
+            "seed": self.seed,
+        }
+
+    def train_model(self, models_folder):
+        """
+        trains a small reward forest on processed synthetic events, the inference cases score with it
+        :return: the location of the model
+        """
+        data = BenchmarkData(os.path.join(models_folder, "training_events"), MODEL_TRAINING_ROWS,
+                             storage=self.storage, seed=self.seed, client_tree=False)
+        processed_path = os.path.join(data.folder, "processed_events_final" + get_table_storage(self.storage).extension)
+        get_table_storage(self.storage).write(data.processed_events(), processed_path)
+        self.training_events_path = processed_path
+
+        trainer = ChunkedRewardModelTrainer(processed_path, chunk_size=max(len(data.processed_events()), 1),
+                                            trees_per_chunk=20, forest_parameters=BENCHMARK_FOREST_PARAMETERS,
+                                            seed=self.seed)
+        return trainer.save(trainer.train(processes=1), models_folder=models_folder, version=0, export_compact=True)
+
+    def setup_client_read(self, data):
+        client_ids = data.client_ids()
+        return (lambda: [Client(client_id, client_folder_path=data.client_path, storage=data.storage)
+                         for client_id in client_ids]), len(data.events)
+
+    def setup_client_purchases_after(self, data):
+        clients = data.load_clients()
+        return (lambda: [client.process_client_add_purchase_nr_to_event_write_to_csv()
+                         for client in clients]), len(data.events)
+
+    def setup_client_total_spend_on_product(self, data):
+        clients = data.load_clients()
+
+        def run_case():
+            for client in clients:
+                client.spend_index = None
+                client.process_client_add_total_spend_on_product()
+        return run_case, len(data.events)
+
+    def setup_client_total_spend_on_category_product(self, data):
+        clients = data.load_clients()
+
+        def run_case():
+            for client in clients:
+                client.spend_index = None
+                client.process_client_add_total_spend_on_category_product()
+        return run_case, len(data.events)
+
+    def setup_client_write(self, data):
+        clients = data.load_clients()
+        return (lambda: [client.write_tables_to_csv() for client in clients]), len(data.events)
+
+    def setup_folder_tree_processing(self, data):
+        process_clients = ProcessClientsFolderTree(data.client_path, storage=data.storage)
+        return (lambda: process_clients.process_client_purchases_to_event_multiprocessing(
+            add_purchases=True, add_total_product_spend=True, add_total_category_product_spend=True,
+            processes=self.processes)), len(data.events)
+
+    def setup_aggregation(self, data):
+        process_clients = ProcessClientsFolderTree(data.client_path, storage=data.storage)
+        output_path = os.path.join(data.folder, "aggregated_events" + get_table_storage(data.storage).extension)
+        return (lambda: process_clients.aggregate_clients_streaming(
+            table_name="events", file_name_to_write=output_path, processes=self.processes)), len(data.events)
+
+    def setup_exposure_counts(self, data):
+        process_clients = Process_clients(data.purchases, data.events)
+        return (lambda: process_clients.process_client_chunks(processes=self.processes)), len(data.purchases)
+
+    def setup_columnar_processing(self, data):
+        def run_case():
+            ProcessClientsColumnar(data.events_path, data.purchases_path).process_clients(
+                add_purchases=True, add_total_product_spend=True, add_total_category_product_spend=True)
+        return run_case, len(data.events)
+
+    def setup_reward_inference(self, data):
+        reward_predictor = RewardPredictor(self.model_location)
+        events = data.processed_events()
+        return (lambda: reward_predictor.predict_reward(reward_predictor.preprocessing_data(events))), len(events)
+
+    def setup_compact_forest_inference(self, data):
+        reward_predictor = RewardPredictor(compact_forest_path_for_model(self.model_location))
+        events = data.processed_events()
+        return (lambda: reward_predictor.predict_reward(reward_predictor.preprocessing_data(events))), len(events)
+
+    # the setup function of every case and if the case needs the client folder tree
+    CASES = {
+        "client_read": (setup_client_read, True),
+        "client_purchases_after": (setup_client_purchases_after, True),
+        "client_total_spend_on_product": (setup_client_total_spend_on_product, True),
+        "client_total_spend_on_category_product": (setup_client_total_spend_on_category_product, True),
+        "client_write": (setup_client_write, True),
+        "folder_tree_processing": (setup_folder_tree_processing, True),
+        "aggregation": (setup_aggregation, True),
+        "exposure_counts": (setup_exposure_counts, False),
+        "columnar_processing": (setup_columnar_processing, False),
+        "reward_inference": (setup_reward_inference, False),
+        "compact_forest_inference": (setup_compact_forest_inference, False),
+    }
+
+
+def check_incremental_refresh(data, processes=1, appended_share=REFRESH_CHECK_APPENDED_SHARE):
+    """
+    Checks that process_client_purchases_to_event_incremental gives the same events as a full recompute when
+    purchases are appended. A copy of the client tree gets the purchases without the latest appended_share of them
+    and is processed, then the held back purchases are appended to the purchases files and the copy is refreshed.
+    A second copy with all purchases is processed completely, and the events of every client are compared
+    :param data: BenchmarkData with a csv client tree
+    :param processes: the number of worker processes
+    :param appended_share: the share of the latest purchases that is appended
+    :return: dict with the number of clients that got appended purchases and the ids of the clients whose events
+    differ by more than the rounding of the sums
+    """
+    feature_flags = {"add_purchases": True, "add_total_product_spend": True, "add_total_category_product_spend": True}
+    refreshed_path = os.path.join(data.folder, "refresh_check", "refreshed")
+    recomputed_path = os.path.join(data.folder, "refresh_check", "recomputed")
+    for path in (refreshed_path, recomputed_path):
+        shutil.rmtree(path, ignore_errors=True)
+        shutil.copytree(data.client_path, path)
+
+    cutoff_date = pd.to_datetime(data.purchases["DATE"]).quantile(1 - appended_share)
+    appended_purchases = {}
+    for client in ProcessClientsFolderTree(refreshed_path, storage="csv").clientid_list:
+        client = Client(client, client_folder_path=refreshed_path)
+        appended_rows = pd.to_datetime(client.client_purchases_table["DATE"]) >= cutoff_date
+        if appended_rows.any():
+            appended_purchases[client.client_id] = client.client_purchases_table[appended_rows]
+            client.write_table(client.client_purchases_table[~appended_rows], client.client_purchases_table_path)
+
+    refreshed_tree = ProcessClientsFolderTree(refreshed_path, storage="csv")
+    refreshed_tree.process_client_purchases_to_event_incremental(processes=processes, **feature_flags)
+    for client_id, purchases in appended_purchases.items():
+        purchases_path = refreshed_tree.client_table_path(client_id, "purchases")
+        columns = pd.read_csv(purchases_path, sep="|", nrows=0).columns
+        purchases[columns].to_csv(purchases_path, sep="|", mode="a", header=False, index=False)
+    refreshed_tree.process_client_purchases_to_event_incremental(processes=processes, **feature_flags)
+    ProcessClientsFolderTree(recomputed_path, storage="csv").process_client_purchases_to_event_incremental(
+        processes=processes, **feature_flags)
+
+    mismatched_clients = []
+    for client_id in appended_purchases:
+        refreshed_events = Client(client_id, client_folder_path=refreshed_path).client_events_table
+        recomputed_events = Client(client_id, client_folder_path=recomputed_path).client_events_table
+        try:
+            # the appended purchases are summed in another order, so the spend columns may differ in the last digits
+            pd.testing.assert_frame_equal(refreshed_events, recomputed_events, check_exact=False, rtol=1e-9)
+        except AssertionError:
+            mismatched_clients.append(client_id)
+    return {"check": "incremental_refresh", "passed": not mismatched_clients,
+            "refreshed_clients": len(appended_purchases), "mismatched_clients": mismatched_clients}
+
+
+def check_off_policy_direct_method(events_path, model_location):
+    """
+    Checks that the direct method of the off-policy evaluation gives the logged order and its reverse different
+    values, see off_policy_evaluation.check_direct_method_position
+    :param events_path: processed events with sessions
+    :param model_location: the reward model
+    :return: dict with the direct method estimates of both orders
+    """
+    policies = [LoggedRankingPolicy(), LoggedRankingPolicy(reverse=True)]
+    evaluation_results = OffPolicyEvaluator(policies, events_path=events_path, model_location=model_location,
+                                            seed=0).evaluate(processes=1)
+    return {"check": "direct_method_position", **check_direct_method_position(evaluation_results)}
+
+
+def compare_with_baseline(report, baseline, threshold=DEFAULT_REGRESSION_THRESHOLD):
+    """
+    :param report: the result of PerformanceBenchmark.run
+    :param baseline: an earlier result of PerformanceBenchmark.run
+    :param threshold: the share of the baseline rows per second a case may lose
+    :return: list with a dict per case and scale that regressed, with the baseline and current rows per second
+    """
+    baseline_results = {(result["case"], result["scale"]): result for result in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        baseline_result = baseline_results.get((result["case"], result["scale"]))
+        if baseline_result is None:
+            continue
+        change = result["rows_per_second"] / baseline_result["rows_per_second"] - 1
+        result["change_from_baseline"] = change
+        if change < -threshold:
+            regressions.append({"case": result["case"], "scale": result["scale"],
+                                "baseline_rows_per_second": baseline_result["rows_per_second"],
+                                "rows_per_second": result["rows_per_second"], "change": change})
+    return regressions
+
+
+def write_report(report, results_folder="benchmark_results"):
+    """
+    writes the report as performance_<date and time>.json in the results folder
+    :return: the path of the report
+    """
+    os.makedirs(results_folder, exist_ok=True)
+    path = os.path.join(results_folder, f"performance_{datetime.datetime.now():%Y%m%d_%H%M%S}.json")
+    with open(path, "w") as report_file:
+        json.dump(report, report_file, indent=2)
+    return path
+
+
+if __name__ == "__main__":
+    # python performance_benchmark.py --scales 1000 100000 1000000
+    # exits with 1 when a case is slower than the baseline by more than the threshold. Run it with
+    # --update-baseline on the machine the checks run on to record the baseline first
+    parser = argparse.ArgumentParser(description="Benchmarks the throughput of the processing and inference code")
+    parser.add_argument("--scales", type=int, nargs="+", default=list(DEFAULT_SCALES))
+    parser.add_argument("--cases", nargs="+", default=None, choices=list(PerformanceBenchmark.CASES))
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--storage", default="csv", choices=["csv", "parquet"])
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_PATH)
+    parser.add_argument("--threshold", type=float, default=DEFAULT_REGRESSION_THRESHOLD)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--skip-refresh-check", action="store_true")
+    parser.add_argument("--skip-off-policy-check", action="store_true")
+    arguments = parser.parse_args()
+
+    benchmark = PerformanceBenchmark(scales=arguments.scales, cases=arguments.cases, repeats=arguments.repeats,
+                                     processes=arguments.processes, storage=arguments.storage,
+                                     check_refresh=not arguments.skip_refresh_check,
+                                     check_off_policy=not arguments.skip_off_policy_check)
+    benchmark_report = benchmark.run()
+
+    regressions = []
+    if os.path.exists(arguments.baseline) and not arguments.update_baseline:
+        with open(arguments.baseline) as baseline_file:
+            regressions = compare_with_baseline(benchmark_report, json.load(baseline_file), arguments.threshold)
+    print("Written the results to", write_report(benchmark_report))
+
+    if arguments.update_baseline:
+        os.makedirs(os.path.dirname(arguments.baseline) or ".", exist_ok=True)
+        with open(arguments.baseline, "w") as baseline_file:
+            json.dump(benchmark_report, baseline_file, indent=2)
+        print("Updated the baseline", arguments.baseline)
+    for regression in regressions:
+        print(f"Regression in {regression['case']} at {regression['scale']} events: "
+              f"{regression['baseline_rows_per_second']:.0f} -> {regression['rows_per_second']:.0f} rows/s "
+              f"({regression['change']:.0%})")
+    failed_checks = [check for check in benchmark_report["checks"] if not check["passed"]]
+    for check in failed_checks:
+        if check["check"] == "incremental_refresh":
+            print(f"The incremental refresh at {check['scale']} events differs from a full recompute for the "
+                  f"clients {check['mismatched_clients']}")
+        else:
+            print("The direct method gives the logged order and its reverse the same value")
+    sys.exit(1 if regressions or failed_checks else 0)
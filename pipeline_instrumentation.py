@@ -0,0 +1,398 @@
+import cProfile
+import csv
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+
+try:
+    import resource
+except ImportError:
+    # windows has no resource module, the peak memory is not reported there
+    resource = None
+
+# the environment variables of the profiling hook, they are inherited by the pool workers so a run can be profiled
+# without changing code
+PROFILE_TASKS_VARIABLE = "PIPELINE_PROFILE"
+PROFILER_VARIABLE = "PIPELINE_PROFILER"
+PROFILE_FOLDER_VARIABLE = "PIPELINE_PROFILE_FOLDER"
+PROFILE_SLOWER_THAN_VARIABLE = "PIPELINE_PROFILE_SLOWER_THAN"
+
+# seconds of cpu time between two samples of the sampling profiler
+SAMPLING_INTERVAL = 0.005
+
+# the stage timings of the task that is measured in this process, None when no task is measured
+current_stage_timings = None
+# the thread that runs the measured task, the stages of other threads, like the background reads of a ClientLoader,
+# do not belong to the task
+measured_thread = None
+# the profiler of this process, built from the environment the first time a task is measured
+worker_task_profiler = None
+
+
+def peak_rss_mb():
+    """
+    :return: the peak resident memory of this process in MB, None if the platform does not report it
+    """
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports the peak in kilobytes, macOS in bytes
+    return peak_rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+class StageTimings:
+    """
+    The number of calls, seconds and rows per stage of a task, for example read, purchases_after, write or predict
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, name, seconds, rows=0, calls=1):
+        stage = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0, "rows": 0})
+        stage["calls"] += calls
+        stage["seconds"] += seconds
+        stage["rows"] += rows
+
+    def merge(self, stages):
+        """
+        :param stages: dict with the stages of another task, see to_dict
+        """
+        for name, stage in stages.items():
+            self.add(name, stage["seconds"], stage["rows"], stage["calls"])
+        return self
+
+    def to_dict(self):
+        return {name: dict(stage) for name, stage in self.stages.items()}
+
+
+class TimedStage:
+    """
+    Times a stage of the task that is measured in this process. Outside of a TaskMeasurement, and in other threads
+    than the one of the measured task, nothing is recorded, so the stages cost nothing when the code is used on its
+    own
+
+        with timed_stage("read") as stage:
+            table = storage.read(path)
+            stage.rows = len(table)
+    """
+
+    def __init__(self, name, rows=0):
+        self.name = name
+        self.rows = rows
+        self.start_time = None
+
+    def __enter__(self):
+        if current_stage_timings is not None and threading.get_ident() == measured_thread:
+            self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.start_time is not None and current_stage_timings is not None:
+            current_stage_timings.add(self.name, time.perf_counter() - self.start_time, self.rows)
+        return False
+
+
+def timed_stage(name, rows=0):
+    """
+    :param name: the name of the stage
+    :param rows: the number of rows the stage handles, can also be set on the stage inside the with block
+    :return: TimedStage context manager
+    """
+    return TimedStage(name, rows)
+
+
+class SamplingProfiler:
+    """
+    Records the call stack every SAMPLING_INTERVAL seconds of cpu time with a SIGPROF timer. It slows the task down
+    much less than cProfile. The samples are written as folded stacks, which flamegraph.pl and speedscope read.
+    Only works in the main thread of a process on unix, which is where the pool workers run their tasks
+    """
+
+    def __init__(self, interval=SAMPLING_INTERVAL):
+        self.interval = interval
+        self.samples = Counter()
+
+    def sample(self, signal_number, frame):
+        stack = []
+        while frame is not None:
+            stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+            frame = frame.f_back
+        self.samples[";".join(reversed(stack))] += 1
+
+    def enable(self):
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def disable(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def dump_stats(self, path):
+        with open(path, "w") as folded_file:
+            for stack, count in self.samples.most_common():
+                folded_file.write(f"{stack} {count}\n")
+
+
+class TaskProfiler:
+    """
+    Optional profiling of single tasks, for example the clients of process_client_tree.py. It is configured with
+    environment variables, which the pool workers inherit:
+    PIPELINE_PROFILE: all, or the comma separated ids of the tasks to profile
+    PIPELINE_PROFILER: cprofile (default), written as <task id>.prof for pstats or snakeviz, or sampling, written as
+    <task id>.folded
+    PIPELINE_PROFILE_SLOWER_THAN: only keep the profiles of the tasks that took more seconds than this, to find the
+    slow clients of a run
+    PIPELINE_PROFILE_FOLDER: the folder the profiles are written to, by default profiles
+    """
+
+    def __init__(self, task_ids=None, profiler="cprofile", folder="profiles", slower_than=0.0):
+        """
+        :param task_ids: "all", or a set of task ids as strings. None profiles nothing
+        :param profiler: cprofile or sampling
+        :param folder: the folder the profiles are written to
+        :param slower_than: only the profiles of the tasks that took longer than this many seconds are kept
+        """
+        if profiler not in ("cprofile", "sampling"):
+            raise ValueError(f"Unknown profiler {profiler}, use cprofile or sampling")
+        if profiler == "sampling" and not hasattr(signal, "setitimer"):
+            print("The sampling profiler needs signal.setitimer, which this platform does not have, using cprofile")
+            profiler = "cprofile"
+        self.task_ids = task_ids
+        self.profiler = profiler
+        self.folder = folder
+        self.slower_than = slower_than
+
+    @classmethod
+    def from_environment(cls):
+        """
+        :return: TaskProfiler configured with the PIPELINE_PROFILE environment variables
+        """
+        task_ids = os.environ.get(PROFILE_TASKS_VARIABLE, "").strip()
+        if task_ids and task_ids != "all":
+            task_ids = {task_id.strip() for task_id in task_ids.split(",") if task_id.strip()}
+        return cls(task_ids=task_ids or None,
+                   profiler=os.environ.get(PROFILER_VARIABLE, "cprofile"),
+                   folder=os.environ.get(PROFILE_FOLDER_VARIABLE, "profiles"),
+                   slower_than=float(os.environ.get(PROFILE_SLOWER_THAN_VARIABLE, 0.0)))
+
+    def profiles(self, task_id):
+        return self.task_ids == "all" or (self.task_ids is not None and str(task_id) in self.task_ids)
+
+    def start(self, task_id):
+        """
+        :return: the running profiler of the task, None if the task is not profiled
+        """
+        if not self.profiles(task_id):
+            return None
+        profiler = cProfile.Profile() if self.profiler == "cprofile" else SamplingProfiler()
+        profiler.enable()
+        return profiler
+
+    def stop(self, profiler, task_id, wall_seconds):
+        """
+        :return: the path of the written profile, None if it is not kept
+        """
+        if profiler is None:
+            return None
+        profiler.disable()
+        if wall_seconds < self.slower_than:
+            return None
+        os.makedirs(self.folder, exist_ok=True)
+        extension = ".prof" if self.profiler == "cprofile" else ".folded"
+        file_name = "".join(character if character.isalnum() or character in "-_." else "_"
+                            for character in str(task_id))
+        path = os.path.join(self.folder, f"{file_name}{extension}")
+        profiler.dump_stats(path)
+        return path
+
+
+def get_task_profiler():
+    """
+    :return: the TaskProfiler of this process, read from the environment once
+    """
+    global worker_task_profiler
+    if worker_task_profiler is None:
+        worker_task_profiler = TaskProfiler.from_environment()
+    return worker_task_profiler
+
+
+class TaskMeasurement:
+    """
+    Measures one task, for example one client, in the process that runs it. The timed stages inside the with block
+    are collected, and afterwards metrics holds a dict with the wall time, the rows, the stages, the process id and
+    the peak memory of the process, small enough to send back from a pool worker
+
+        with TaskMeasurement(client_id) as measurement:
+            client = process_client(client_id)
+            measurement.rows = len(client.client_events_table)
+        return client_id, measurement.metrics
+    """
+
+    def __init__(self, task_id, rows=0):
+        self.task_id = task_id
+        self.rows = rows
+        self.stage_timings = StageTimings()
+        self.previous_stage_timings = None
+        self.previous_measured_thread = None
+        self.profiler = None
+        self.start_time = None
+        self.wall_seconds = None
+        self.metrics = None
+
+    def __enter__(self):
+        global current_stage_timings, measured_thread
+        self.previous_stage_timings = current_stage_timings
+        self.previous_measured_thread = measured_thread
+        current_stage_timings = self.stage_timings
+        measured_thread = threading.get_ident()
+        self.profiler = get_task_profiler().start(self.task_id)
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global current_stage_timings, measured_thread
+        self.wall_seconds = time.perf_counter() - self.start_time
+        profile_path = get_task_profiler().stop(self.profiler, self.task_id, self.wall_seconds)
+        current_stage_timings = self.previous_stage_timings
+        measured_thread = self.previous_measured_thread
+        self.metrics = {
+            "task_id": str(self.task_id),
+            "pid": os.getpid(),
+            "wall_seconds": self.wall_seconds,
+            "rows": int(self.rows),
+            "peak_rss_mb": peak_rss_mb(),
+            "stages": self.stage_timings.to_dict(),
+            "profile": profile_path,
+        }
+        return False
+
+
+def rate(count, seconds):
+    return count / seconds if seconds > 0 else 0.0
+
+
+class RunReport:
+    """
+    Collects the metrics of the measured tasks of a run, also the ones that come back from the pool workers, and
+    summarizes them per worker process and per stage
+    """
+
+    def __init__(self, name):
+        """
+        :param name: the name of the run, for example the function that runs it
+        """
+        self.name = name
+        self.start_time = time.perf_counter()
+        self.tasks = []
+
+    def add(self, metrics):
+        """
+        :param metrics: the metrics of a TaskMeasurement
+        """
+        self.tasks.append(metrics)
+
+    def wall_seconds(self):
+        return time.perf_counter() - self.start_time
+
+    def progress(self, total=None):
+        """
+        :param total: the number of tasks of the run
+        :return: a line with the number of finished tasks and the rates
+        """
+        wall_seconds = self.wall_seconds()
+        rows = sum(task["rows"] for task in self.tasks)
+        finished = f"{len(self.tasks)}/{total}" if total is not None else f"{len(self.tasks)}"
+        return (f"{self.name}: {finished} tasks in {wall_seconds:.1f}s, "
+                f"{rate(len(self.tasks), wall_seconds):.2f} tasks/s, {rate(rows, wall_seconds):.0f} rows/s")
+
+    def workers(self):
+        """
+        :return: list with the number of tasks, rows, busy seconds, rates and peak memory per worker process
+        """
+        workers = {}
+        for task in self.tasks:
+            worker = workers.setdefault(task["pid"], {"pid": task["pid"], "tasks": 0, "rows": 0,
+                                                      "busy_seconds": 0.0, "peak_rss_mb": None})
+            worker["tasks"] += 1
+            worker["rows"] += task["rows"]
+            worker["busy_seconds"] += task["wall_seconds"]
+            if task["peak_rss_mb"] is not None:
+                worker["peak_rss_mb"] = max(worker["peak_rss_mb"] or 0.0, task["peak_rss_mb"])
+        for worker in workers.values():
+            worker["tasks_per_second"] = rate(worker["tasks"], worker["busy_seconds"])
+            worker["rows_per_second"] = rate(worker["rows"], worker["busy_seconds"])
+        return sorted(workers.values(), key=lambda worker: worker["pid"])
+
+    def stages(self):
+        """
+        :return: dict with the calls, seconds, rows, rows per second and share of the busy time per stage, the
+        slowest stage first
+        """
+        stage_timings = StageTimings()
+        for task in self.tasks:
+            stage_timings.merge(task["stages"])
+        busy_seconds = sum(task["wall_seconds"] for task in self.tasks)
+        stages = stage_timings.to_dict()
+        for stage in stages.values():
+            stage["rows_per_second"] = rate(stage["rows"], stage["seconds"])
+            stage["share_of_busy_time"] = rate(stage["seconds"], busy_seconds)
+        return dict(sorted(stages.items(), key=lambda item: item[1]["seconds"], reverse=True))
+
+    def summary(self, slowest=10):
+        """
+        :param slowest: the number of slowest tasks to list
+        :return: dict with the totals, the rates, the workers, the stages and the slowest tasks of the run
+        """
+        wall_seconds = self.wall_seconds()
+        rows = sum(task["rows"] for task in self.tasks)
+        slowest_tasks = sorted(self.tasks, key=lambda task: task["wall_seconds"], reverse=True)[:slowest]
+        return {
+            "name": self.name,
+            "wall_seconds": wall_seconds,
+            "tasks": len(self.tasks),
+            "rows": rows,
+            "tasks_per_second": rate(len(self.tasks), wall_seconds),
+            "rows_per_second": rate(rows, wall_seconds),
+            "main_peak_rss_mb": peak_rss_mb(),
+            "workers": self.workers(),
+            "stages": self.stages(),
+            "slowest_tasks": [{"task_id": task["task_id"], "wall_seconds": task["wall_seconds"],
+                               "rows": task["rows"], "profile": task["profile"]} for task in slowest_tasks],
+        }
+
+    def print_summary(self, slowest=5):
+        summary = self.summary(slowest)
+        print(self.progress())
+        for name, stage in summary["stages"].items():
+            print(f"  {name}: {stage['seconds']:.2f}s ({stage['share_of_busy_time']:.0%}), "
+                  f"{stage['rows_per_second']:.0f} rows/s")
+        print("  slowest tasks:", [(task["task_id"], round(task["wall_seconds"], 2))
+                                   for task in summary["slowest_tasks"]])
+
+    def write(self, path):
+        """
+        writes the summary as json to path, and a row per task with the seconds per stage as csv next to it
+        :param path: the json file, for example reports/process_clients.json
+        :return: the summary
+        """
+        summary = self.summary()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as report_file:
+            json.dump(summary, report_file, indent=2)
+
+        stage_names = sorted({name for task in self.tasks for name in task["stages"]})
+        with open(os.path.splitext(path)[0] + ".tasks.csv", "w", newline="") as tasks_file:
+            writer = csv.writer(tasks_file)
+            writer.writerow(["task_id", "pid", "wall_seconds", "rows", "peak_rss_mb", "profile"]
+                            + [f"{name}_seconds" for name in stage_names])
+            for task in self.tasks:
+                writer.writerow([task["task_id"], task["pid"], task["wall_seconds"], task["rows"],
+                                 task["peak_rss_mb"], task["profile"]]
+                                + [task["stages"].get(name, {}).get("seconds", 0.0) for name in stage_names])
+        return summary
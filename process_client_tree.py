@@ -1,43 +1,199 @@
+import asyncio
+import collections
 import datetime
+import functools
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
 import random
 import multiprocessing
+import shutil
+
+from client_manifest import (ClientManifest, FEATURE_PURCHASES, PURCHASES_APPENDED, PURCHASES_REWRITTEN,
+                             appended_new_category_pairs, features_from_flags, file_unchanged,
+                             first_appended_purchase_date, flags_from_features, purchases_change)
+from cumulative_spend_index import CumulativeSpendIndex
+from pipeline_instrumentation import RunReport, TaskMeasurement, timed_stage
+from proposition_category_index import PropositionCategoryIndex
+from shared_tables import SharedArrays, attach_arrays
+from sorted_window_index import SortedWindowIndex, count_in_windows, window_label
+from streaming_aggregation import chunk_part_path, get_part_merger, write_part
+from table_storage import (HIVE_PARTITION_COLUMN, client_table_layout, client_table_path, get_table_storage,
+                           get_table_storage_for_path, list_client_ids, partition_value)
+
+# the number of clients a ClientLoader reads ahead of the client that is processed
+DEFAULT_READ_AHEAD = 4
+
+# the PropositionCategoryIndex of a worker process, it is attached to the shared memory once per process by
+# init_category_worker
+worker_category_index = None
 
 
 class Client:
     def __init__(self, client_id,
-                 client_folder_path: str = "client_data"):
+                 client_folder_path: str = "client_data",
+                 storage="csv", read_tables=True):
+        """
+        :param client_id: the id of the client, the name of the folder of the client
+        :param client_folder_path: the folder with a folder per client, or with the Hive-style partitioned tables
+        written by client_partitioner.py
+        :param storage: the table storage backend of the client tables, csv or parquet
+        :param read_tables: if False the tables are not read yet and are None, ClientLoader reads them in the
+        background
+        """
         self.client_id = client_id
-        self.client_purchases_table_path = os.path.join(client_folder_path, self.client_id, "purchases.csv")
-        self.client_events_table_path = os.path.join(client_folder_path, self.client_id, "events.csv")
-
-        self.client_purchases_table = pd.read_csv(self.client_purchases_table_path, sep="|")
-        self.client_events_table = pd.read_csv(self.client_events_table_path, sep="|")
+        self.storage = get_table_storage(storage)
+        self.layout = client_table_layout(client_folder_path)
+        self.client_purchases_table_path = client_table_path(client_folder_path, self.client_id, "purchases",
+                                                             self.storage.extension, self.layout)
+        self.client_events_table_path = client_table_path(client_folder_path, self.client_id, "events",
+                                                          self.storage.extension, self.layout)
+
+        self.client_purchases_table = None
+        self.client_events_table = None
+        if read_tables:
+            self.client_purchases_table = self.read_table(self.client_purchases_table_path)
+            self.client_events_table = self.read_table(self.client_events_table_path)
+        self.spend_index = None
+        self.category_index = None
+
+    def read_table(self, path):
+        """
+        reads a table of the client. The partition files of the hive layout do not have the USER_CLIENT_NUMBER
+        column, it is added back from the client id
+        :param path: path of the table
+        :return: the table
+        """
+        with timed_stage("read") as stage:
+            table = self.storage.read(path)
+            if self.layout == "hive" and HIVE_PARTITION_COLUMN not in table.columns:
+                table.insert(0, HIVE_PARTITION_COLUMN, partition_value(self.client_id))
+            stage.rows = len(table)
+        return table
+
+    def write_table(self, table, path):
+        """
+        writes a table of the client, without the USER_CLIENT_NUMBER column in the hive layout
+        :param table: the table to write
+        :param path: path of the table
+        :return:
+        """
+        with timed_stage("write", rows=len(table)):
+            if self.layout == "hive":
+                table = table.drop(columns=[HIVE_PARTITION_COLUMN], errors="ignore")
+            self.storage.write(table, path)
 
-    def process_client_add_purchase_nr_to_event_write_to_csv(self):
+    def process_client_add_purchase_nr_to_event_write_to_csv(self, date_ranges=(7, 30), event_timestamp_column=None,
+                                                             purchase_timestamp_column=None):
         """
         This function will process the client and add the purchases_7_day_after and purchases_30_day_after columns
         to the events.csv file
+        The purchases are indexed once with a SortedWindowIndex, so every window is answered for all of the events
+        at once instead of scanning the purchases table for every event row
+        :param date_ranges: the number of days or the timedeltas to look after the event date. Every date range adds
+        a purchases_<date_range>_after column, for example purchases_7_day_after or purchases_2_hour_after
+        :param event_timestamp_column: the timestamp column of the events, for example TIMESTAMP_EVENT. Needed for the
+        timedelta date ranges, which are counted to the second instead of by day
+        :param purchase_timestamp_column: the timestamp column of the purchases, needed for the timedelta date ranges
         :return:
         """
-        self.client_events_table["purchases_7_day_after"] = 0
-        self.client_events_table["purchases_30_day_after"] = 0
+        purchase_counts = count_in_windows(self.client_purchases_table, self.client_events_table, date_ranges,
+                                           direction="after", timestamp_column=purchase_timestamp_column,
+                                           query_timestamp_column=event_timestamp_column)
 
-        for index, row in self.client_events_table.iterrows():
-            user_id = row["USER_CLIENT_NUMBER"]
-            date = row["DATE"]
-            proposition_id = row["PROPOSITION"]
-            # Replace these with your actual function to calculate events prior to purchase date
-            purchases_30_day_after = self.get_purchases_after_date(self.client_purchases_table, user_id, date,
-                                                                   proposition_id, date_range=30)
-            purchases_7_day_after = self.get_purchases_after_date(self.client_purchases_table, user_id, date,
-                                                                  proposition_id, date_range=7)
+        self.client_events_table = self.client_events_table.assign(**{
+            f"purchases_{window_label(date_range)}_after": counts for date_range, counts in purchase_counts.items()
+        })
 
-            self.client_events_table.loc[index, 'purchases_7_day_after'] = len(purchases_7_day_after)
-            self.client_events_table.loc[index, 'purchases_30_day_after'] = len(purchases_30_day_after)
+    def process_client_features(self, add_purchases=True, add_total_product_spend=False,
+                                add_total_category_product_spend=False, date_ranges=(7, 30),
+                                event_timestamp_column=None, purchase_timestamp_column=None):
+        """
+        This function will add the selected feature columns to the events table of the client
+        :param add_purchases: if True, it will add the purchases_7_day_after and purchases_30_day_after columns
+        :param add_total_product_spend: if True, it will add the total_spend_on_product column
+        :param add_total_category_product_spend: if True, it will add the total_spend_on_category_product column
+        :param date_ranges: the number of days or the timedeltas to look after the event date for the purchases
+        columns
+        :param event_timestamp_column: the timestamp column of the events for the timedelta date ranges, see
+        process_client_add_purchase_nr_to_event_write_to_csv
+        :param purchase_timestamp_column: the timestamp column of the purchases for the timedelta date ranges
+        :return:
+        """
+        event_rows = len(self.client_events_table)
+        if add_purchases:
+            with timed_stage("purchases_after", rows=event_rows):
+                self.process_client_add_purchase_nr_to_event_write_to_csv(
+                    date_ranges=date_ranges, event_timestamp_column=event_timestamp_column,
+                    purchase_timestamp_column=purchase_timestamp_column)
+
+        if add_total_product_spend:
+            with timed_stage("total_spend_on_product", rows=event_rows):
+                self.process_client_add_total_spend_on_product()
+
+        if add_total_category_product_spend:
+            with timed_stage("total_spend_on_category_product", rows=event_rows):
+                self.process_client_add_total_spend_on_category_product()
+
+    def refresh_features_since(self, since_date, add_purchases=True, add_total_product_spend=False,
+                               add_total_category_product_spend=False, date_ranges=(7, 30)):
+        """
+        This function will recompute the feature columns only for the events that purchases from since_date on can
+        change. The purchase counts change for events up to the largest date range before since_date, the total
+        spend columns only for events from since_date on. The feature columns have to be computed before
+        :param since_date: the date of the earliest new purchase
+        :param add_purchases: if True, it will refresh the purchases_<date_range>_day_after columns
+        :param add_total_product_spend: if True, it will refresh the total_spend_on_product column
+        :param add_total_category_product_spend: if True, it will refresh the total_spend_on_category_product column
+        :param date_ranges: the number of days to look after the event date for the purchases columns
+        :return: number of refreshed event rows
+        """
+        event_days = SortedWindowIndex.dates_to_days(self.client_events_table["DATE"])
+        since_day = np.datetime64(pd.Timestamp(since_date).date(), "D")
+        refreshed_rows = np.zeros(len(self.client_events_table), dtype=bool)
+
+        if add_purchases:
+            affected_rows = event_days >= since_day - max(date_ranges)
+            with timed_stage("purchases_after", rows=int(affected_rows.sum())):
+                purchase_counts = SortedWindowIndex(self.client_purchases_table).count_after(
+                    self.client_events_table[affected_rows], date_ranges=date_ranges)
+                for date_range, counts in purchase_counts.items():
+                    column = f"purchases_{window_label(date_range)}_after"
+                    # the count columns are int32 after table_schema.apply_schema, the counts are int64
+                    self.client_events_table.loc[affected_rows, column] = \
+                        counts.astype(self.client_events_table[column].dtype)
+            refreshed_rows |= affected_rows
+
+        affected_rows = event_days >= since_day
+        affected_events = self.client_events_table[affected_rows]
+        self.spend_index = None
+        if add_total_product_spend:
+            with timed_stage("total_spend_on_product", rows=len(affected_events)):
+                self.client_events_table.loc[affected_rows, "total_spend_on_product"] = \
+                    self.get_spend_index().spend_on_product(affected_events)
+            refreshed_rows |= affected_rows
+
+        if add_total_category_product_spend and self.get_spend_index().has_categories():
+            with timed_stage("total_spend_on_category_product", rows=len(affected_events)):
+                self.client_events_table.loc[affected_rows, "total_spend_on_category_product"] = \
+                    self.get_spend_index().spend_on_category_product(affected_events)
+            refreshed_rows |= affected_rows
+
+        return int(refreshed_rows.sum())
+
+    def get_spend_index(self):
+        """
+        This function will return the CumulativeSpendIndex of the purchases table of the client. The index is built
+        the first time it is needed and shared by the total spend functions
+        :return: CumulativeSpendIndex of the purchases table
+        """
+        if self.spend_index is None:
+            self.spend_index = CumulativeSpendIndex(self.client_purchases_table)
+        return self.spend_index
 
     def process_client_add_total_spend_on_product(self):
         """
@@ -45,15 +201,8 @@ class Client:
         Returns:
 
         """
-
-        for index, row in self.client_events_table.iterrows():
-            user_id = row["USER_CLIENT_NUMBER"]
-            date = row["DATE"]
-            proposition_id = row["PROPOSITION"]
-            # Replace these with your actual function to calculate events prior to purchase date
-
-            self.client_events_table.loc[index, 'total_spend_on_product'] = self.total_amount_spend_on_product(
-                proposition_id, date, user_id)
+        self.client_events_table["total_spend_on_product"] = self.get_spend_index().spend_on_product(
+            self.client_events_table)
 
     def total_amount_spend_on_product(self, proposition_id, date, user_id):
         """
@@ -63,33 +212,32 @@ class Client:
         :param user_id: the user id of the client
         :return: total amount spend on the product
         """
-        total_spend = 0
-        date = datetime.datetime.strptime(date, "%Y-%m-%d").date()
-        product_purchase_events = self.client_purchases_table[
-            (self.client_purchases_table["USER_CLIENT_NUMBER"] == user_id) &
-            (self.client_purchases_table["DATE"] <= str(date)) &
-            (self.client_purchases_table["PROPOSITION"] == proposition_id)
+        event = pd.DataFrame({"USER_CLIENT_NUMBER": [user_id], "DATE": [date], "PROPOSITION": [proposition_id]})
+        return self.get_spend_index().spend_on_product(event)[0]
 
-            ]
-        total_spend = product_purchase_events["AMOUNT"].sum()
-        return total_spend
-
-    def setup_product_category(self):
+    def setup_product_category(self, category_index=None):
         """
         this functions sets up the product category for the puchases table of each proposition id
+        :param category_index: the PropositionCategoryIndex of all events, built once with
+        proposition_category_index.py. Without it the index is built from the events of the client. The column is a
+        categorical on the codes of the index and is written with the category values, like the events have them
         Returns:
 
         """
-        self.client_purchases_table["ARTICLE_CATEGORIE"] = 0
-        for proposition_id in self.client_purchases_table["PROPOSITION"].unique():
-            product_category = self.get_product_category(proposition_id)
-            #print(product_category)
-            #print(self.client_purchases_table[self.client_purchases_table["PROPOSITION"]==proposition_id].to_html())
-
-            for index, row in self.client_purchases_table[self.client_purchases_table["PROPOSITION"]==proposition_id].iterrows():
-                row["ARTICLE_CATEGORIE"] = product_category
-
+        if category_index is not None:
+            self.category_index = category_index
+        self.client_purchases_table = self.get_category_index().apply(self.client_purchases_table)
+        self.spend_index = None
 
+    def get_category_index(self):
+        """
+        This function will return the PropositionCategoryIndex the product categories are looked up in, by default
+        the index of the events of the client
+        :return: PropositionCategoryIndex
+        """
+        if self.category_index is None:
+            self.category_index = PropositionCategoryIndex.build(self.client_events_table)
+        return self.category_index
 
     def get_product_category(self, proposition_id):
         """
@@ -97,15 +245,7 @@ class Client:
         :param proposition_id:
         :return: the product category of the proposition id
         """
-        all_product_rows_df = self.client_events_table[self.client_events_table["PROPOSITION"] == proposition_id]
-        try:
-
-            article_category = all_product_rows_df["ARTICLE_CATEGORIE"].values[0]
-
-        except IndexError:
-            article_category = np.nan
-
-        return article_category
+        return self.get_category_index().categories_of([proposition_id])[0]
 
     def process_client_add_total_spend_on_category_product(self):
         """
@@ -113,54 +253,37 @@ class Client:
         Returns:
 
         """
+        spend_index = self.get_spend_index()
+        if not spend_index.has_categories():
+            print("No product category found for client", self.client_id)
+            self.client_events_table["total_spend_on_category_product"] = 0.0
+            return
 
-        for index, row in self.client_events_table.iterrows():
-            user_id = row["USER_CLIENT_NUMBER"]
-            date = row["DATE"]
-            article_category = row["ARTICLE_CATEGORIE"]
-            # Replace these with your actual function to calculate events prior to purchase date
-
-            self.client_events_table.loc[
-                index, 'total_spend_on_category_product'] = self.total_amount_spend_on_category_product(
-                article_category, date)
+        self.client_events_table["total_spend_on_category_product"] = spend_index.spend_on_category_product(
+            self.client_events_table)
 
     def total_amount_spend_on_category_product(self, article_category, date):
         """
         This function will calculate the total amount spend on the product. before this date for the client
         :param article_category: the category of the product
         :param date: until this date the total amount spend on the product will be calculated
-        :param user_id: the user id of the client
         :return: total amount spend on the product
-        :TODO: remove the product_id_finder and make the file already have the product category
         """
-        total_spend = 0
-        date = datetime.datetime.strptime(date, "%Y-%m-%d").date()
-        try:
-            bought_product_id_in_category = self.client_purchases_table[
-                (self.client_purchases_table["ARTICLE_CATEGORIE"] == article_category)
-            ]["PROPOSITION"].unique()
-
-        except KeyError:
+        spend_index = self.get_spend_index()
+        if not spend_index.has_categories():
             print("No product category found for client", self.client_id)
             return 0
 
-        product_purchase_events = self.client_purchases_table[
-            (self.client_purchases_table["DATE"] <= str(date)) &
-            (self.client_purchases_table["PROPOSITION"].isin(bought_product_id_in_category))
-
-            ]
-        total_spend = product_purchase_events["AMOUNT"].sum()
-
-
-        return total_spend
+        event = pd.DataFrame({"ARTICLE_CATEGORIE": [article_category], "DATE": [date]})
+        return spend_index.spend_on_category_product(event)[0]
 
     def write_tables_to_csv(self):
         """
-        This function will write the tables to the csv
+        This function will write the tables to the csv, or to the format of the configured table storage
         :return:
         """
-        self.client_purchases_table.to_csv(self.client_purchases_table_path, sep="|", index=False)
-        self.client_events_table.to_csv(self.client_events_table_path, sep="|", index=False)
+        self.write_table(self.client_purchases_table, self.client_purchases_table_path)
+        self.write_table(self.client_events_table, self.client_events_table_path)
 
     @staticmethod
     def get_purchases_after_date(purchase_events, user_id, purchase_date, proposition_id, date_range=30,
@@ -204,9 +327,341 @@ class Client:
             return None
 
 
+class ClientLoader:
+    """
+    Iterates over the Clients of a list of client ids and reads the tables of the next clients while the current
+    client is processed, so on a slow (network) volume the processing does not wait for every read. The reads are
+    coroutines on an asyncio event loop in a background thread, the two tables of a client are read at the same time
+    in a thread pool and the clients come out in the order of the client ids. At most read_ahead clients are read
+    but not processed yet, so the memory stays bounded.
+
+    write_behind writes the tables of a processed client in the background in the same way, at most
+    max_pending_writes clients wait to be written. The end of the with block waits for all writes, and a read or
+    write that failed is raised in the thread that uses the loader.
+
+        with ClientLoader(client_ids, client_path) as client_loader:
+            for client in client_loader:
+                client.process_client_features()
+                client_loader.write_behind(client)
+
+    With read_ahead 0 the clients are read and written one by one, without the background thread.
+    """
+
+    def __init__(self, client_ids, client_path="client_data", storage="csv", read_ahead=DEFAULT_READ_AHEAD,
+                 max_pending_writes=None):
+        """
+        :param client_ids: the ids of the clients, in the order they are returned
+        :param client_path: the folder with the client tables
+        :param storage: the table storage backend of the client tables, csv or parquet
+        :param read_ahead: the number of clients that are read ahead of the client that is processed
+        :param max_pending_writes: the number of clients that can wait to be written, by default read_ahead
+        """
+        self.client_ids = list(client_ids)
+        self.client_path = client_path
+        self.storage = storage
+        self.read_ahead = read_ahead
+        self.max_pending_writes = max_pending_writes or max(read_ahead, 1)
+        self.next_client_position = 0
+        self.reads = collections.deque()
+        self.writes = collections.deque()
+        self.loop = None
+        self.loop_thread = None
+        self.executor = None
+        self.clients_read = 0
+        self.clients_written = 0
+        self.read_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.write_seconds = 0.0
+
+    def start(self):
+        """
+        starts the event loop in the background thread, it is started by the first read or write
+        :return: the loader
+        """
+        if self.read_ahead > 0 and self.loop is None:
+            # every client reads and writes its two tables at the same time
+            self.executor = ThreadPoolExecutor(max_workers=2 * (self.read_ahead + self.max_pending_writes))
+            self.loop = asyncio.new_event_loop()
+            self.loop_thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+            self.loop_thread.start()
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.read_ahead == 0:
+            if self.next_client_position >= len(self.client_ids):
+                raise StopIteration
+            client_id = self.client_ids[self.next_client_position]
+            self.next_client_position += 1
+            start_time = time.perf_counter()
+            client = Client(client_id, client_folder_path=self.client_path, storage=self.storage)
+            self.read_seconds += time.perf_counter() - start_time
+            self.wait_seconds += time.perf_counter() - start_time
+            self.clients_read += 1
+            return client
+
+        self.start()
+        self.schedule_reads()
+        if not self.reads:
+            self.close()
+            raise StopIteration
+        start_time = time.perf_counter()
+        try:
+            client, read_seconds = self.reads.popleft().result()
+        except Exception:
+            self.close()
+            raise
+        self.wait_seconds += time.perf_counter() - start_time
+        self.read_seconds += read_seconds
+        self.clients_read += 1
+        # the read of the next client starts before this client is processed
+        self.schedule_reads()
+        return client
+
+    def schedule_reads(self):
+        """
+        starts the reads of the next clients until read_ahead clients are being read or waiting
+        """
+        while len(self.reads) < self.read_ahead and self.next_client_position < len(self.client_ids):
+            client_id = self.client_ids[self.next_client_position]
+            self.next_client_position += 1
+            self.reads.append(asyncio.run_coroutine_threadsafe(self.read_client(client_id), self.loop))
+
+    async def read_client(self, client_id):
+        """
+        :return: tuple of (the Client with both tables read, seconds it took to read them)
+        """
+        loop = asyncio.get_running_loop()
+        start_time = time.perf_counter()
+        client = await loop.run_in_executor(self.executor, functools.partial(
+            Client, client_id, client_folder_path=self.client_path, storage=self.storage, read_tables=False))
+        client.client_purchases_table, client.client_events_table = await asyncio.gather(
+            loop.run_in_executor(self.executor, client.read_table, client.client_purchases_table_path),
+            loop.run_in_executor(self.executor, client.read_table, client.client_events_table_path))
+        return client, time.perf_counter() - start_time
+
+    def write_behind(self, client):
+        """
+        writes the tables of the client with write_tables_to_csv in the background. When max_pending_writes clients
+        are waiting to be written it first waits for the oldest write. The client should not be changed anymore
+        :param client: the processed client
+        :return:
+        """
+        self.start()
+        if self.loop is None:
+            start_time = time.perf_counter()
+            client.write_tables_to_csv()
+            self.write_seconds += time.perf_counter() - start_time
+            self.clients_written += 1
+            return
+        while len(self.writes) >= self.max_pending_writes:
+            self.writes.popleft().result()
+        self.writes.append(asyncio.run_coroutine_threadsafe(self.write_client(client), self.loop))
+
+    async def write_client(self, client):
+        loop = asyncio.get_running_loop()
+        start_time = time.perf_counter()
+        await loop.run_in_executor(self.executor, client.write_tables_to_csv)
+        self.write_seconds += time.perf_counter() - start_time
+        self.clients_written += 1
+
+    async def cancel_pending_reads(self):
+        """
+        cancels the reads of the clients that were not used, the reads that already run finish in the thread pool
+        """
+        pending_tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in pending_tasks:
+            task.cancel()
+        await asyncio.gather(*pending_tasks, return_exceptions=True)
+
+    def close(self):
+        """
+        waits for the writes that are still running and stops the background thread. The first write that failed is
+        raised after the loader is stopped
+        :return:
+        """
+        if self.loop is None:
+            return
+        write_error = None
+        while self.writes:
+            try:
+                self.writes.popleft().result()
+            except Exception as error:
+                write_error = write_error or error
+        self.reads.clear()
+        asyncio.run_coroutine_threadsafe(self.cancel_pending_reads(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
+        self.executor.shutdown(wait=True)
+        self.loop = None
+        if write_error is not None:
+            raise write_error
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def summary(self):
+        """
+        :return: text with the clients that were read and written, the seconds the reads and writes took and the
+        seconds the processing waited for a read
+        """
+        return (f"read {self.clients_read} clients in {self.read_seconds:.2f}s, waited {self.wait_seconds:.2f}s for "
+                f"the reads, wrote {self.clients_written} clients in {self.write_seconds:.2f}s")
+
+
+def process_client(client_id, client_path="client_data", storage="csv", add_purchases=True,
+                   add_total_product_spend=False, add_total_category_product_spend=False):
+    """
+    This function will process one client and write the tables of the client back to the client folder
+    :param client_id: the id of the client
+    :param client_path: the folder with a folder per client
+    :param storage: the table storage backend of the client tables, csv or parquet
+    :param add_purchases: if True, it will add the purchases_7_day_after and purchases_30_day_after columns
+    :param add_total_product_spend: if True, it will add the total_spend_on_product column
+    :param add_total_category_product_spend: if True, it will add the total_spend_on_category_product column
+    :return: the processed client
+    """
+    client = Client(client_id=client_id, client_folder_path=client_path, storage=storage)
+    client.process_client_features(add_purchases=add_purchases,
+                                   add_total_product_spend=add_total_product_spend,
+                                   add_total_category_product_spend=add_total_category_product_spend)
+    client.write_tables_to_csv()
+    return client
+
+
+def process_client_task(task):
+    """
+    Pool worker for one client. The task only holds the client id, the location of the client tree and the feature
+    flags, so the ProcessClientsFolderTree does not have to be pickled for every task
+    :param task: tuple of (client_id, client_path, storage, feature_flags)
+    :return: tuple of (client_id, wall time in seconds, metrics of the TaskMeasurement of the client)
+    """
+    client_id, client_path, storage, feature_flags = task
+    with TaskMeasurement(client_id) as measurement:
+        client = process_client(client_id, client_path=client_path, storage=storage, **feature_flags)
+        measurement.rows = len(client.client_events_table)
+    return client_id, measurement.wall_seconds, measurement.metrics
+
+
+def refresh_client_task(task):
+    """
+    Pool worker that brings one client up to date with the manifest entry of its last run. A client that was never
+    processed or whose events changed is processed completely. When purchases were appended to the purchases file,
+    only the events those purchases can change are recomputed. Features that were never computed are added
+    :param task: tuple of (client_id, client_path, storage, features, date_ranges, manifest_entry)
+    :return: tuple of (client_id, new manifest entry, wall time in seconds, metrics of the TaskMeasurement)
+    """
+    client_id, client_path, storage, features, date_ranges, entry = task
+    with TaskMeasurement(client_id) as measurement:
+        features = set(features)
+
+        client = Client(client_id=client_id, client_folder_path=client_path, storage=storage)
+        events_unchanged = entry is not None and file_unchanged(client.client_events_table_path, entry["events"])
+        if not events_unchanged:
+            client.process_client_features(date_ranges=date_ranges, **flags_from_features(features))
+            computed_features = features
+        else:
+            computed_features = set(entry["features"])
+            if FEATURE_PURCHASES in computed_features and list(date_ranges) != entry["date_ranges"]:
+                computed_features.discard(FEATURE_PURCHASES)
+
+            change = purchases_change(client.client_purchases_table_path, entry["purchases"])
+            if change == PURCHASES_REWRITTEN:
+                client.process_client_features(date_ranges=date_ranges, **flags_from_features(computed_features))
+            elif change == PURCHASES_APPENDED:
+                previous_rows = entry["purchases"]["rows"]
+                refresh_flags = flags_from_features(computed_features)
+                if refresh_flags["add_total_category_product_spend"] and appended_new_category_pairs(
+                        client.client_purchases_table, previous_rows):
+                    refresh_flags["add_total_category_product_spend"] = False
+                    client.process_client_add_total_spend_on_category_product()
+
+                since_date = first_appended_purchase_date(client.client_purchases_table, previous_rows)
+                if since_date is not None:
+                    client.refresh_features_since(since_date, date_ranges=date_ranges, **refresh_flags)
+
+            missing_features = features - computed_features
+            client.process_client_features(date_ranges=date_ranges, **flags_from_features(missing_features))
+            computed_features = computed_features | features
+
+        client.write_tables_to_csv()
+        measurement.rows = len(client.client_events_table)
+        new_entry = ClientManifest.create_entry(client.client_events_table_path, client.client_purchases_table_path,
+                                                len(client.client_purchases_table), computed_features, date_ranges)
+    return client_id, new_entry, measurement.wall_seconds, measurement.metrics
+
+
+def init_category_worker(category_index_descriptors):
+    """
+    attaches the worker process to the PropositionCategoryIndex in shared memory
+    :param category_index_descriptors: the descriptors of the index arrays, see shared_tables.SharedArrays.share
+    """
+    global worker_category_index
+    worker_category_index = PropositionCategoryIndex.from_shared_arrays(attach_arrays(category_index_descriptors))
+
+
+def add_product_category_task(task):
+    """
+    Pool worker that sets the product category of the purchases of one client with the PropositionCategoryIndex
+    of the worker, which all workers share
+    :param task: tuple of (client_id, client_path, storage)
+    :return: client_id
+    """
+    client_id, client_path, storage = task
+    client = Client(client_id=client_id, client_folder_path=client_path, storage=storage)
+    client.setup_product_category(worker_category_index)
+    client.write_table(client.client_purchases_table, client.client_purchases_table_path)
+    return client_id
+
+
+def aggregate_clients_task(task):
+    """
+    Pool worker that reads one chunk of clients and concatenates one of their tables, the next clients are read while
+    the table of a client is collected
+    :param task: tuple of (client_id_chunk, table_name, client_path, storage)
+    :return: the concatenated table of the chunk
+    """
+    client_id_chunk, table_name, client_path, storage = task
+    with ClientLoader(client_id_chunk, client_path=client_path, storage=storage) as client_loader:
+        tables = [client.get_table_of_client(table_name) for client in client_loader]
+    return pd.concat(tables, ignore_index=True)
+
+
+def aggregate_clients_to_part_task(task):
+    """
+    Pool worker that concatenates one table of a chunk of clients and writes it as a part of the aggregated output
+    :param task: tuple of (client_id_chunk, table_name, client_path, storage, part_path)
+    :return: tuple of (part_path, number of rows in the part)
+    """
+    client_id_chunk, table_name, client_path, storage, part_path = task
+    rows = write_part(aggregate_clients_task((client_id_chunk, table_name, client_path, storage)), part_path)
+    return part_path, rows
+
+
+def available_processes():
+    """
+    :return: the number of cores this process is allowed to run on
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
 class ProcessClientsFolderTree:
-    def __init__(self):
-        self.client_path = "client_data"
+    def __init__(self, client_path="client_data", storage="csv"):
+        """
+        :param client_path: the folder with a folder per client
+        :param storage: the table storage backend of the client tables, csv or parquet
+        """
+        self.client_path = client_path
+        self.storage = storage
 
         self.clientid_list = []
         self.process_clients_setup()
@@ -216,6 +671,9 @@ class ProcessClientsFolderTree:
         This function will setup the clients in the client folder. It will add all of the clients to the clientid_list
         :return:
         """
+        if client_table_layout(self.client_path) == "hive":
+            self.clientid_list.extend(list_client_ids(self.client_path, layout="hive"))
+            return
         for client_id in os.listdir(self.client_path):
             if "." not in client_id:
                 self.clientid_list.append(client_id)
@@ -224,34 +682,35 @@ class ProcessClientsFolderTree:
 
     def process_clients_in_chunk_7days(self, client_id_chunk, add_purchases=True,
                                        add_total_product_spend=False,
-                                       add_total_category_product_spend=False):
+                                       add_total_category_product_spend=False, read_ahead=DEFAULT_READ_AHEAD):
         """
         This function will process the clients in the chunk and add the purchases_7_day_after and purchases_30_day_after
+        The next clients are read and the processed clients are written in the background, see ClientLoader
         :param client_id_chunk:
         :param add_purchases: if True, it will add the purchases_7_day_after and purchases_30_day_after columns
         :param add_total_product_spend: if True, it will add the total_spend_on_product column
         :param add_total_category_product_spend: if True, it will add the total_spend_on_category_product column
+        :param read_ahead: the number of clients that are read while a client is processed, 0 reads and writes the
+        clients one by one
 
-        :return:
+        :return: RunReport with the timings of the clients
         """
         print("arguments:", client_id_chunk, add_purchases, add_total_product_spend, add_total_category_product_spend)
-        for index, client_id in enumerate(client_id_chunk):
-            if index % 10 == 0:
-                print("Processing client: ", client_id)
-            client = Client(client_id=client_id, client_folder_path="client_data")
-            if add_purchases:
-                client.process_client_add_purchase_nr_to_event_write_to_csv()
-
-            if add_total_product_spend:
-                client.process_client_add_total_spend_on_product()
-
-            if add_total_category_product_spend:
-                client.process_client_add_total_spend_on_category_product()
-
-
-
-            client.write_tables_to_csv()
-            #print("Done with client: ", client_id)
+        run_report = RunReport("process_clients_in_chunk_7days")
+        with ClientLoader(client_id_chunk, client_path=self.client_path, storage=self.storage,
+                          read_ahead=read_ahead) as client_loader:
+            for index, client in enumerate(client_loader):
+                if index % 10 == 0:
+                    print("Processing client: ", client.client_id, run_report.progress(len(client_id_chunk)))
+                with TaskMeasurement(client.client_id) as measurement:
+                    client.process_client_features(add_purchases=add_purchases,
+                                                   add_total_product_spend=add_total_product_spend,
+                                                   add_total_category_product_spend=add_total_category_product_spend)
+                    client_loader.write_behind(client)
+                    measurement.rows = len(client.client_events_table)
+                run_report.add(measurement.metrics)
+        print("Client loader:", client_loader.summary())
+        return run_report
 
     def setup_chunks_from_client_list(self, client_list, chunk_size=100):
         """
@@ -261,37 +720,149 @@ class ProcessClientsFolderTree:
         chunks = [client_list[i:i + chunk_size] for i in range(0, len(client_list), chunk_size)]
         return chunks
 
+    def client_table_path(self, client_id, table_name):
+        """
+        :param client_id: the id of the client
+        :param table_name: events or purchases
+        :return: the path of the table of the client in the configured table storage
+        """
+        return client_table_path(self.client_path, client_id, table_name, get_table_storage(self.storage).extension)
+
+    def order_clients_by_events_size(self, client_list):
+        """
+        This function will order the clients on the size of their events file, largest first. Starting with the
+        largest clients keeps a few large restaurants from finishing long after all of the other clients
+        :param client_list: list of client ids
+        :return: list of client ids ordered on the size of the events file
+        """
+        def events_file_size(client_id):
+            events_path = self.client_table_path(client_id, "events")
+            return os.path.getsize(events_path) if os.path.exists(events_path) else 0
+
+        return sorted(client_list, key=events_file_size, reverse=True)
+
     def process_client_purchases_to_event_multiprocessing(self, add_purchases=True,
                                                           add_total_product_spend=False,
-                                                          add_total_category_product_spend=False):
+                                                          add_total_category_product_spend=False,
+                                                          processes=None,
+                                                          report_path=None):
         """
         This function will process the clients in the client folder and add the purchases_7_day_after
         and purchases_30_day_after columns to the events.csv file
+        The clients are handed out one at a time, largest first, so an idle worker always picks up the next client
+        :param add_purchases: if True, it will add the purchases_7_day_after and purchases_30_day_after columns
+        :param add_total_product_spend: if True, it will add the total_spend_on_product column
+        :param add_total_category_product_spend: if True, it will add the total_spend_on_category_product column
+        :param processes: number of worker processes, by default the number of available cores
+        :param report_path: optional json file to write the RunReport of the run to, with the timings per stage, the
+        rates and the peak memory per worker, and a csv with a row per client next to it
+        :return: dict with the wall time in seconds per client id
+        """
+        if processes is None:
+            processes = available_processes()
+
+        feature_flags = {
+            "add_purchases": add_purchases,
+            "add_total_product_spend": add_total_product_spend,
+            "add_total_category_product_spend": add_total_category_product_spend,
+        }
+        tasks = [(client_id, self.client_path, self.storage, feature_flags)
+                 for client_id in self.order_clients_by_events_size(self.clientid_list)]
+
+        client_wall_times = {}
+        run_report = RunReport("process_client_purchases_to_event_multiprocessing")
+        with multiprocessing.Pool(processes=processes) as pool:
+            for index, (client_id, wall_time, metrics) in enumerate(pool.imap_unordered(process_client_task, tasks)):
+                client_wall_times[client_id] = wall_time
+                run_report.add(metrics)
+                if index % 100 == 0:
+                    print(f"Processed {index + 1}/{len(tasks)} clients, client {client_id} took {wall_time:.2f}s, "
+                          f"{run_report.progress(len(tasks))}")
+
+        run_report.print_summary()
+        if report_path is not None:
+            run_report.write(report_path)
+        return client_wall_times
+
+    def process_client_purchases_to_event_incremental(self, add_purchases=True,
+                                                      add_total_product_spend=False,
+                                                      add_total_category_product_spend=False,
+                                                      date_ranges=(7, 30),
+                                                      processes=None,
+                                                      manifest_path=None,
+                                                      save_every=50,
+                                                      report_path=None):
+        """
+        This function will bring the clients in the client folder up to date, like
+        process_client_purchases_to_event_multiprocessing, but it keeps a manifest of what is already computed.
+        Clients whose files did not change since the last run are skipped, a run that crashed resumes with the
+        clients that were not recorded yet, and clients that got new purchases only recompute the affected events.
+        Running it twice gives the same files as running it once
         :param add_purchases: if True, it will add the purchases_7_day_after and purchases_30_day_after columns
         :param add_total_product_spend: if True, it will add the total_spend_on_product column
         :param add_total_category_product_spend: if True, it will add the total_spend_on_category_product column
+        :param date_ranges: the number of days to look after the event date for the purchases columns
+        :param processes: number of worker processes, by default the number of available cores
+        :param manifest_path: the manifest file, by default manifest.json in the client folder
+        :param save_every: the manifest is saved after every save_every processed clients
+        :param report_path: optional json file to write the RunReport of the run to, see
+        process_client_purchases_to_event_multiprocessing
+        :return: dict with the wall time in seconds per processed client id
+        """
+        if processes is None:
+            processes = available_processes()
+        if manifest_path is None:
+            manifest_path = os.path.join(self.client_path, "manifest.json")
+
+        manifest = ClientManifest(manifest_path)
+        features = features_from_flags(add_purchases, add_total_product_spend, add_total_category_product_spend)
+
+        tasks = []
+        for client_id in self.order_clients_by_events_size(self.clientid_list):
+            entry = manifest.get(client_id)
+            if ClientManifest.is_up_to_date(entry, self.client_table_path(client_id, "events"),
+                                            self.client_table_path(client_id, "purchases"), features, date_ranges):
+                continue
+            tasks.append((client_id, self.client_path, self.storage, sorted(features), list(date_ranges), entry))
+        print(f"Skipping {len(self.clientid_list) - len(tasks)} up to date clients, processing {len(tasks)} clients")
+
+        client_wall_times = {}
+        run_report = RunReport("process_client_purchases_to_event_incremental")
+        with multiprocessing.Pool(processes=processes) as pool:
+            for index, (client_id, entry, wall_time, metrics) in enumerate(
+                    pool.imap_unordered(refresh_client_task, tasks)):
+                manifest.record(client_id, entry)
+                client_wall_times[client_id] = wall_time
+                run_report.add(metrics)
+                if (index + 1) % save_every == 0:
+                    manifest.save()
+                    print(f"Processed {index + 1}/{len(tasks)} clients, {run_report.progress(len(tasks))}")
+        manifest.save()
+        run_report.print_summary()
+        if report_path is not None:
+            run_report.write(report_path)
+        return client_wall_times
+
+    def add_product_category_multiprocessing(self, category_index_path="processed_data/proposition_categories.npz",
+                                             processes=None):
+        """
+        This function will set the ARTICLE_CATEGORIE column of the purchases of every client from the saved
+        PropositionCategoryIndex, see proposition_category_index.py. The index is loaded once and put in shared
+        memory, the workers attach to it instead of each loading a copy
+        :param category_index_path: the saved index of all events
+        :param processes: number of worker processes, by default the number of available cores
         :return:
         """
-        chunks_to_process = self.setup_chunks_from_client_list(self.clientid_list, chunk_size=100)
-
-        args_for_processing = [
-            (chunk,
-             add_purchases,
-             add_total_product_spend,
-             add_total_category_product_spend
-             )
-            for chunk in chunks_to_process]
-
-        with multiprocessing.Pool(processes=8) as pool:
-            results = pool.starmap(self.process_clients_in_chunk_7days, args_for_processing)
-
-        """if add_purchases:
-            with multiprocessing.Pool(processes=1) as pool:
-                results = pool.map(self.process_clients_in_chunk_7days, chunks_to_process)
-        
-        if add_total_product_spend:
-            with multiprocessing.Pool(processes=1) as pool:
-                results = pool.map(self.process_clients_in_chunk_7days, chunks_to_process)"""
+        tasks = [(client_id, self.client_path, self.storage) for client_id in self.clientid_list]
+        category_index = PropositionCategoryIndex.load(category_index_path)
+        with SharedArrays() as shared_arrays:
+            category_index_descriptors = shared_arrays.share(category_index.shared_arrays())
+            del category_index
+            with multiprocessing.Pool(processes=processes or available_processes(), initializer=init_category_worker,
+                                      initargs=(category_index_descriptors,)) as pool:
+                for index, client_id in enumerate(pool.imap_unordered(add_product_category_task, tasks, chunksize=10)):
+                    if index % 1000 == 0:
+                        print(f"Added the product category of {index + 1}/{len(tasks)} clients")
 
     #________________________________Aggregate with multiprocessing_________________________________________________#
 
@@ -302,19 +873,7 @@ class ProcessClientsFolderTree:
         :param table_name: to aggregate can only be purchases or events
         :return:
         """
-        if table_name == "purchases":
-            client = Client(client_id=client_id_chunk[0], client_folder_path="client_data")
-            df = client.get_table_of_client(table_name)
-            for index, client_id in enumerate(client_id_chunk[1:]):
-                client = Client(client_id=client_id, client_folder_path="client_data")
-                df = pd.concat([df, client.get_table_of_client(table_name)], ignore_index=True)
-        elif table_name == "events":
-            client = Client(client_id=client_id_chunk[0], client_folder_path="client_data")
-            df = client.get_table_of_client(table_name)
-            for index, client_id in enumerate(client_id_chunk[1:]):
-                client = Client(client_id=client_id, client_folder_path="client_data")
-                df = pd.concat([df, client.get_table_of_client(table_name)], ignore_index=True)
-        return df
+        return aggregate_clients_task((client_id_chunk, table_name, self.client_path, self.storage))
 
     def aggregate_clients_multi_processing(self, table_name="purchases", write_to_csv=False,
                                            file_name_to_write="processed_purchase_events.csv", sample_bool=False):
@@ -322,8 +881,8 @@ class ProcessClientsFolderTree:
         This function will aggregate the clients in the client folder using multiprocessing
         You can specify the table name to aggregate
         :param table_name:
-        :param write_to_csv:
-        :param file_name_to_write:
+        :param write_to_csv: if True, the aggregated table is written to file_name_to_write
+        :param file_name_to_write: written as parquet if it ends with .parquet, otherwise as csv
         :param sample_bool: if True, it will only process the first 10 chunks which is 1000 clients
         :return:
         """
@@ -331,17 +890,64 @@ class ProcessClientsFolderTree:
         if sample_bool:
             chunks_to_process = chunks_to_process[:10]
         # Prepare tuples of arguments
-        args_for_processing = [(chunk, table_name) for chunk in chunks_to_process]
+        args_for_processing = [(chunk, table_name, self.client_path, self.storage) for chunk in chunks_to_process]
 
-        with multiprocessing.Pool(processes=8) as pool:
-            results = pool.starmap(self.aggregate_clients_in_chunk, args_for_processing)
+        with multiprocessing.Pool(processes=available_processes()) as pool:
+            results = list(pool.imap(aggregate_clients_task, args_for_processing))
 
         df = pd.concat(results, ignore_index=True)
         if write_to_csv:
-            df.to_csv(file_name_to_write, sep="|", index=False)
+            get_table_storage_for_path(file_name_to_write).write(df, file_name_to_write)
         return df
 
 
+    def aggregate_clients_streaming(self, table_name="purchases",
+                                    file_name_to_write="processed_data/processed_purchase_events.csv",
+                                    sample_bool=False, processes=None, chunk_size=100):
+        """
+        This function will aggregate the clients in the client folder using multiprocessing in bounded memory.
+        Every worker writes the table of its chunk of clients as a part, and the parts are appended to the output in
+        chunk order as soon as they are done. So the output has the same client order as
+        aggregate_clients_multi_processing, but only a few chunks are in memory at a time
+        :param table_name: to aggregate can only be purchases or events
+        :param file_name_to_write: written as parquet row groups if it ends with .parquet, otherwise as csv
+        :param sample_bool: if True, it will only process the first 10 chunks which is 1000 clients
+        :param processes: number of worker processes, by default the number of available cores
+        :param chunk_size: number of clients per part
+        :return: number of aggregated rows
+        """
+        if processes is None:
+            processes = available_processes()
+
+        chunks_to_process = self.setup_chunks_from_client_list(self.clientid_list, chunk_size=chunk_size)
+        if sample_bool:
+            chunks_to_process = chunks_to_process[:10]
+
+        parts_folder = file_name_to_write + ".parts"
+        os.makedirs(parts_folder, exist_ok=True)
+        args_for_processing = [
+            (chunk, table_name, self.client_path, self.storage,
+             chunk_part_path(parts_folder, chunk_index, file_name_to_write))
+            for chunk_index, chunk in enumerate(chunks_to_process)]
+
+        part_merger = get_part_merger(file_name_to_write)
+        total_rows = 0
+        try:
+            with multiprocessing.Pool(processes=processes) as pool:
+                # imap returns the parts in chunk order, the next parts are written while this one is appended
+                for index, (part_path, rows) in enumerate(pool.imap(aggregate_clients_to_part_task,
+                                                                    args_for_processing)):
+                    part_merger.append_part(part_path)
+                    os.remove(part_path)
+                    total_rows += rows
+                    if index % 10 == 0:
+                        print(f"Aggregated chunk {index + 1}/{len(args_for_processing)}")
+        finally:
+            part_merger.close()
+        shutil.rmtree(parts_folder, ignore_errors=True)
+        return total_rows
+
+
 if __name__ == "__main__":
     #if you run this program, you will add each of the clients in the client_data folder. THen for each of the
     # clients you will add the purchases_7_day_after and purchases_30_day_after columns to the events.csv file
@@ -366,8 +972,8 @@ if __name__ == "__main__":
     # If you want to aggregate the clients in the client folder using multiprocessing, you can use the function below
     # This function will aggregate the clients in the client folder using multiprocessing
 
-    process_clients.aggregate_clients_multi_processing(table_name="purchases", write_to_csv=True,
-                                                       file_name_to_write="processed_data/processed_purchase_events_final_correct.csv")
+    process_clients.aggregate_clients_streaming(
+        table_name="purchases", file_name_to_write="processed_data/processed_purchase_events_final_correct.csv")
 
-    process_clients.aggregate_clients_multi_processing(table_name="events", write_to_csv=True,
-                                                       file_name_to_write="processed_data/processed_events_final_correct.csv")
\ No newline at end of file
+    process_clients.aggregate_clients_streaming(
+        table_name="events", file_name_to_write="processed_data/processed_events_final_correct.csv")
\ No newline at end of file
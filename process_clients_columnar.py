@@ -0,0 +1,130 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from cumulative_spend_index import CumulativeSpendIndex
+from sorted_window_index import count_in_windows, window_label
+from table_storage import get_table_storage_for_file
+
+
+class ProcessClientsColumnar:
+    """
+    Single pass version of the client_data flow. Instead of splitting the events and purchases into a folder per
+    client, processing every folder with ProcessClientsFolderTree and aggregating the folders again, the global
+    tables are read once and every feature is computed for all of the clients at once. The indexes are keyed by
+    USER_CLIENT_NUMBER, so every feature is computed per client exactly like the Client class does on its own
+    folder.
+    """
+
+    def __init__(self, events_table_path="processed_data/processed_events_final.csv",
+                 purchases_table_path="processed_data/purchase_data_with_categories.csv",
+                 client_id_list=None):
+        """
+        :param events_table_path: the events table of all clients, the input of
+        save_clients_in_folder_structure_updated.ipynb
+        :param purchases_table_path: the purchases table of all clients with the ARTICLE_CATEGORIE column
+        :param client_id_list: the clients to process in the order to write them. Pass
+        ProcessClientsFolderTree().clientid_list to get the rows in the same order as the folder tree. By default the
+        clients with both purchases and events are used in the order of the purchases table, like the notebook does
+        """
+        self.events_table = get_table_storage_for_file(events_table_path).read(events_table_path)
+        self.purchases_table = get_table_storage_for_file(purchases_table_path).read(purchases_table_path)
+        if "Unnamed: 0" in self.purchases_table.columns:
+            self.purchases_table = self.purchases_table.drop(columns=["Unnamed: 0"])
+
+        if client_id_list is None:
+            client_id_list = self.clients_with_purchases_and_events()
+        self.clientid_list = [int(client_id) for client_id in client_id_list]
+
+        self.events_table = self.select_clients(self.events_table)
+        self.purchases_table = self.select_clients(self.purchases_table)
+
+    def clients_with_purchases_and_events(self):
+        """
+        This function will return the clients that have purchases and events. These are the clients the notebook
+        saves in the client folder tree
+        :return: list of client ids in the order of the purchases table
+        """
+        unique_clients_purchases = self.purchases_table["USER_CLIENT_NUMBER"].unique()
+        unique_clients_events = self.events_table["USER_CLIENT_NUMBER"].unique()
+        return list(unique_clients_purchases[np.isin(unique_clients_purchases, unique_clients_events)])
+
+    def select_clients(self, table):
+        """
+        This function will keep the rows of the clients in the clientid_list and order the rows per client in the
+        order of the clientid_list. The rows of one client keep their original order
+        :param table: events or purchases table
+        :return: the rows of the selected clients
+        """
+        client_order = pd.Series(np.arange(len(self.clientid_list)), index=self.clientid_list)
+        client_rank = table["USER_CLIENT_NUMBER"].map(client_order)
+        table = table[client_rank.notna().to_numpy()]
+        client_rank = client_rank.dropna().to_numpy()
+        return table.iloc[np.argsort(client_rank, kind="stable")].reset_index(drop=True)
+
+    def process_clients(self, add_purchases=True, add_total_product_spend=False,
+                        add_total_category_product_spend=False, date_ranges=(7, 30), event_timestamp_column=None,
+                        purchase_timestamp_column=None):
+        """
+        This function will add the same columns to the events table as
+        ProcessClientsFolderTree.process_client_purchases_to_event_multiprocessing
+        :param add_purchases: if True, it will add the purchases_7_day_after and purchases_30_day_after columns
+        :param add_total_product_spend: if True, it will add the total_spend_on_product column
+        :param add_total_category_product_spend: if True, it will add the total_spend_on_category_product column
+        :param date_ranges: the number of days or the timedeltas to look after the event date, every date range adds
+        a purchases_<date_range>_after column with the same name as Client.process_client_add_purchase_nr_to_event
+        :param event_timestamp_column: the timestamp column of the events, needed for the timedelta date ranges
+        :param purchase_timestamp_column: the timestamp column of the purchases, needed for the timedelta date ranges
+        :return: the processed events table
+        """
+        if add_purchases:
+            purchase_counts = count_in_windows(self.purchases_table, self.events_table, date_ranges,
+                                               direction="after", timestamp_column=purchase_timestamp_column,
+                                               query_timestamp_column=event_timestamp_column)
+            self.events_table = self.events_table.assign(**{
+                f"purchases_{window_label(date_range)}_after": counts for date_range, counts in purchase_counts.items()
+            })
+
+        if add_total_product_spend or add_total_category_product_spend:
+            spend_index = CumulativeSpendIndex(self.purchases_table,
+                                               category_key_columns=("USER_CLIENT_NUMBER", "ARTICLE_CATEGORIE"))
+            if add_total_product_spend:
+                self.events_table["total_spend_on_product"] = spend_index.spend_on_product(self.events_table)
+
+            if add_total_category_product_spend:
+                if spend_index.has_categories():
+                    self.events_table["total_spend_on_category_product"] = spend_index.spend_on_category_product(
+                        self.events_table)
+                else:
+                    print("No product category found in the purchases table")
+                    self.events_table["total_spend_on_category_product"] = 0.0
+
+        return self.events_table
+
+    def write_tables_to_csv(self, events_file_name="processed_data/processed_events_final_correct.csv",
+                            purchases_file_name=None):
+        """
+        This function will write the processed tables directly to the csv, without the client folder tree
+        :param events_file_name: file to write the processed events to
+        :param purchases_file_name: if given, the purchases of the selected clients are written to this file
+        :return:
+        """
+        self.events_table.to_csv(events_file_name, sep="|", index=False)
+        if purchases_file_name is not None:
+            self.purchases_table.to_csv(purchases_file_name, sep="|", index=False)
+
+
+if __name__ == "__main__":
+    # if you run this program, you will process all of the clients in memory and write the processed events
+    # directly, without having to setup the client_data folder tree first
+    if not os.path.exists("processed_data/processed_events_final.csv"):
+        raise Exception("you have to first add the processed events and purchases to the processed_data folder")
+
+    process_clients = ProcessClientsColumnar()
+    process_clients.process_clients(add_purchases=True,
+                                    add_total_product_spend=True,
+                                    add_total_category_product_spend=True)
+    process_clients.write_tables_to_csv(
+        events_file_name="processed_data/processed_events_final_correct.csv",
+        purchases_file_name="processed_data/processed_purchase_events_final_correct.csv")
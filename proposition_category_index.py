@@ -0,0 +1,206 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from table_storage import get_table_storage_for_file
+
+# the category code of propositions without a known category
+MISSING_CATEGORY = -1
+
+
+class PropositionCategoryIndex:
+    """
+    Global lookup of the ARTICLE_CATEGORIE of every PROPOSITION. It is built once from the events of all clients and
+    saved, so the clients and the worker processes look the categories up instead of searching the events again.
+
+    A proposition gets the first category it has in the events, like the groupby("PROPOSITION").first() of
+    add_category_to_purchases.ipynb. The categories are stored as integer codes, the code of a category is its
+    position in categories, and a batch of propositions is looked up with one binary search.
+
+    The client tables keep the category values, because the ARTICLE_CATEGORIE of the events is compared with them and
+    the reward model is trained on them. apply gives the purchases a categorical column on the codes of the index, so
+    in memory they are integer codes as well, and table_schema.py reads the column back as a categorical.
+    """
+
+    def __init__(self, propositions=None, category_codes=None, categories=None):
+        """
+        :param propositions: sorted array of the proposition ids
+        :param category_codes: the category code of every proposition
+        :param categories: the category values, the position of a value is its code
+        """
+        self.propositions = np.asarray(propositions if propositions is not None else [], dtype=np.int64)
+        self.category_codes = np.asarray(category_codes if category_codes is not None else [], dtype=np.int32)
+        self.categories = pd.Index(categories if categories is not None else [], dtype=object)
+
+    @classmethod
+    def build(cls, events_table):
+        """
+        :param events_table: events with the PROPOSITION and ARTICLE_CATEGORIE columns
+        :return: the index of the first category of every proposition in the events
+        """
+        return cls().add_events(events_table)
+
+    @classmethod
+    def build_from_file(cls, events_path, chunk_size=1_000_000):
+        """
+        builds the index from an events file, which is read in chunks with only the two columns that are needed
+        :param events_path: path of the events, csv or parquet
+        :param chunk_size: the number of rows that are read at once
+        :return: PropositionCategoryIndex
+        """
+        category_index = cls()
+        for chunk in get_table_storage_for_file(events_path).read_chunks(
+                events_path, chunk_size=chunk_size, columns=["PROPOSITION", "ARTICLE_CATEGORIE"]):
+            category_index.add_events(chunk)
+        return category_index
+
+    def add_events(self, events_table):
+        """
+        adds the propositions of the events that are not in the index yet. Propositions that are already in the
+        index keep their category, so adding the events in chunks gives the same index as adding them at once
+        :param events_table: events with the PROPOSITION and ARTICLE_CATEGORIE columns
+        :return: the index
+        """
+        events_with_category = events_table[["PROPOSITION", "ARTICLE_CATEGORIE"]].dropna()
+        # every category is given a code, also the ones that are not the first category of a proposition, so the
+        # categories of all events can be encoded
+        new_categories = pd.Index(pd.unique(events_with_category["ARTICLE_CATEGORIE"]), dtype=object)
+        self.categories = self.categories.append(new_categories.difference(self.categories, sort=False))
+
+        first_categories = events_with_category.drop_duplicates(subset="PROPOSITION", keep="first")
+        propositions = first_categories["PROPOSITION"].to_numpy(dtype=np.int64)
+        new_propositions = ~np.isin(propositions, self.propositions)
+        if new_propositions.any():
+            propositions = np.concatenate((self.propositions, propositions[new_propositions]))
+            category_codes = np.concatenate((
+                self.category_codes,
+                self.categories.get_indexer(first_categories["ARTICLE_CATEGORIE"][new_propositions]).astype(np.int32)))
+            order = np.argsort(propositions, kind="stable")
+            self.propositions = propositions[order]
+            self.category_codes = category_codes[order]
+        return self
+
+    def codes_of(self, propositions):
+        """
+        :param propositions: the proposition ids to look up
+        :return: int32 array with the category code of every proposition, MISSING_CATEGORY if it has none
+        """
+        propositions = np.asarray(propositions, dtype=np.int64)
+        if len(self.propositions) == 0:
+            return np.full(len(propositions), MISSING_CATEGORY, dtype=np.int32)
+        positions = np.minimum(np.searchsorted(self.propositions, propositions), len(self.propositions) - 1)
+        found = self.propositions.take(positions) == propositions
+        return np.where(found, self.category_codes.take(positions), MISSING_CATEGORY).astype(np.int32)
+
+    def categories_of(self, propositions, missing_value=np.nan):
+        """
+        :param propositions: the proposition ids to look up
+        :param missing_value: the value of the propositions without a category
+        :return: object array with the category of every proposition
+        """
+        return self.decode(self.codes_of(propositions), missing_value=missing_value)
+
+    def encode(self, category_values):
+        """
+        :param category_values: ARTICLE_CATEGORIE values, for example "1,071,331,581"
+        :return: int32 array with the code of every value, MISSING_CATEGORY for missing and unknown values
+        """
+        return self.categories.get_indexer(pd.Index(category_values, dtype=object)).astype(np.int32)
+
+    def decode(self, category_codes, missing_value=np.nan):
+        """
+        :param category_codes: category codes
+        :param missing_value: the value of MISSING_CATEGORY
+        :return: object array with the category value of every code
+        """
+        category_codes = np.asarray(category_codes)
+        values = np.full(len(category_codes), missing_value, dtype=object)
+        known_codes = category_codes != MISSING_CATEGORY
+        values[known_codes] = self.categories.to_numpy().take(category_codes[known_codes])
+        return values
+
+    def apply(self, purchases_table, as_codes=False, missing_value=np.nan):
+        """
+        sets the ARTICLE_CATEGORIE column of the purchases from their PROPOSITION
+        :param purchases_table: purchases with the PROPOSITION column
+        :param as_codes: if True, the column gets the integer category codes instead of the category values
+        :param missing_value: the value of the purchases whose proposition has no category, when not as_codes
+        :return: the purchases with the ARTICLE_CATEGORIE column, a categorical on the category codes when not
+        as_codes, so it is written with the category values
+        """
+        category_codes = self.codes_of(purchases_table["PROPOSITION"])
+        if as_codes:
+            return purchases_table.assign(ARTICLE_CATEGORIE=category_codes)
+        categories = self.categories
+        if not pd.isna(missing_value):
+            if missing_value not in categories:
+                categories = categories.append(pd.Index([missing_value], dtype=object))
+            category_codes = np.where(category_codes == MISSING_CATEGORY, categories.get_loc(missing_value),
+                                      category_codes)
+        return purchases_table.assign(ARTICLE_CATEGORIE=pd.Categorical.from_codes(category_codes, categories))
+
+    def save(self, path):
+        """
+        saves the index as a npz file
+        :param path: path of the npz file
+        :return:
+        """
+        temporary_path = path + ".tmp.npz"
+        np.savez(temporary_path, propositions=self.propositions, category_codes=self.category_codes,
+                 categories=np.array(self.categories, dtype=str))
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        loads an index that was saved with save
+        :param path: path of the npz file
+        :return: PropositionCategoryIndex
+        """
+        with np.load(path) as index_data:
+            return cls(propositions=index_data["propositions"], category_codes=index_data["category_codes"],
+                       categories=index_data["categories"].tolist())
+
+    def shared_arrays(self):
+        """
+        :return: dict with the arrays of the index, to put in shared memory with shared_tables.SharedArrays
+        """
+        return {"propositions": self.propositions, "category_codes": self.category_codes,
+                "categories": np.array(self.categories, dtype=str)}
+
+    @classmethod
+    def from_shared_arrays(cls, arrays):
+        """
+        builds the index on arrays that were attached with shared_tables.attach_arrays. The proposition and code
+        arrays are used without a copy, only the few category values are copied
+        :param arrays: dict returned by shared_arrays
+        :return: PropositionCategoryIndex
+        """
+        return cls(propositions=arrays["propositions"], category_codes=arrays["category_codes"],
+                   categories=arrays["categories"].tolist())
+
+    @classmethod
+    def load_or_build(cls, path, events_path):
+        """
+        :param path: path of the saved index
+        :param events_path: the events to build the index from when it is not saved yet
+        :return: the saved index, or the index built from the events, which is then saved
+        """
+        if os.path.exists(path):
+            return cls.load(path)
+        category_index = cls.build_from_file(events_path)
+        category_index.save(path)
+        return category_index
+
+
+if __name__ == "__main__":
+    # builds the index of add_category_to_purchases.ipynb and adds the categories to the purchases
+    category_index = PropositionCategoryIndex.load_or_build("processed_data/proposition_categories.npz",
+                                                            "processed_data/processed_events.csv")
+    print("Propositions with a category: ", len(category_index.propositions),
+          "categories: ", len(category_index.categories))
+    purchases = get_table_storage_for_file("processed_data/processed_purchase_events.csv").read(
+        "processed_data/processed_purchase_events.csv")
+    purchases = category_index.apply(purchases, missing_value="0")
+    purchases.to_csv("processed_data/purchase_data_with_categories.csv", sep="|", index=False)
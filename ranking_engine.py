@@ -0,0 +1,255 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+from compact_forest import CompactForest
+from reward_scoring_service import CANDIDATE_COLUMNS
+from rewardRandomForest import FIXED_FEATURE_VALUES, MODEL_FEATURE_COLUMNS, RewardPredictor
+from weather_features import weather_feature_columns
+
+# the categorical columns RewardPredictor numbers per table when the model has no encoder, a session has one value
+# in them so they get number 0
+PER_TABLE_CATEGORICAL_COLUMNS = ["PAGE_SECTION", "DEVICE_INFO_BRAND", "DEVICE_INFO_TYPE", "DEVICE_INFO_BROWSER",
+                                 "USER_SALES_GROUP", "USER_SEGMENT", "USER_SALES_DISTRICT"]
+
+
+class RankingEngine:
+    """
+    Ranks a catalogue of candidate propositions for a session with the reward model, instead of scoring rankings
+    that were built offline in the notebooks.
+
+    The features of the catalogue are kept as a float32 matrix in the feature order of the model. For a request the
+    rows of the candidates are taken from it in one go and the session columns, which are the same for every
+    candidate, are filled in with one broadcast, so no per candidate rows or tables are built. The session context
+    is encoded once with the encoder and weather store of the RewardPredictor, and all candidates are scored in one
+    batched prediction. The scores are bit-identical to RewardPredictor.predict_reward on the same rows.
+
+    The top-K are found with argpartition. If the model predicts with PAGE_SECTION_POSITION, the candidates are
+    scored at every position and the positions are filled in order with the best candidate that is not placed yet.
+
+    A request does not change the engine, so one engine can serve requests from several threads.
+    """
+
+    def __init__(self, reward_predictor, catalogue):
+        """
+        :param reward_predictor: the RewardPredictor, its model, encoder and weather store are used
+        :param catalogue: table with a row per PROPOSITION and the candidate columns, like PRICE. Candidate columns
+        that are not in the catalogue are 0, like in RewardScoringService
+        """
+        self.reward_predictor = reward_predictor
+        self.model = reward_predictor.model
+        model_feature_names = getattr(self.model, "feature_names_in_", None)
+        self.feature_columns = list(model_feature_names if model_feature_names is not None else MODEL_FEATURE_COLUMNS)
+        self.candidate_columns = [column for column in self.feature_columns if column in CANDIDATE_COLUMNS]
+        self.session_columns = [column for column in self.feature_columns if column not in CANDIDATE_COLUMNS]
+        self.candidate_feature_positions = np.array([self.feature_columns.index(column)
+                                                     for column in self.candidate_columns], dtype=np.int64)
+        self.session_feature_positions = np.array([self.feature_columns.index(column)
+                                                   for column in self.session_columns], dtype=np.int64)
+        self.position_feature = (self.feature_columns.index("PAGE_SECTION_POSITION")
+                                 if "PAGE_SECTION_POSITION" in self.feature_columns else None)
+
+        catalogue = catalogue.drop_duplicates("PROPOSITION").sort_values("PROPOSITION")
+        self.propositions = catalogue["PROPOSITION"].to_numpy(dtype=np.int64)
+        self.catalogue_features = np.zeros((len(catalogue), len(self.feature_columns)), dtype=np.float32)
+        for column in self.candidate_columns:
+            if column in catalogue.columns:
+                self.catalogue_features[:, self.feature_columns.index(column)] = catalogue[column].to_numpy(
+                    dtype=np.float32, na_value=np.nan)
+
+        # the trees of a scikit-learn forest are called directly, which skips the input validation and the thread
+        # pool of RandomForestRegressor.predict
+        self.trees = None
+        if hasattr(self.model, "estimators_") and all(hasattr(tree, "tree_") for tree in self.model.estimators_):
+            self.trees = [tree.tree_ for tree in self.model.estimators_]
+        self.weather_cache = {}
+
+    def session_features(self, session_context):
+        """
+        :param session_context: dict with the session columns, for example USER_CLIENT_NUMBER, USER_SESSION_ID,
+        DATE, the device columns and the weather columns. Weather columns that are missing are looked up in the
+        weather store of the reward predictor
+        :return: float32 array with the value of every session column
+        """
+        encoder = self.reward_predictor.encoder
+        weather_values = self.weather_values(session_context)
+        values = np.empty(len(self.session_columns), dtype=np.float32)
+        for index, column in enumerate(self.session_columns):
+            if column in FIXED_FEATURE_VALUES:
+                value = FIXED_FEATURE_VALUES[column]
+            elif column == "day_of_week":
+                value = pd.Timestamp(session_context["DATE"]).dayofweek
+            elif encoder is not None and column in encoder.categories:
+                value = encoder.categories[column].get_indexer(pd.Index([session_context.get(column)],
+                                                                        dtype=object))[0]
+                if value == -1:
+                    if encoder.handle_unknown == "error":
+                        raise ValueError(f"Unseen value in column {column}: {session_context.get(column)}")
+                    value = encoder.unknown_value
+            elif encoder is None and column in PER_TABLE_CATEGORICAL_COLUMNS:
+                value = 0
+            elif column in weather_values:
+                value = weather_values[column]
+            else:
+                value = session_context.get(column, np.nan)
+            values[index] = np.nan if value is None else value
+        return values
+
+    def weather_values(self, session_context):
+        """
+        :return: dict with the weather features of the session that are not in the context, looked up once per date
+        and district
+        """
+        weather_store = self.reward_predictor.weather_store
+        if weather_store is None or set(weather_feature_columns(weather_store.leads)).issubset(session_context):
+            return {}
+        cache_key = (str(session_context["DATE"]), session_context.get(weather_store.district_column))
+        if cache_key not in self.weather_cache:
+            session_table = pd.DataFrame({"DATE": [session_context["DATE"]],
+                                          weather_store.district_column: [cache_key[1]]})
+            self.weather_cache[cache_key] = {column: values[0]
+                                             for column, values in weather_store.features(session_table).items()}
+        return self.weather_cache[cache_key]
+
+    def catalogue_rows(self, propositions):
+        """
+        :param propositions: the proposition ids of the candidates, None for the whole catalogue
+        :return: the rows of the candidates in the catalogue
+        """
+        if propositions is None:
+            return np.arange(len(self.propositions))
+        propositions = np.asarray(propositions, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(self.propositions, propositions), max(len(self.propositions) - 1, 0))
+        unknown = self.propositions.take(rows) != propositions if len(self.propositions) else np.ones(
+            len(propositions), dtype=bool)
+        if unknown.any():
+            raise ValueError(f"Propositions that are not in the catalogue: {propositions[unknown][:10].tolist()}")
+        return rows
+
+    def feature_matrix(self, session_context, propositions=None, candidate_values=None):
+        """
+        :param session_context: dict with the session columns
+        :param propositions: the proposition ids of the candidates, None for the whole catalogue
+        :param candidate_values: optional dict with per candidate column an array with a value per candidate, for
+        example the total_spend_on_product of the client, it replaces the values of the catalogue
+        :return: float32 matrix with a row per candidate and the features of the model as columns
+        """
+        return self.rows_feature_matrix(session_context, self.catalogue_rows(propositions), candidate_values)
+
+    def rows_feature_matrix(self, session_context, candidate_rows, candidate_values=None):
+        """
+        :param candidate_rows: the rows of the candidates in the catalogue, see catalogue_rows
+        :return: the feature matrix of the candidates, see feature_matrix
+        """
+        features = self.catalogue_features.take(candidate_rows, axis=0)
+        features[:, self.session_feature_positions] = self.session_features(session_context)
+        for column, values in (candidate_values or {}).items():
+            features[:, self.feature_columns.index(column)] = values
+        return features
+
+    def predict(self, features):
+        """
+        :param features: float32 feature matrix, see feature_matrix
+        :return: the predicted reward of every row
+        """
+        if self.trees is not None:
+            predictions = np.zeros(len(features), dtype=np.float64)
+            for tree in self.trees:
+                predictions += tree.predict(features).ravel()
+            return predictions / len(self.trees)
+        if isinstance(self.model, CompactForest):
+            return self.model.predict(features)
+        return self.model.predict(pd.DataFrame(features, columns=self.feature_columns))
+
+    def score(self, session_context, propositions=None, candidate_values=None):
+        """
+        :return: the predicted reward of every candidate, see feature_matrix for the parameters
+        """
+        return self.predict(self.feature_matrix(session_context, propositions, candidate_values))
+
+    def top_k(self, session_context, k=10, propositions=None, candidate_values=None):
+        """
+        :param session_context: dict with the session columns
+        :param k: the number of positions to fill
+        :param propositions: the proposition ids of the candidates, None for the whole catalogue
+        :param candidate_values: optional dict with per candidate column an array with a value per candidate
+        :return: tuple of the proposition ids and their predicted reward for PAGE_SECTION_POSITION 1 to k
+        """
+        candidate_rows = self.catalogue_rows(propositions)
+        features = self.rows_feature_matrix(session_context, candidate_rows, candidate_values)
+        k = min(k, len(candidate_rows))
+        if k == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+
+        if self.position_feature is None:
+            scores = self.predict(features)
+            best = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+            best = best[np.argsort(-scores[best], kind="stable")]
+            return self.propositions[candidate_rows[best]], scores[best]
+
+        # every position gets the best of its top k candidates that is not placed at an earlier position, at most
+        # k - 1 of them are placed already
+        chosen = np.empty(k, dtype=np.int64)
+        chosen_scores = np.empty(k)
+        placed = np.zeros(len(candidate_rows), dtype=bool)
+        for position in range(1, k + 1):
+            features[:, self.position_feature] = position
+            scores = self.predict(features)
+            best = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+            best = best[~placed[best]]
+            chosen[position - 1] = best[np.argmax(scores[best])]
+            chosen_scores[position - 1] = scores[chosen[position - 1]]
+            placed[chosen[position - 1]] = True
+        return self.propositions[candidate_rows[chosen]], chosen_scores
+
+    def top_k_table(self, session_context, k=10, propositions=None, candidate_values=None):
+        """
+        :return: table with the PAGE_SECTION_POSITION, PROPOSITION and predicted reward of the top k, see top_k
+        """
+        top_propositions, top_scores = self.top_k(session_context, k, propositions, candidate_values)
+        return pd.DataFrame({"PAGE_SECTION_POSITION": np.arange(1, len(top_propositions) + 1),
+                             "PROPOSITION": top_propositions, "reward": top_scores})
+
+
+def benchmark_ranking_latency(engine, session_contexts, n_candidates=5000, k=10, repeats=5, seed=0):
+    """
+    Latency benchmark of RankingEngine.top_k, every session is ranked repeats times with a random set of candidates
+    from the catalogue
+    :param engine: the RankingEngine
+    :param session_contexts: list of session context dicts
+    :param n_candidates: the number of candidates per request, at most the size of the catalogue
+    :param k: the number of positions to fill
+    :return: dict with the latency percentiles in milliseconds
+    """
+    random_generator = np.random.default_rng(seed)
+    n_candidates = min(n_candidates, len(engine.propositions))
+    latencies = []
+    for _ in range(repeats):
+        for session_context in session_contexts:
+            propositions = random_generator.choice(engine.propositions, size=n_candidates, replace=False)
+            start_time = time.perf_counter()
+            engine.top_k(session_context, k=k, propositions=propositions)
+            latencies.append(time.perf_counter() - start_time)
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "requests": len(latencies),
+        "candidates_per_request": n_candidates,
+        "p50_latency_ms": float(np.percentile(latencies_ms, 50)),
+        "p99_latency_ms": float(np.percentile(latencies_ms, 99)),
+        "max_latency_ms": float(latencies_ms.max()),
+    }
+
+
+if __name__ == "__main__":
+    # ranks the propositions of the processed events for the sessions of a benchmark file
+    from table_storage import get_table_storage_for_file
+
+    events = get_table_storage_for_file("processed_data/processed_events_final.csv").read(
+        "processed_data/processed_events_final.csv", columns=["PROPOSITION", "PRICE", "ARTICLE_CATEGORIE"])
+    ranking_engine = RankingEngine(RewardPredictor(), catalogue=events)
+    benchmark_file = "benchmark_data/benchmark_bidfood_current_prediction_system/premium_product_line.csv"
+    benchmark = get_table_storage_for_file(benchmark_file).read(benchmark_file)
+    sessions = [session.iloc[0].to_dict() for _, session in benchmark.groupby("USER_SESSION_ID", sort=False)]
+    print(ranking_engine.top_k_table(sessions[0], k=10))
+    print(benchmark_ranking_latency(ranking_engine, sessions))
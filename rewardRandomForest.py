@@ -4,19 +4,91 @@ import os
 import numpy as np
 import pandas as pd
 
+from category_encoder import CategoricalEncoder
+from compact_forest import COMPACT_FOREST_EXTENSION, CompactForest
+from pipeline_instrumentation import timed_stage
+from table_storage import CsvTableStorage, ParquetTableStorage
+from weather_features import WeatherFeatureStore, weather_feature_columns
+
+# the features the reward model predicts with, in the order of training
+MODEL_FEATURE_COLUMNS = ["PRICE", "PROPOSITION", "USER_CLIENT_NUMBER", "USER_SESSION_ID", "PROMOTION_LABEL",
+                         "PAGE_SECTION", "PROMOTION_PRICE", "DEVICE_INFO_BRAND", "DEVICE_INFO_TYPE",
+                         "DEVICE_INFO_BROWSER", "USER_SALES_GROUP", "USER_SEGMENT", "USER_SALES_DISTRICT",
+                         "USER_PROMOTIONS_ALLOWED"] + weather_feature_columns(4) + [
+                         "total_spend_on_category_product", "total_spend_on_product", "day_of_week"]
+
+# the columns that are set to the same value for every row before predicting
+FIXED_FEATURE_VALUES = {
+    "PROMOTION_PRICE": 0,
+    "PROMOTION_LABEL": 0,
+    "PAGE_NAME": 0,
+    "PAGE_SECTION": 0,
+    "USER_PROMOTIONS_ALLOWED": 0,
+}
+
 class RewardPredictor():
-    def __init__(self, model_location="models/reward_predictor_model_weather_0.pkl"):
+    def __init__(self, model_location="models/reward_predictor_model_weather_0.pkl", weather_store=None, model=None):
+        """
+        :param model_location: the pickled model or the exported .forest folder
+        :param weather_store: optional WeatherFeatureStore or the path of a saved one. The weather features of events
+        without weather columns are looked up in it
+        :param model: optional model that is already loaded, for example a CompactForest in shared memory. The
+        encoder is still loaded from next to the model location
+        """
         self.model_location = model_location
-        self.model = self.load_model(model_location)
+        self.model = model if model is not None else self.load_model(model_location)
+        self.encoder = self.load_encoder(model_location)
+        if isinstance(weather_store, str):
+            weather_store = WeatherFeatureStore.load(weather_store)
+        self.weather_store = weather_store
 
     def load_model(self, model_location):
         """
-        loads the model from the model location
+        loads the model from the model location. A .forest folder that was exported with compact_forest.py is memory
+        mapped instead of unpickled
         :return: RandomForestPredictor model
         """
+        if model_location.rstrip("/").endswith(COMPACT_FOREST_EXTENSION):
+            return CompactForest(model_location)
         with open(model_location, "rb") as pickle_file:
             return pickle.load(pickle_file)
 
+    def shared_arrays(self):
+        """
+        The arrays of the model and of the weather store, to put in shared memory with shared_tables.SharedArrays so
+        the workers of a pool do not each hold a copy. A pickled forest is flattened into a CompactForest, which
+        predicts the same rewards
+        :return: dict with the CompactForest arrays under "model" and the weather store arrays under "weather"
+        """
+        model = self.model if isinstance(self.model, CompactForest) else CompactForest.from_model(self.model)
+        arrays = {"model": model.shared_arrays()}
+        if self.weather_store is not None:
+            arrays["weather"] = self.weather_store.shared_arrays()
+        return arrays
+
+    @classmethod
+    def from_shared_arrays(cls, model_location, arrays):
+        """
+        :param model_location: the location of the model, the encoder is loaded from next to it
+        :param arrays: dict returned by shared_arrays, attached with shared_tables.attach_arrays
+        :return: RewardPredictor on the shared model and weather arrays
+        """
+        weather_store = WeatherFeatureStore.from_shared_arrays(arrays["weather"]) if "weather" in arrays else None
+        return cls(model_location, weather_store=weather_store,
+                   model=CompactForest.from_shared_arrays(arrays["model"]))
+
+    def load_encoder(self, model_location):
+        """
+        loads the categorical encoder that was saved next to the model by randomForestModelCreatorWeather.ipynb
+        :return: CategoricalEncoder, or None if the model has no encoder
+        """
+        encoder_location = CategoricalEncoder.encoder_path_for_model(model_location)
+        if not os.path.exists(encoder_location):
+            print("No categorical encoder found at", encoder_location,
+                  "the category numbers are built from every table itself and may not match the training")
+            return None
+        return CategoricalEncoder.load(encoder_location)
+
     def predict_reward(self, features):
         """
         predicts the reward based on the features
@@ -26,80 +98,23 @@ class RewardPredictor():
         :param features: features to predict the reward
         :return: reward
         """
-        possible_features = ["PRICE", "PROPOSITION", "USER_CLIENT_NUMBER", "USER_SESSION_ID", "PROMOTION_LABEL",  "PAGE_SECTION", "PAGE_SECTION_POSITION", "PROMOTION_PRICE", "PRODUCT_TYPE", "DEVICE_INFO_BRAND", "DEVICE_INFO_TYPE", "DEVICE_INFO_BROWSER", "USER_SALES_GROUP", "USER_SEGMENT", "USER_SALES_DISTRICT", "USER_PROMOTIONS_ALLOWED"]
-        possible_features = [
-                            "PRICE",
-                            "PROPOSITION",
-                            "USER_CLIENT_NUMBER",
-                            "USER_SESSION_ID",
-            "PROMOTION_LABEL",
-            "PROMOTION_PRICE",
-            "PAGE_SECTION"
-            "PAGE_NAME",
-                            "PAGE_SECTION_POSITION",
-
-                            "PAGE_SECTION",
-
-                            "DEVICE_INFO_BRAND",
-                            "DEVICE_INFO_TYPE",
-                            "DEVICE_INFO_BROWSER",
-                            "USER_SALES_GROUP",
-                            "USER_SEGMENT",
-                            "USER_SALES_DISTRICT",
-                            "USER_PROMOTIONS_ALLOWED",
-                            "temperature",
-                            "precipcover",
-                            "precip",
-                            "temperature_lead_1",
-                            "precipitation_coverage_lead_1",
-                            "precipitation_amount_lead_1",
-                            "temperature_lead_2",
-                            "precipitation_coverage_lead_2",
-                            "precipitation_amount_lead_2",
-                            "temperature_lead_3",
-                            "precipitation_coverage_lead_3",
-                            "precipitation_amount_lead_3",
-                            "temperature_lead_4",
-                            "precipitation_coverage_lead_4",
-                            "precipitation_amount_lead_4",
-                            "total_spend_on_category_product",
-                            "total_spend_on_product",
-                            "day_of_week",
-
-                        ]
-
-        possible_features = ['PRICE', 'PROPOSITION', 'USER_CLIENT_NUMBER', 'USER_SESSION_ID',
-       'PROMOTION_LABEL', 'PAGE_SECTION', 'PROMOTION_PRICE',
-       'DEVICE_INFO_BRAND', 'DEVICE_INFO_TYPE', 'DEVICE_INFO_BROWSER',
-       'USER_SALES_GROUP', 'USER_SEGMENT', 'USER_SALES_DISTRICT',
-       'USER_PROMOTIONS_ALLOWED', 'temperature', 'precipcover', 'precip',
-       'temperature_lead_1', 'precipitation_coverage_lead_1',
-       'precipitation_amount_lead_1', 'temperature_lead_2',
-       'precipitation_coverage_lead_2', 'precipitation_amount_lead_2',
-       'temperature_lead_3', 'precipitation_coverage_lead_3',
-       'precipitation_amount_lead_3', 'temperature_lead_4',
-       'precipitation_coverage_lead_4', 'precipitation_amount_lead_4',
-       'total_spend_on_category_product', 'total_spend_on_product',
-       'day_of_week']
-
-        features["PROMOTION_PRICE"] = 0
-        features["PROMOTION_LABEL"] = 0
-        features["PAGE_NAME"] = 0
-        features["PAGE_SECTION"] = 0
-
-        features["USER_PROMOTIONS_ALLOWED"] = 0
+        with timed_stage("feature_frame", rows=len(features)):
+            feature_frame = self.build_feature_frame(features)
+        with timed_stage("predict", rows=len(features)):
+            return self.model.predict(feature_frame)
+
+    def build_feature_frame(self, features):
+        """
+        builds the columns the model predicts with from the features. The features table itself is not changed
+        :param features: features to predict the reward
+        :return: table with the model features in the order of training
+        """
+        features = features.copy()
+        for column, value in FIXED_FEATURE_VALUES.items():
+            features[column] = value
         features["DATE"] = pd.to_datetime(features["DATE"])
         features["day_of_week"] = features["DATE"].dt.dayofweek
-
-
-
-
-        #features_to_predict_with = [feature for feature in features if feature in possible_features]
-
-        features_to_predict_with = features[possible_features]
-        #print(features_to_predict_with["PRICE"])
-        #features_to_predict_with["PRICE"] = float(features_to_predict_with["PRICE"])
-        return self.model.predict(features_to_predict_with)
+        return features[MODEL_FEATURE_COLUMNS]
 
     def predict_ranking_complete_dataset(self):
         """
@@ -118,15 +133,18 @@ class RewardPredictor():
                 continue
             rewards[folder] = {}
             for file in os.listdir("benchmark_data/" + folder):
-                if ".DS_Store" in folder:
+                if ".DS_Store" in file:
                     continue
                 rewards[folder][file] = 0
                 print("benchmark_data/" + folder + "/" + file)
-                if folder == "benchmark_top_sold_products":
-                    df = pd.read_csv("benchmark_data/" + folder + "/" + file, sep=",")
+                if file.endswith(ParquetTableStorage.extension):
+                    df = ParquetTableStorage().read("benchmark_data/" + folder + "/" + file)
+
+                elif folder == "benchmark_top_sold_products":
+                    df = CsvTableStorage(sep=",").read("benchmark_data/" + folder + "/" + file)
 
                 else:
-                    df = pd.read_csv("benchmark_data/" + folder + "/" + file, sep="|")
+                    df = CsvTableStorage(sep="|").read("benchmark_data/" + folder + "/" + file)
                 transformed_df = self.preprocessing_data(df)
                 reward = self.predict_reward(transformed_df)
                 rewards[folder][file] += reward
@@ -148,11 +166,18 @@ class RewardPredictor():
 
     def preprocessing_data(self, event_data_to_analyze):
         """
-        preprocesses the data
+        preprocesses the data. The weather features are added from the weather store when they are missing and the
+        categorical columns get the category numbers of the encoder of the model, values the model was not trained on
+        get the unknown value of the encoder
         :param features: features to preprocess
         :return: preprocessed features
         """
+        if self.weather_store is not None and not set(weather_feature_columns(self.weather_store.leads)).issubset(
+                event_data_to_analyze.columns):
+            event_data_to_analyze = self.weather_store.attach(event_data_to_analyze)
 
+        if self.encoder is not None:
+            return self.encoder.transform(event_data_to_analyze)
 
         # Replace categorical values using map
         transformation_dict = self.data_events_to_categories_dict_creation(event_data_to_analyze)
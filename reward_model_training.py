@@ -0,0 +1,335 @@
+import datetime
+import json
+import os
+import pickle
+import time
+from contextlib import closing
+from multiprocessing import Pool
+
+import numpy as np
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.preprocessing import StandardScaler
+
+from category_encoder import CategoricalEncoder, TRAINING_CATEGORICAL_COLUMNS
+from compact_forest import compact_forest_path_for_model, export_forest
+from process_client_tree import available_processes
+from rewardRandomForest import RewardPredictor
+from table_schema import fill_missing
+from table_storage import get_table_storage_for_file
+from weather_features import WeatherFeatureStore
+
+# the forest parameters of the no_parameters_tuning_custom_parameters option of randomForestModelCreatorWeather.ipynb,
+# every chunk adds trees_per_chunk of these trees to the forest
+DEFAULT_FOREST_PARAMETERS = {
+    "max_depth": 68,
+    "min_samples_split": 2,
+    "min_samples_leaf": 3,
+    "max_features": "sqrt",
+    "bootstrap": False,
+}
+
+# the feature builder of a worker process, it is set once per process by init_training_worker
+worker_feature_builder = None
+
+
+class TrainingFeatureBuilder(RewardPredictor):
+    """
+    The feature code path of RewardPredictor without a model: the chunks of the training data get their weather
+    features, category numbers and feature columns exactly like the rows RewardPredictor scores later.
+    """
+
+    def __init__(self, encoder, weather_store=None):
+        """
+        :param encoder: the fitted CategoricalEncoder that is saved next to the model
+        :param weather_store: optional WeatherFeatureStore or the path of a saved one
+        """
+        self.model_location = None
+        self.model = None
+        self.encoder = encoder
+        if isinstance(weather_store, str):
+            weather_store = WeatherFeatureStore.load(weather_store)
+        self.weather_store = weather_store
+
+    def training_data(self, chunk, target_column="purchases_7_day_after", binary_target=True):
+        """
+        :param chunk: a chunk of the processed events
+        :param target_column: the column with the number of purchases after the event
+        :param binary_target: if True, the target is 1 when there were purchases, like purchased_7_days_after_binary
+        :return: tuple of the feature table and the target array. Missing feature values are 0, like the
+        fillna(0) of the training notebook, also in the categorical columns
+        """
+        features = fill_missing(self.build_feature_frame(self.preprocessing_data(chunk)))
+        target = chunk[target_column].to_numpy(dtype=np.float64)
+        if binary_target:
+            target = (target > 0).astype(np.float64)
+        return features, target
+
+
+def init_training_worker(encoder, weather_store_path):
+    """
+    sets up the feature builder once per worker process
+    :param encoder: the fitted CategoricalEncoder
+    :param weather_store_path: optional path of a saved WeatherFeatureStore
+    """
+    global worker_feature_builder
+    worker_feature_builder = TrainingFeatureBuilder(encoder, weather_store_path)
+
+
+def fit_chunk_forest_task(task):
+    """
+    Fits the trees of one chunk
+    :param task: tuple of (chunk, chunk number, target column, binary target, forest parameters)
+    :return: tuple of (chunk number, fitted RandomForestRegressor, number of rows, wall time)
+    """
+    chunk, chunk_number, target_column, binary_target, forest_parameters = task
+    start_time = time.perf_counter()
+    features, target = worker_feature_builder.training_data(chunk, target_column, binary_target)
+    forest = RandomForestRegressor(n_jobs=1, **forest_parameters).fit(features, target)
+    return chunk_number, forest, len(target), time.perf_counter() - start_time
+
+
+def merge_forests(forests):
+    """
+    Merges forests that were fitted on different chunks into one forest. A random forest predicts the mean of its
+    trees, so the merged forest predicts the mean of all trees of all chunks
+    :param forests: fitted RandomForestRegressors with the same features
+    :return: RandomForestRegressor with the trees of all forests
+    """
+    merged_forest = RandomForestRegressor(**forests[0].get_params())
+    merged_forest.estimators_ = [tree for forest in forests for tree in forest.estimators_]
+    merged_forest.n_estimators = len(merged_forest.estimators_)
+    merged_forest.estimator_ = forests[0].estimator_
+    merged_forest.n_features_in_ = forests[0].n_features_in_
+    merged_forest.feature_names_in_ = forests[0].feature_names_in_
+    merged_forest.n_outputs_ = forests[0].n_outputs_
+    return merged_forest
+
+
+class ScaledIncrementalRegressor:
+    """
+    Standardizes the features before they reach a learner with partial_fit, like SGDRegressor, which does not
+    converge on the unscaled prices, ids and spend columns. The scaler is updated with every chunk before the
+    learner is, so the scale is the running scale of the chunks seen so far.
+    """
+
+    def __init__(self, learner):
+        """
+        :param learner: an estimator with partial_fit and predict
+        """
+        self.learner = learner
+        self.scaler = StandardScaler()
+
+    def partial_fit(self, features, target):
+        """
+        updates the scaler and the learner with one chunk
+        :return: the regressor
+        """
+        self.scaler.partial_fit(features)
+        self.learner.partial_fit(self.scaler.transform(features), target)
+        return self
+
+    def predict(self, features):
+        """
+        :return: the predictions of the learner on the scaled features
+        """
+        return self.learner.predict(self.scaler.transform(features))
+
+    @property
+    def feature_names_in_(self):
+        return self.scaler.feature_names_in_
+
+
+def next_model_version(models_folder="models", model_name="reward_predictor_model_chunked"):
+    """
+    :return: the first version number without a model in the models folder
+    """
+    version = 0
+    while os.path.exists(os.path.join(models_folder, f"{model_name}_{version}.pkl")):
+        version += 1
+    return version
+
+
+class ChunkedRewardModelTrainer:
+    """
+    Trains the reward model on the full processed events instead of a sample. The events are read in chunks and
+    every chunk gets its features from the code path of RewardPredictor, so training and scoring can not drift.
+
+    With the forest learner the trees of every chunk are fitted in a worker process and the trees of all chunks are
+    merged into one forest, the model RewardPredictor loads. Only a few chunks are in memory at a time. Any learner
+    with partial_fit can be given instead, it is trained on the chunks one after the other. Wrap learners that need
+    scaled features, like SGDRegressor, in a ScaledIncrementalRegressor.
+
+    The categorical encoder is fitted on all chunks in a first pass that only reads the categorical columns, and
+    saved next to the model with a json file that records how the model was trained.
+    """
+
+    def __init__(self, events_path="processed_data/processed_events_final.csv", chunk_size=1_000_000,
+                 learner="forest", trees_per_chunk=8, forest_parameters=None, target_column="purchases_7_day_after",
+                 binary_target=True, weather_store_path=None, seed=42):
+        """
+        :param events_path: the processed events, csv or parquet
+        :param chunk_size: the number of rows per chunk
+        :param learner: "forest" for the merged per chunk forests, or an estimator with partial_fit
+        :param trees_per_chunk: the number of trees that are fitted on every chunk
+        :param forest_parameters: parameters of the trees, by default DEFAULT_FOREST_PARAMETERS
+        :param target_column: the column with the number of purchases after the event
+        :param binary_target: if True, the target is 1 when there were purchases
+        :param weather_store_path: optional saved WeatherFeatureStore for events without weather columns
+        :param seed: the random_state of the trees of chunk n is seed + n
+        """
+        self.events_path = events_path
+        self.chunk_size = chunk_size
+        self.learner = learner
+        self.trees_per_chunk = trees_per_chunk
+        self.forest_parameters = dict(DEFAULT_FOREST_PARAMETERS if forest_parameters is None else forest_parameters)
+        self.target_column = target_column
+        self.binary_target = binary_target
+        self.weather_store_path = weather_store_path
+        self.seed = seed
+        self.storage = get_table_storage_for_file(events_path)
+        self.encoder = None
+        self.training_summary = {}
+
+    def read_chunks(self, columns=None):
+        """
+        :return: iterator over the chunks of the events
+        """
+        return self.storage.read_chunks(self.events_path, chunk_size=self.chunk_size, columns=columns)
+
+    def fit_encoder(self):
+        """
+        fits the categorical encoder on all chunks, reading only the categorical columns
+        :return: the fitted CategoricalEncoder
+        """
+        # only the first chunk is read, the reader is closed so the file is not left open
+        with closing(self.storage.read_chunks(self.events_path, chunk_size=1)) as first_chunks:
+            event_columns = next(iter(first_chunks)).columns
+        categorical_columns = [column for column in TRAINING_CATEGORICAL_COLUMNS if column in event_columns]
+        self.encoder = CategoricalEncoder()
+        for chunk in self.read_chunks(columns=categorical_columns):
+            self.encoder.partial_fit(chunk, categorical_columns)
+        return self.encoder
+
+    def train(self, processes=None, max_chunks_in_flight=None):
+        """
+        trains the model on all chunks of the events
+        :param processes: number of worker processes of the forest learner, by default the available cores
+        :param max_chunks_in_flight: the maximum number of chunks that are read but not fitted yet, by default two
+        per process
+        :return: the trained model
+        """
+        start_time = time.perf_counter()
+        if self.encoder is None:
+            self.fit_encoder()
+        print(f"Fitted the categorical encoder in {time.perf_counter() - start_time:.2f}s")
+
+        if self.learner == "forest":
+            model, rows, chunks = self.train_forest(processes, max_chunks_in_flight)
+        else:
+            model, rows, chunks = self.train_incremental()
+
+        self.training_summary = {
+            "events_path": self.events_path,
+            "rows": rows,
+            "chunks": chunks,
+            "chunk_size": self.chunk_size,
+            "learner": "forest" if self.learner == "forest" else type(getattr(self.learner, "learner",
+                                                                               self.learner)).__name__,
+            "trees": len(model.estimators_) if self.learner == "forest" else None,
+            "forest_parameters": self.forest_parameters if self.learner == "forest" else None,
+            "target_column": self.target_column,
+            "binary_target": self.binary_target,
+            "feature_names": [str(name) for name in model.feature_names_in_],
+            "training_seconds": round(time.perf_counter() - start_time, 2),
+        }
+        print(f"Trained on {rows} rows in {chunks} chunks in {self.training_summary['training_seconds']}s")
+        return model
+
+    def train_forest(self, processes=None, max_chunks_in_flight=None):
+        """
+        fits the trees of every chunk in the worker processes and merges them
+        :return: tuple of (merged forest, number of rows, number of chunks)
+        """
+        processes = processes or available_processes()
+        max_chunks_in_flight = max_chunks_in_flight or 2 * processes
+
+        chunk_forests = {}
+        rows = 0
+        with Pool(processes=processes, initializer=init_training_worker,
+                  initargs=(self.encoder, self.weather_store_path)) as pool:
+            in_flight = []
+            for chunk_number, chunk in enumerate(self.read_chunks()):
+                forest_parameters = dict(self.forest_parameters, n_estimators=self.trees_per_chunk,
+                                         random_state=self.seed + chunk_number)
+                in_flight.append(pool.apply_async(fit_chunk_forest_task, ((
+                    chunk, chunk_number, self.target_column, self.binary_target, forest_parameters),)))
+                # the reading waits for the oldest chunk, so only max_chunks_in_flight chunks are in memory
+                while len(in_flight) >= max_chunks_in_flight:
+                    rows += self.collect_chunk_forest(in_flight.pop(0), chunk_forests)
+            while in_flight:
+                rows += self.collect_chunk_forest(in_flight.pop(0), chunk_forests)
+
+        # the trees are merged in chunk order, so the model does not depend on the order the workers finish in
+        return merge_forests([chunk_forests[number] for number in sorted(chunk_forests)]), rows, len(chunk_forests)
+
+    @staticmethod
+    def collect_chunk_forest(async_result, chunk_forests):
+        """
+        waits for the forest of a chunk
+        :return: the number of rows of the chunk
+        """
+        chunk_number, forest, chunk_rows, wall_time = async_result.get()
+        chunk_forests[chunk_number] = forest
+        print(f"Fitted chunk {chunk_number}: {chunk_rows} rows in {wall_time:.2f}s")
+        return chunk_rows
+
+    def train_incremental(self):
+        """
+        trains the partial_fit learner on the chunks one after the other
+        :return: tuple of (learner, number of rows, number of chunks)
+        """
+        feature_builder = TrainingFeatureBuilder(self.encoder, self.weather_store_path)
+        rows = 0
+        chunks = 0
+        for chunks, chunk in enumerate(self.read_chunks(), start=1):
+            features, target = feature_builder.training_data(chunk, self.target_column, self.binary_target)
+            self.learner.partial_fit(features, target)
+            rows += len(target)
+        return self.learner, rows, chunks
+
+    def save(self, model, models_folder="models", model_name="reward_predictor_model_chunked", version=None,
+             export_compact=False):
+        """
+        writes the model as the next version in the models folder, with its encoder and a json file with the
+        training summary next to it
+        :param model: the trained model
+        :param models_folder: the models folder
+        :param model_name: the name of the model files
+        :param version: the version number, by default the first free one
+        :param export_compact: if True, the forest is also exported as a memory mapped .forest folder
+        :return: the location of the model, to pass to RewardPredictor(model_location=...)
+        """
+        if version is None:
+            version = next_model_version(models_folder, model_name)
+        os.makedirs(models_folder, exist_ok=True)
+        model_location = os.path.join(models_folder, f"{model_name}_{version}.pkl")
+        with open(model_location, "wb") as file:
+            pickle.dump(model, file)
+        self.encoder.save(CategoricalEncoder.encoder_path_for_model(model_location))
+
+        training_summary = dict(self.training_summary, version=version,
+                                created=datetime.datetime.now().isoformat(timespec="seconds"))
+        with open(os.path.splitext(model_location)[0] + ".training.json", "w") as file:
+            json.dump(training_summary, file, indent=2)
+
+        if export_compact and self.learner == "forest":
+            # the .forest folder shares the encoder of the pickle, they have the same name without extension
+            export_forest(model, compact_forest_path_for_model(model_location))
+        print("Saved model: ", model_location)
+        return model_location
+
+
+if __name__ == "__main__":
+    trainer = ChunkedRewardModelTrainer("processed_data/processed_events_final.csv")
+    reward_model = trainer.train()
+    trainer.save(reward_model, export_compact=True)
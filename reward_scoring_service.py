@@ -0,0 +1,390 @@
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from multiprocessing.connection import Client as ConnectionClient
+from multiprocessing.connection import Listener
+
+import numpy as np
+import pandas as pd
+
+from rewardRandomForest import RewardPredictor
+from table_storage import CsvTableStorage
+
+# the columns that differ per candidate, every other column describes the session
+CANDIDATE_COLUMNS = ["PROPOSITION", "PRICE", "ARTICLE_CATEGORIE", "PAGE_SECTION_POSITION",
+                     "total_spend_on_category_product", "total_spend_on_product"]
+
+
+class LRUScoreCache:
+    """
+    Least recently used cache of the scores of (session context, proposition, position) tuples
+    """
+
+    def __init__(self, max_size=100_000):
+        self.max_size = max_size
+        self.scores = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        :return: the cached score, or None if the key is not in the cache
+        """
+        with self.lock:
+            score = self.scores.get(key)
+            if score is None:
+                self.misses += 1
+                return None
+            self.scores.move_to_end(key)
+            self.hits += 1
+            return score
+
+    def put(self, key, score):
+        with self.lock:
+            self.scores[key] = score
+            self.scores.move_to_end(key)
+            while len(self.scores) > self.max_size:
+                self.scores.popitem(last=False)
+
+
+class RewardScoringService:
+    """
+    Long lived scorer around RewardPredictor. The model is loaded once, concurrent requests are coalesced into a
+    single model.predict call and the scores of repeated (session context, proposition, position) tuples are
+    served from an LRU cache.
+
+    A request is a session context (dict with the session columns, for example USER_CLIENT_NUMBER, DATE, the device
+    and weather columns) and a list of candidates. A candidate is a PROPOSITION id or a dict with the candidate
+    columns (PROPOSITION, PRICE, ARTICLE_CATEGORIE, ...). The columns of a bare PROPOSITION id come from the
+    catalogue. The position of a candidate in the list is its PAGE_SECTION_POSITION, starting at 1, unless the
+    candidate sets it itself.
+
+    The model needs its fitted CategoricalEncoder, so the category numbers of a request do not depend on the other
+    requests it is coalesced with. A request that can not be scored only fails its own future.
+    """
+
+    def __init__(self, model_location="models/reward_predictor_model_weather_0.pkl", reward_predictor=None,
+                 catalogue=None, cache_size=100_000, max_batch_rows=8192, max_wait_seconds=0.002):
+        """
+        :param model_location: the model to load, when no reward_predictor is given
+        :param reward_predictor: an already loaded RewardPredictor, it must have the categorical encoder of the model
+        :param catalogue: optional table with a row per PROPOSITION and candidate columns like PRICE and
+        ARTICLE_CATEGORIE. Spend columns that are not in the catalogue are 0
+        :param cache_size: the maximum number of cached scores
+        :param max_batch_rows: the maximum number of rows in one model.predict call
+        :param max_wait_seconds: how long the batcher waits for more requests to coalesce with the first one
+        """
+        self.reward_predictor = reward_predictor if reward_predictor is not None else RewardPredictor(model_location)
+        if self.reward_predictor.encoder is None:
+            raise ValueError("The reward scoring service needs the categorical encoder of the model, save it next to "
+                             "the model with CategoricalEncoder.save. Without it the category numbers, and so the "
+                             "cached scores, depend on the requests that are scored together")
+        self.catalogue = {}
+        if catalogue is not None:
+            catalogue_columns = [column for column in CANDIDATE_COLUMNS if column in catalogue.columns]
+            catalogue_rows = catalogue[catalogue_columns].drop_duplicates("PROPOSITION").to_dict("records")
+            self.catalogue = {row["PROPOSITION"]: row for row in catalogue_rows}
+        self.cache = LRUScoreCache(cache_size)
+        self.max_batch_rows = max_batch_rows
+        self.max_wait_seconds = max_wait_seconds
+        self.requests = queue.Queue()
+        self.batcher = None
+        self.stopped = threading.Event()
+        self.predict_calls = 0
+
+    def start(self):
+        """
+        starts the background thread that coalesces the requests
+        :return: the service
+        """
+        if self.batcher is None:
+            self.stopped.clear()
+            self.batcher = threading.Thread(target=self.run_batcher, daemon=True)
+            self.batcher.start()
+        return self
+
+    def stop(self):
+        """
+        stops the background thread after the queued requests are scored
+        :return:
+        """
+        if self.batcher is not None:
+            self.stopped.set()
+            self.requests.put(None)
+            self.batcher.join()
+            self.batcher = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def score(self, session_context, candidates):
+        """
+        scores the candidates for one session. Blocks until the batch the request was coalesced into is scored
+        :param session_context: dict with the session columns
+        :param candidates: list of PROPOSITION ids or dicts with the candidate columns
+        :return: numpy array with a score per candidate
+        """
+        return self.submit(session_context, candidates).result()
+
+    def score_batch(self, requests):
+        """
+        scores a micro-batch of requests
+        :param requests: list of (session_context, candidates) tuples
+        :return: list with a numpy array of scores per request
+        """
+        futures = [self.submit(session_context, candidates) for session_context, candidates in requests]
+        return [future.result() for future in futures]
+
+    def submit(self, session_context, candidates):
+        """
+        queues a request for the batcher
+        :return: Future with the numpy array of scores
+        """
+        future = Future()
+        rows = self.candidate_rows(session_context, candidates)
+        keys = [self.cache_key(session_context, row) for row in rows]
+        cached_scores = [self.cache.get(key) for key in keys]
+        if all(score is not None for score in cached_scores):
+            future.set_result(np.array(cached_scores, dtype=np.float64))
+            return future
+
+        if self.batcher is None:
+            self.start()
+        self.requests.put((session_context, rows, keys, cached_scores, future))
+        return future
+
+    def candidate_rows(self, session_context, candidates):
+        """
+        :return: a dict with the candidate columns per candidate, with the position filled in
+        """
+        rows = []
+        for position, candidate in enumerate(candidates, start=1):
+            if isinstance(candidate, dict):
+                row = dict(candidate)
+            else:
+                row = dict(self.catalogue.get(candidate, {"PROPOSITION": candidate}))
+                row.setdefault("total_spend_on_category_product", 0.0)
+                row.setdefault("total_spend_on_product", 0.0)
+            row.setdefault("PAGE_SECTION_POSITION", position)
+            rows.append(row)
+        return rows
+
+    @staticmethod
+    def cache_key(session_context, row):
+        """
+        :return: hashable key of the session context and the candidate, including its position
+        """
+        return tuple(sorted(session_context.items())), tuple(sorted(row.items()))
+
+    def run_batcher(self):
+        """
+        takes the first queued request, waits up to max_wait_seconds for more requests and scores all of the rows
+        that are not cached in a single model.predict call
+        """
+        while not self.stopped.is_set() or not self.requests.empty():
+            first_request = self.requests.get()
+            if first_request is None:
+                continue
+            batch = [first_request]
+            batch_rows = len(first_request[1])
+            deadline = time.perf_counter() + self.max_wait_seconds
+            while batch_rows < self.max_batch_rows:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if request is None:
+                    break
+                batch.append(request)
+                batch_rows += len(request[1])
+
+            try:
+                self.score_requests(batch)
+            except Exception as exception:
+                for request in batch:
+                    if not request[-1].done():
+                        request[-1].set_exception(exception)
+
+    def score_requests(self, batch):
+        """
+        scores the rows of the batch that are not cached and fills in the futures of the requests. Every request is
+        preprocessed on its own and the rows of all requests are predicted in one call. When that call fails the
+        requests are predicted one by one, so only the requests that can not be scored get the exception
+        :param batch: list of queued requests
+        :return:
+        """
+        scored_requests = []
+        request_frames = []
+        for request in batch:
+            session_context, rows, keys, cached_scores, future = request
+            try:
+                frame = pd.DataFrame([{**session_context, **row}
+                                      for row, cached_score in zip(rows, cached_scores) if cached_score is None])
+                request_frames.append(self.reward_predictor.preprocessing_data(frame))
+                scored_requests.append(request)
+            except Exception as exception:
+                future.set_exception(exception)
+        if not scored_requests:
+            return
+
+        try:
+            predicted_scores = self.predict(pd.concat(request_frames, ignore_index=True))
+            request_scores = np.split(predicted_scores, np.cumsum([len(frame) for frame in request_frames])[:-1])
+        except Exception:
+            request_scores = []
+            for request, frame in zip(scored_requests, request_frames):
+                try:
+                    request_scores.append(self.predict(frame))
+                except Exception as exception:
+                    request[-1].set_exception(exception)
+                    request_scores.append(None)
+
+        for (session_context, rows, keys, cached_scores, future), predicted_scores in zip(scored_requests,
+                                                                                          request_scores):
+            if predicted_scores is None:
+                continue
+            scores = np.empty(len(rows), dtype=np.float64)
+            predicted_index = 0
+            for index, (key, cached_score) in enumerate(zip(keys, cached_scores)):
+                if cached_score is None:
+                    scores[index] = predicted_scores[predicted_index]
+                    self.cache.put(key, scores[index])
+                    predicted_index += 1
+                else:
+                    scores[index] = cached_score
+            future.set_result(scores)
+
+    def predict(self, frame):
+        """
+        :param frame: preprocessed rows
+        :return: numpy array with the predicted reward of every row
+        """
+        predicted_scores = np.asarray(self.reward_predictor.predict_reward(frame), dtype=np.float64)
+        self.predict_calls += 1
+        return predicted_scores
+
+    def serve(self, address=("localhost", 6010), authkey=b"reward-scoring"):
+        """
+        serves score requests from other local processes. Every connection sends (session_context, candidates)
+        tuples and gets the scores back as a list, see RewardScoringClient
+        :param address: the address to listen on
+        :param authkey: the key the clients have to authenticate with
+        :return:
+        """
+        self.start()
+        with Listener(address, authkey=authkey) as listener:
+            print("Reward scoring service listening on", address)
+            while not self.stopped.is_set():
+                connection = listener.accept()
+                threading.Thread(target=self.handle_connection, args=(connection,), daemon=True).start()
+
+    def handle_connection(self, connection):
+        with connection:
+            while True:
+                try:
+                    session_context, candidates = connection.recv()
+                except EOFError:
+                    return
+                try:
+                    connection.send(self.score(session_context, candidates).tolist())
+                except Exception as exception:
+                    connection.send(exception)
+
+
+class RewardScoringClient:
+    """
+    Client for a RewardScoringService that runs in another local process with serve()
+    """
+
+    def __init__(self, address=("localhost", 6010), authkey=b"reward-scoring"):
+        self.connection = ConnectionClient(address, authkey=authkey)
+
+    def score(self, session_context, candidates):
+        """
+        :param session_context: dict with the session columns
+        :param candidates: list of PROPOSITION ids or dicts with the candidate columns
+        :return: list with a score per candidate
+        """
+        self.connection.send((session_context, candidates))
+        response = self.connection.recv()
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def close(self):
+        self.connection.close()
+
+
+def sessions_from_benchmark_file(benchmark_file, sep="|"):
+    """
+    splits a benchmark file in score requests, one per session
+    :param benchmark_file: one of the files in benchmark_data
+    :param sep: separator of the file
+    :return: list of (session_context, candidates) tuples
+    """
+    benchmark = CsvTableStorage(sep=sep).read(benchmark_file)
+    session_columns = [column for column in benchmark.columns if column not in CANDIDATE_COLUMNS]
+    requests = []
+    for _, session in benchmark.groupby("USER_SESSION_ID", sort=False):
+        session_context = session.iloc[0][session_columns].to_dict()
+        candidates = session[[column for column in CANDIDATE_COLUMNS if column in session.columns]]
+        requests.append((session_context, candidates.to_dict("records")))
+    return requests
+
+
+def benchmark_service(service, requests, concurrency=8, repeats=3):
+    """
+    Latency and throughput benchmark of the service. The requests are sent by concurrency threads, every request
+    is sent repeats times, so the later rounds measure the cache
+    :param service: a RewardScoringService
+    :param requests: list of (session_context, candidates) tuples, see sessions_from_benchmark_file
+    :param concurrency: number of threads that send requests at the same time
+    :param repeats: number of times every request is sent
+    :return: dict with the latency percentiles in milliseconds and the throughput in candidates per second
+    """
+    all_requests = requests * repeats
+    latencies = [0.0] * len(all_requests)
+
+    def send_requests(thread_index):
+        for index in range(thread_index, len(all_requests), concurrency):
+            session_context, candidates = all_requests[index]
+            start_time = time.perf_counter()
+            service.score(session_context, candidates)
+            latencies[index] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    threads = [threading.Thread(target=send_requests, args=(thread_index,)) for thread_index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_time = time.perf_counter() - start_time
+
+    latencies_ms = np.array(latencies) * 1000
+    scored_candidates = sum(len(candidates) for _, candidates in all_requests)
+    return {
+        "requests": len(all_requests),
+        "p50_latency_ms": float(np.percentile(latencies_ms, 50)),
+        "p99_latency_ms": float(np.percentile(latencies_ms, 99)),
+        "candidates_per_second": scored_candidates / wall_time,
+        "predict_calls": service.predict_calls,
+        "cache_hits": service.cache.hits,
+        "cache_misses": service.cache.misses,
+    }
+
+
+if __name__ == "__main__":
+    # benchmark of the service on the sessions of one of the benchmark files
+    benchmark_file = "benchmark_data/benchmark_bidfood_current_prediction_system/premium_product_line.csv"
+    benchmark_requests = sessions_from_benchmark_file(benchmark_file)
+    with RewardScoringService(catalogue=CsvTableStorage(sep="|").read(benchmark_file)) as scoring_service:
+        print(benchmark_service(scoring_service, benchmark_requests))
@@ -0,0 +1,116 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# the shared memory segments this process attached to, by segment name. They stay open as long as the process
+# uses the arrays in them
+attached_segments = {}
+
+
+class SharedArrays:
+    """
+    Puts read-only numpy arrays, like the lookup tables and the model arrays, in shared memory once, so the workers
+    of a pool attach to them by name instead of each unpickling or loading their own copy. Only the small
+    descriptors (segment name, shape and dtype of every array) are passed to the pool initializer, and the workers
+    map the same pages, so the memory of the tables does not grow with the number of workers.
+
+    The main process owns the segments and removes them when it leaves the with block, which has to be around the
+    pool:
+
+        with SharedArrays() as shared_arrays:
+            descriptors = shared_arrays.share(category_index.shared_arrays())
+            with Pool(initializer=init_worker, initargs=(descriptors,)) as pool:
+                ...
+    """
+
+    def __init__(self):
+        self.segments = []
+
+    def add(self, array):
+        """
+        copies an array into a new shared memory segment
+        :param array: numpy array, object arrays can not be shared, strings have to be a fixed width str dtype
+        :return: the descriptor of the array, see attach_array
+        """
+        array = np.asarray(array)
+        if array.dtype.hasobject:
+            raise ValueError("Arrays with python objects can not be put in shared memory, convert them to str first")
+        # a segment of 0 bytes can not be created
+        segment = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.segments.append(segment)
+        shared_array = np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)
+        shared_array[...] = array
+        del shared_array
+        return segment.name, array.shape, array.dtype.str
+
+    def share(self, arrays):
+        """
+        :param arrays: dict with numpy arrays, the values can also be dicts of arrays
+        :return: dict with the same keys and the descriptor of every array, see attach_arrays
+        """
+        if isinstance(arrays, dict):
+            return {name: self.share(value) for name, value in arrays.items()}
+        return self.add(arrays)
+
+    @property
+    def nbytes(self):
+        """
+        :return: the size of all segments in bytes
+        """
+        return sum(segment.size for segment in self.segments)
+
+    def close(self):
+        """
+        closes and removes all segments. The workers that are still attached keep their mapping until they exit
+        :return:
+        """
+        for segment in self.segments:
+            segment.close()
+            try:
+                segment.unlink()
+            except FileNotFoundError:
+                pass
+        self.segments = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def open_segment(segment_name):
+    """
+    :param segment_name: the name of an existing segment
+    :return: the SharedMemory of the segment, opened once per process
+    """
+    if segment_name not in attached_segments:
+        try:
+            # the segment is owned by the main process, the resource tracker of the worker should not remove it
+            segment = shared_memory.SharedMemory(name=segment_name, track=False)
+        except TypeError:
+            segment = shared_memory.SharedMemory(name=segment_name)
+        attached_segments[segment_name] = segment
+    return attached_segments[segment_name]
+
+
+def attach_array(descriptor):
+    """
+    :param descriptor: tuple of (segment name, shape, dtype) returned by SharedArrays.add
+    :return: read-only numpy array on the shared memory, nothing is copied
+    """
+    segment_name, shape, dtype = descriptor
+    array = np.ndarray(tuple(shape), dtype=np.dtype(dtype), buffer=open_segment(segment_name).buf)
+    array.flags.writeable = False
+    return array
+
+
+def attach_arrays(descriptors):
+    """
+    :param descriptors: dict returned by SharedArrays.share
+    :return: dict with the same keys and the attached arrays
+    """
+    if isinstance(descriptors, dict):
+        return {name: attach_arrays(value) for name, value in descriptors.items()}
+    return attach_array(descriptors)
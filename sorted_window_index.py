@@ -0,0 +1,351 @@
+import numpy as np
+import pandas as pd
+
+# np.sum adds up to this many values in 8 lanes, longer arrays are split in halves (pairwise summation)
+PAIRWISE_LANES = 8
+PAIRWISE_BLOCK_SIZE = 128
+
+
+def window_to_timedelta(window):
+    """
+    :param window: a number of days or a timedelta, for example 7, pd.Timedelta(hours=2) or "2h"
+    :return: the window as pd.Timedelta
+    """
+    if isinstance(window, (int, np.integer)):
+        return pd.Timedelta(days=int(window))
+    return pd.Timedelta(window)
+
+
+def window_label(window):
+    """
+    :param window: a number of days or a timedelta
+    :return: the label of the window for column names, for example 7_day, 2_hour or 90_minute
+    """
+    seconds = int(window_to_timedelta(window).total_seconds())
+    for unit_seconds, unit in ((86400, "day"), (3600, "hour"), (60, "minute")):
+        if seconds % unit_seconds == 0:
+            return f"{seconds // unit_seconds}_{unit}"
+    return f"{seconds}_second"
+
+
+def has_time_zone(dates):
+    """
+    :param dates: series with datetimes or dates as strings, of strings only the first date is parsed
+    :return: True if the dates have a time zone, like TIMESTAMP_EVENT (2022-02-09T14:11:05.550Z), or None if there
+    are no dates
+    """
+    dates = pd.Series(dates)
+    if pd.api.types.is_datetime64_any_dtype(dates.dtype):
+        return dates.dt.tz is not None
+    first_dates = dates.dropna().iloc[:1]
+    if len(first_dates) == 0:
+        return None
+    return pd.to_datetime(first_dates, format="ISO8601").dt.tz is not None
+
+
+class SortedWindowIndex:
+    """
+    Index over a table of dated rows (for example the purchases of a client) that counts, for a whole table of
+    query rows at once, how many indexed rows with the same key fall inside a date window around the query date.
+
+    The dates are parsed only once, the rows are sorted on (key, date) and every window is answered with two
+    np.searchsorted lookups instead of a boolean scan of the table per query row. The key and the date of the query
+    rows are looked up once for all of the requested windows and the bounds of all windows are searched in one
+    np.searchsorted call, so asking for more windows costs little extra.
+    With the default day resolution the dates are truncated to the day, like the string dates of the client tables.
+    With the second resolution the windows are exact timestamp intervals, for example "seen within 2 hours before
+    the purchase".
+    When a value column is given, the running sums of that column per key are kept in the same order, so the sum of
+    the values up to a date is answered with one np.searchsorted lookup and a few array lookups. The sums are added
+    in the same order as the .sum() of the rows of the key, so they are the same to the last digit.
+    """
+
+    def __init__(self, table, key_columns=("USER_CLIENT_NUMBER", "PROPOSITION"), date_column="DATE",
+                 value_column=None, resolution="D"):
+        """
+        :param table: the table with the rows to count, for example the purchases table of a client
+        :param key_columns: the columns a query row has to match on to be counted
+        :param date_column: the column with the date of the rows, for example 2024-11-18 or 2022-02-09T14:11:05.550Z
+        :param value_column: optional column to keep prefix sums of, for example AMOUNT
+        :param resolution: D to truncate the dates to the day, s to keep the timestamps to the second
+        """
+        if resolution not in ("D", "s"):
+            raise ValueError("resolution can only be D or s")
+        self.key_columns = list(key_columns)
+        self.date_column = date_column
+        self.value_column = value_column
+        self.resolution = resolution
+
+        days = self.dates_to_units(table[date_column], resolution)
+        valid_rows = ~np.isnat(days)
+        for key_column in self.key_columns:
+            valid_rows &= table[key_column].notna().to_numpy()
+
+        keys = pd.MultiIndex.from_frame(table.loc[valid_rows, self.key_columns])
+        self.key_index = keys.unique()
+        key_codes = self.key_index.get_indexer(keys).astype(np.int64)
+        days = days[valid_rows].astype(np.int64)
+
+        self.first_day = int(days.min()) if len(days) else 0
+        last_day = int(days.max()) if len(days) else 0
+        # every key gets a block of stride positions, one for every day (or second) between the first and the last
+        self.stride = last_day - self.first_day + 1
+        positions = key_codes * self.stride + (days - self.first_day)
+        sort_order = np.argsort(positions, kind="stable")
+        self.sorted_positions = positions[sort_order]
+
+        if value_column is not None:
+            self.sorted_values = table.loc[valid_rows, value_column].fillna(0).to_numpy(dtype=np.float64)[sort_order]
+            # index in sorted_positions of the first row of every key
+            self.key_starts = np.searchsorted(self.sorted_positions,
+                                              np.arange(len(self.key_index), dtype=np.int64) * self.stride)
+            # a cumsum over all keys would need a subtraction per key, which leaves rounding noise in the sums
+            # (113.39000000000004 instead of 113.39), so the running sums restart at every key
+            row_ranks = np.arange(len(self.sorted_values)) - self.key_starts[key_codes[sort_order]]
+            self.running_sums = self.key_running_sums(self.sorted_values, row_ranks, step=1)
+            self.lane_sums = self.key_running_sums(self.sorted_values, row_ranks, step=PAIRWISE_LANES)
+
+    @staticmethod
+    def key_running_sums(values, row_ranks, step=1):
+        """
+        Running sums within every key, the values are added one by one like a python loop would
+        :param values: the values sorted on (key, date)
+        :param row_ranks: the position of every row in its key
+        :param step: 1 for the sum of all rows of the key up to the row, 8 for the sum of every 8th row up to the row,
+        the lanes of np.sum
+        :return: array with the running sum of every row
+        """
+        running_sums = values.copy()
+        rank_order = np.argsort(row_ranks, kind="stable")
+        rank_bounds = np.searchsorted(row_ranks[rank_order],
+                                      np.arange(int(row_ranks.max()) + 2 if len(row_ranks) else 1))
+        # every step adds the running sum of the previous row (of the lane) of the key to the rows of one rank
+        for rank in range(step, len(rank_bounds) - 1):
+            rows = rank_order[rank_bounds[rank]:rank_bounds[rank + 1]]
+            running_sums[rows] += running_sums[rows - step]
+        return running_sums
+
+    def key_sums(self, starts, lengths):
+        """
+        The sums of the first rows of keys, added in the same order as np.sum and so the .sum() of pandas: fewer
+        than 8 values one by one, up to 128 values in 8 lanes that are added pairwise, and longer sums in halves
+        :param starts: the index of the first row of the key of every sum
+        :param lengths: the number of rows of every sum, at least 1
+        :return: array with every sum
+        """
+        sums = np.zeros(len(starts), dtype=np.float64)
+        short = lengths < PAIRWISE_LANES
+        sums[short] = self.running_sums[starts[short] + lengths[short] - 1]
+
+        block = (lengths >= PAIRWISE_LANES) & (lengths <= PAIRWISE_BLOCK_SIZE)
+        block_starts = starts[block]
+        block_lengths = lengths[block]
+        whole_lanes = block_lengths - block_lengths % PAIRWISE_LANES
+        lanes = self.lane_sums[(block_starts + whole_lanes - PAIRWISE_LANES)[:, None] + np.arange(PAIRWISE_LANES)]
+        block_sums = (((lanes[:, 0] + lanes[:, 1]) + (lanes[:, 2] + lanes[:, 3]))
+                      + ((lanes[:, 4] + lanes[:, 5]) + (lanes[:, 6] + lanes[:, 7])))
+        for extra in range(PAIRWISE_LANES - 1):
+            rest = whole_lanes + extra < block_lengths
+            block_sums[rest] += self.sorted_values[block_starts[rest] + whole_lanes[rest] + extra]
+        sums[block] = block_sums
+
+        # the few sums of more than 128 values are split in halves by np.sum itself, every distinct sum once
+        long_sums = np.flatnonzero(lengths > PAIRWISE_BLOCK_SIZE)
+        long_bounds, long_index = np.unique(np.stack((starts[long_sums], lengths[long_sums]), axis=1), axis=0,
+                                            return_inverse=True)
+        long_values = [self.sorted_values[start:start + length].sum() for start, length in long_bounds]
+        sums[long_sums] = np.asarray(long_values, dtype=np.float64)[long_index.ravel()]
+        return sums
+
+    @staticmethod
+    def dates_to_days(dates):
+        """
+        Parses the dates once and truncates them to the day
+        :param dates: series with dates as strings (2024-11-18) or datetimes
+        :return: numpy array of datetime64[D]
+        """
+        return SortedWindowIndex.dates_to_units(dates, "D")
+
+    @staticmethod
+    def dates_to_units(dates, resolution="D"):
+        """
+        Parses the dates once and truncates them to the resolution. Timestamps with a time zone, like the
+        TIMESTAMP_EVENT column, are converted to UTC first
+        :param dates: series with dates as strings (2024-11-18, 2022-02-09T14:11:05.550Z) or datetimes
+        :param resolution: D or s
+        :return: numpy array of datetime64 in the resolution
+        """
+        dates = pd.to_datetime(pd.Series(dates))
+        if dates.dt.tz is not None:
+            dates = dates.dt.tz_convert(None)
+        return dates.to_numpy().astype(f"datetime64[{resolution}]")
+
+    def window_units(self, window):
+        """
+        :param window: a number of days or a timedelta
+        :return: the length of the window in the resolution of the index
+        """
+        window_length = window_to_timedelta(window) / pd.Timedelta(1, unit=self.resolution)
+        if window_length != int(window_length):
+            raise ValueError(f"Window {window} is not a whole number of {self.resolution} units")
+        return int(window_length)
+
+    def count_after(self, query_table, date_ranges=(7, 30), query_date_column=None):
+        """
+        Counts for every row of the query table the indexed rows with the same key and a date from the query date
+        up to and including the query date plus the date range.
+        :param query_table: table with the key columns and the date column, for example the events table
+        :param date_ranges: the numbers of days or the timedeltas to look after the query date
+        :param query_date_column: the date column of the query table, by default the date column of the index
+        :return: dict with the date range as key and a numpy array with a count per query row as value
+        """
+        return self.count_in_windows(query_table, date_ranges, direction="after", query_date_column=query_date_column)
+
+    def count_before(self, query_table, date_ranges=(30, 7, 1), query_date_column=None):
+        """
+        Counts for every row of the query table the indexed rows with the same key and a date from the query date
+        minus the date range up to and including the query date.
+        :param query_table: table with the key columns and the date column, for example the purchases table
+        :param date_ranges: the numbers of days or the timedeltas to look back from the query date
+        :param query_date_column: the date column of the query table, by default the date column of the index
+        :return: dict with the date range as key and a numpy array with a count per query row as value
+        """
+        return self.count_in_windows(query_table, date_ranges, direction="before", query_date_column=query_date_column)
+
+    def count_in_windows(self, query_table, windows, direction="before", query_date_column=None):
+        """
+        Counts for every row of the query table and every window the indexed rows with the same key inside the
+        window. A window before the query date runs from the query date minus the window up to and including the
+        query date, a window after it from the query date up to and including the query date plus the window
+        :param query_table: table with the key columns and the date column
+        :param windows: the numbers of days or the timedeltas, for example (30, 7, pd.Timedelta(hours=2))
+        :param direction: before or after the query date
+        :param query_date_column: the date column of the query table, by default the date column of the index
+        :return: dict with the window as key and a numpy array with a count per query row as value
+        """
+        if direction not in ("before", "after"):
+            raise ValueError("direction can only be before or after")
+        windows = list(windows)
+        window_units = np.array([self.window_units(window) for window in windows], dtype=np.int64)
+        if direction == "before":
+            start_offsets, end_offsets = -window_units, np.zeros_like(window_units)
+        else:
+            start_offsets, end_offsets = np.zeros_like(window_units), window_units
+
+        counts = self._count_in_windows(query_table, start_offsets, end_offsets, query_date_column)
+        return {window: window_counts for window, window_counts in zip(windows, counts)}
+
+    def sum_until(self, query_table):
+        """
+        Sums the value column over the indexed rows with the same key and a date up to and including the query date
+        :param query_table: table with the key columns and the date column, for example the events table
+        :return: numpy array with a sum per query row
+        """
+        if self.value_column is None:
+            raise ValueError("the index has to be created with a value_column to sum over")
+
+        query_codes, query_days, valid_queries = self._query_positions(query_table, self.date_column)
+        sums = np.zeros(len(query_table), dtype=np.float64)
+        if not valid_queries.any():
+            return sums
+
+        query_codes = query_codes[valid_queries]
+        window_end = np.clip(query_days[valid_queries], -1, self.stride - 1)
+        last = np.searchsorted(self.sorted_positions, query_codes * self.stride + window_end, side="right")
+        starts = self.key_starts[query_codes]
+        # queries before the first row of their key sum to 0
+        has_rows = last > starts
+        sums[np.flatnonzero(valid_queries)[has_rows]] = self.key_sums(starts[has_rows], (last - starts)[has_rows])
+        return sums
+
+    def _count_in_windows(self, query_table, start_offsets, end_offsets, query_date_column=None):
+        """
+        Counts the indexed rows between query date + start_offset and query date + end_offset (both inclusive) for
+        every pair of offsets
+        :param query_table: table with the key columns and the date column
+        :param start_offsets: array with the first day (or second) of every window relative to the query date
+        :param end_offsets: array with the last day (or second) of every window relative to the query date
+        :param query_date_column: the date column of the query table, by default the date column of the index
+        :return: array with a row of counts per query row for every window
+        """
+        query_codes, query_days, valid_queries = self._query_positions(query_table,
+                                                                       query_date_column or self.date_column)
+        counts = np.zeros((len(start_offsets), len(query_table)), dtype=np.int64)
+        if not valid_queries.any():
+            return counts
+
+        # the query rows are sorted once on their position, so the bounds of every window are sorted as well and
+        # searchsorted walks through the index in order instead of jumping around
+        valid_rows = np.flatnonzero(valid_queries)
+        query_positions = query_codes[valid_rows] * self.stride + query_days[valid_rows]
+        sort_order = np.argsort(query_positions, kind="stable")
+        valid_rows = valid_rows[sort_order]
+        query_codes = query_codes[valid_rows]
+        query_days = query_days[valid_rows]
+        block_start = query_codes * self.stride
+
+        # the first position after the window end is the start of a window at end + 1, so every distinct offset is
+        # searched only once, the end of the windows before the query date for example is shared by all of them
+        bound_offsets, bound_index = np.unique(np.concatenate((start_offsets, end_offsets + 1)), return_inverse=True)
+        # clipping keeps every lookup inside the block of its own key
+        bounds = block_start + np.clip(query_days + bound_offsets[:, None], 0, self.stride)
+        bound_positions = np.searchsorted(self.sorted_positions, bounds.ravel(), side="left").reshape(bounds.shape)
+
+        first = bound_positions[bound_index[:len(start_offsets)]]
+        last = bound_positions[bound_index[len(start_offsets):]]
+        counts[:, valid_rows] = np.maximum(last - first, 0)
+        return counts
+
+    def _query_positions(self, query_table, query_date_column):
+        """
+        Looks up the key code and the day (or second) offset of every query row
+        :param query_table: table with the key columns and the date column
+        :param query_date_column: the date column of the query table
+        :return: key codes, offsets relative to the first indexed day (or second) and a mask of the rows that can
+        match
+        """
+        query_days = self.dates_to_units(query_table[query_date_column], self.resolution)
+        query_codes = self.key_index.get_indexer(pd.MultiIndex.from_frame(query_table[self.key_columns]))
+        valid_queries = (query_codes >= 0) & ~np.isnat(query_days)
+        query_days = np.where(valid_queries, query_days.astype(np.int64) - self.first_day, 0)
+        return query_codes.astype(np.int64), query_days, valid_queries
+
+
+def count_in_windows(table, query_table, windows, direction="before", timestamp_column=None,
+                     query_timestamp_column=None, key_columns=("USER_CLIENT_NUMBER", "PROPOSITION"), date_column="DATE"):
+    """
+    Counts for every query row the rows of the table with the same key in every window. Windows given as a number of
+    days compare the DATE columns by day, like the client tables always did. Windows given as a timedelta, for
+    example pd.Timedelta(hours=2), compare the timestamp columns to the second
+    :param table: the table with the rows to count
+    :param query_table: the table with a row per count
+    :param windows: the numbers of days and timedeltas, for example (30, 7, 1, pd.Timedelta(hours=2))
+    :param direction: before or after the query date
+    :param timestamp_column: the timestamp column of the table, needed for timedelta windows
+    :param query_timestamp_column: the timestamp column of the query table, needed for timedelta windows
+    :param key_columns: the columns a query row has to match on to be counted
+    :param date_column: the date column of both tables
+    :return: dict with the window as key and a numpy array with a count per query row as value
+    """
+    day_windows = [window for window in windows if isinstance(window, (int, np.integer))]
+    timestamp_windows = [window for window in windows if not isinstance(window, (int, np.integer))]
+    if len(table) == 0:
+        return {window: np.zeros(len(query_table), dtype=np.int64) for window in windows}
+
+    counts = {}
+    if day_windows:
+        day_index = SortedWindowIndex(table, key_columns=key_columns, date_column=date_column)
+        counts.update(day_index.count_in_windows(query_table, day_windows, direction=direction))
+    if timestamp_windows:
+        if timestamp_column is None or query_timestamp_column is None:
+            raise ValueError("windows shorter than a day need the timestamp columns of both tables")
+        time_zones = {has_time_zone(table[timestamp_column]), has_time_zone(query_table[query_timestamp_column])}
+        if time_zones == {True, False}:
+            # dates_to_units converts the timestamps with a time zone to UTC, naive timestamps would be taken as UTC
+            raise ValueError(f"{timestamp_column} and {query_timestamp_column} can only be compared when both or "
+                             f"neither have a time zone, localize the naive timestamps to their time zone first")
+        timestamp_index = SortedWindowIndex(table, key_columns=key_columns, date_column=timestamp_column,
+                                            resolution="s")
+        counts.update(timestamp_index.count_in_windows(query_table, timestamp_windows, direction=direction,
+                                                       query_date_column=query_timestamp_column))
+    return {window: counts[window] for window in windows}
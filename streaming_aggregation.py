@@ -0,0 +1,111 @@
+import os
+import shutil
+
+import pandas as pd
+
+from table_storage import CsvTableStorage, ParquetTableStorage, check_pyarrow_installed, get_table_storage_for_path
+
+
+def chunk_part_path(parts_folder, chunk_index, output_path):
+    """
+    :param parts_folder: the folder the workers write their parts to
+    :param chunk_index: the index of the chunk of clients
+    :param output_path: the aggregated output file, the part gets the same format
+    :return: path of the part of the chunk
+    """
+    extension = os.path.splitext(output_path)[1] or CsvTableStorage.extension
+    return os.path.join(parts_folder, f"part-{chunk_index:06d}{extension}")
+
+
+class CsvPartMerger:
+    """
+    Appends the csv parts of the workers to one csv output in chunk order. Parts with the same header as the first
+    part are copied byte for byte, so the parts are never loaded in memory
+    """
+
+    def __init__(self, output_path, sep="|"):
+        self.output_path = output_path
+        self.sep = sep
+        self.output_file = open(output_path, "wb")
+        self.header = None
+        self.columns = None
+
+    def append_part(self, part_path):
+        """
+        appends the rows of the part to the output
+        :param part_path: path of the csv part
+        :return:
+        """
+        with open(part_path, "rb") as part_file:
+            header = part_file.readline()
+            if self.header is None:
+                self.header = header
+                self.columns = header.decode().rstrip("\r\n").split(self.sep)
+                self.output_file.write(header)
+
+            if header == self.header:
+                shutil.copyfileobj(part_file, self.output_file)
+                return
+
+        # the clients in this part have other columns, so the rows are put in the columns of the first part
+        part = pd.read_csv(part_path, sep=self.sep)
+        dropped_columns = [column for column in part.columns if column not in self.columns]
+        if dropped_columns:
+            print("Dropping columns that are not in the first part: ", dropped_columns)
+        part.reindex(columns=self.columns).to_csv(self.output_file, sep=self.sep, index=False, header=False)
+
+    def close(self):
+        self.output_file.close()
+
+
+class ParquetPartMerger:
+    """
+    Appends the parquet parts of the workers to one parquet output in chunk order. Every part becomes a row group of
+    the output, so only one part is in memory at a time
+    """
+
+    def __init__(self, output_path):
+        check_pyarrow_installed()
+        self.output_path = output_path
+        self.writer = None
+
+    def append_part(self, part_path):
+        """
+        appends the rows of the part to the output as a row group
+        :param part_path: path of the parquet part
+        :return:
+        """
+        import pyarrow.parquet as pq
+
+        part = pq.read_table(part_path)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.output_path, part.schema)
+        elif not part.schema.equals(self.writer.schema):
+            # for example an integer column that has missing values in another chunk
+            part = part.select(self.writer.schema.names).cast(self.writer.schema)
+        self.writer.write_table(part)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def get_part_merger(output_path):
+    """
+    :param output_path: the aggregated output file
+    :return: the part merger for the format of the output file
+    """
+    if output_path.endswith(ParquetTableStorage.extension):
+        return ParquetPartMerger(output_path)
+    return CsvPartMerger(output_path)
+
+
+def write_part(table, part_path):
+    """
+    writes the table of one chunk of clients as a part
+    :param table: the concatenated table of the chunk
+    :param part_path: path of the part
+    :return: number of written rows
+    """
+    get_table_storage_for_path(part_path).write(table, part_path)
+    return len(table)
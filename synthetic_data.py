@@ -0,0 +1,314 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from table_storage import check_pyarrow_installed, get_table_storage
+from weather_features import DEFAULT_DISTRICT, WeatherFeatureStore
+
+# the values of the text columns, with the spelling of the real events
+PAGE_SECTIONS = ["Recommended Products", "Frequently Bought", "Promotions", "Search Results"]
+PAGE_NAMES = ["Home", "Assortment", "Promotions", "Search"]
+PRODUCT_TYPES = ["ARTICLE", "PROMOTION"]
+DEVICES = [
+    ("Apple Macintosh", "COMPUTER", "Safari 15.4"),
+    ("Unknown", "COMPUTER", "Chrome 100"),
+    ("Microsoft Windows", "COMPUTER", "Edge 100"),
+    ("Apple iPhone", "MOBILE", "Mobile Safari 15.4"),
+    ("Apple iPad", "TABLET", "Mobile Safari 15.4"),
+    ("Samsung", "MOBILE", "Chrome Mobile 100"),
+]
+# the category code of every device in the DEVICE_INFO columns
+DEVICE_COLUMN_CODES = {
+    column: (np.array([sorted({device[index] for device in DEVICES}).index(device[index]) for device in DEVICES]),
+             sorted({device[index] for device in DEVICES}))
+    for index, column in enumerate(["DEVICE_INFO_BRAND", "DEVICE_INFO_TYPE", "DEVICE_INFO_BROWSER"])
+}
+SALES_GROUPS = ["Restaur. dagkaart", "Restaur. a la carte", "Zorg", "Bedrijfscatering", "Recreatie", "Horeca overig"]
+SEGMENTS = ["restauratief", "zorg", "catering", "recreatie", "overig"]
+
+
+def category_names(n_categories, random_generator):
+    """
+    :return: n_categories ARTICLE_CATEGORIE values, formatted like the real ones, for example 1,071,331,581
+    """
+    codes = 10 ** 8 + random_generator.choice(19 * 10 ** 8, size=n_categories, replace=False)
+    return [f"{code:,}" for code in np.sort(codes)]
+
+
+def categorical(codes, categories):
+    """
+    :return: categorical column with a fixed list of categories, so every block of rows has the same dtype
+    """
+    return pd.Categorical.from_codes(codes, categories=categories)
+
+
+class SyntheticDataGenerator:
+    """
+    Generates events and purchases tables with the schema of processed_events.csv and
+    purchase_data_with_categories.csv, for performance tests of the processing scripts and the reward model when the
+    real client_data is not available.
+
+    The sizes of the clients are lognormal, so a few large clients have most of the events like in the real data.
+    Every session shows session_size propositions at PAGE_SECTION_POSITION 1 to session_size, the propositions are
+    drawn with a Zipf popularity and keep their PRICE and ARTICLE_CATEGORIE. Purchases are made of propositions the
+    client has seen a few days before, and of some popular propositions it has not seen. The weather columns are
+    looked up per USER_SALES_DISTRICT and DATE in a generated WeatherFeatureStore.
+
+    The clients are generated in blocks with their own random stream, so the tables only depend on the parameters
+    and the seed, and any number of rows can be written block by block without holding them in memory.
+    """
+
+    def __init__(self, n_events=100_000, events_per_client=200, client_size_sigma=1.5, n_propositions=5_000,
+                 popularity_exponent=1.1, n_categories=300, purchases_per_event=0.05, unseen_purchase_share=0.2,
+                 n_districts=20, start_date="2022-01-01", days=365, session_size=10, clients_per_block=1_000,
+                 seed=0):
+        """
+        :param n_events: the total number of event rows, from a thousand to hundreds of millions
+        :param events_per_client: the mean number of events per client, sets the number of clients
+        :param client_size_sigma: the sigma of the lognormal client sizes, higher is more skewed
+        :param n_propositions: the number of propositions in the catalogue
+        :param popularity_exponent: the exponent of the Zipf popularity of the propositions
+        :param n_categories: the number of ARTICLE_CATEGORIE values
+        :param purchases_per_event: the mean number of purchases per event of a client
+        :param unseen_purchase_share: the share of the purchases of propositions the client did not see
+        :param n_districts: the number of USER_SALES_DISTRICT values, every district has its own weather
+        :param start_date: the first DATE of the events
+        :param days: the number of days the events are spread over
+        :param session_size: the number of positions of a session
+        :param clients_per_block: the number of clients that are generated at once
+        :param seed: the seed of all random values
+        """
+        self.n_events = int(n_events)
+        self.purchases_per_event = purchases_per_event
+        self.unseen_purchase_share = unseen_purchase_share
+        self.start_day = np.datetime64(pd.Timestamp(start_date).date(), "D")
+        self.days = days
+        self.session_size = session_size
+        self.clients_per_block = clients_per_block
+        self.seed = seed
+
+        random_generator = np.random.default_rng([seed, 0])
+        n_clients = max(1, self.n_events // events_per_client)
+        # every client has at least one event, the others are divided with the lognormal weights
+        client_weights = random_generator.lognormal(0.0, client_size_sigma, size=n_clients)
+        self.client_sizes = 1 + random_generator.multinomial(self.n_events - n_clients,
+                                                             client_weights / client_weights.sum())
+        self.client_ids = np.arange(1, n_clients + 1, dtype=np.int32) * 7 + 10_000
+        self.client_event_offsets = np.concatenate(([0], np.cumsum(self.client_sizes)))
+        client_sessions = -(-self.client_sizes // session_size)
+        self.client_session_offsets = np.concatenate(([0], np.cumsum(client_sessions)))
+
+        self.districts = [DEFAULT_DISTRICT] + [f"District {index}" for index in range(1, n_districts)]
+        self.client_districts = random_generator.integers(0, n_districts, size=n_clients)
+        self.client_sales_groups = random_generator.integers(0, len(SALES_GROUPS), size=n_clients)
+        self.client_segments = random_generator.integers(0, len(SEGMENTS), size=n_clients)
+        self.client_devices = random_generator.integers(0, len(DEVICES), size=n_clients)
+        self.client_promotions_allowed = random_generator.random(n_clients) < 0.8
+
+        self.propositions = np.sort(100_000 + random_generator.choice(900_000, size=n_propositions,
+                                                                      replace=False)).astype(np.int32)
+        popularity = 1.0 / np.arange(1, n_propositions + 1) ** popularity_exponent
+        self.popularity_cdf = np.cumsum(random_generator.permutation(popularity))
+        self.popularity_cdf /= self.popularity_cdf[-1]
+        self.proposition_prices = np.round(random_generator.gamma(2.0, 12.0, size=n_propositions), 4)
+        self.categories = category_names(n_categories, random_generator)
+        self.proposition_categories = random_generator.integers(0, n_categories, size=n_propositions)
+
+        self.weather_store = self.generate_weather(random_generator)
+
+    @property
+    def n_clients(self):
+        return len(self.client_sizes)
+
+    @property
+    def n_blocks(self):
+        return -(-self.n_clients // self.clients_per_block)
+
+    def generate_weather(self, random_generator):
+        """
+        :return: WeatherFeatureStore with a seasonal temperature and random rain for every district and day, also
+        for the lead days after the last event
+        """
+        weather_store = WeatherFeatureStore()
+        dates = self.start_day + np.arange(self.days + weather_store.leads)
+        day_of_year = pd.DatetimeIndex(dates).dayofyear.to_numpy()
+        for district in self.districts:
+            temperature = 10 - 8 * np.cos(2 * np.pi * (day_of_year - 15) / 365) + random_generator.normal(
+                0, 3, size=len(dates))
+            rain = random_generator.random(len(dates)) < 0.45
+            weather_store.add_days(pd.DataFrame({
+                "date": dates,
+                "temperature": np.round(temperature, 1),
+                "precipcover": np.where(rain, np.round(random_generator.uniform(4, 60, size=len(dates)), 2), 0.0),
+                "precip": np.where(rain, np.round(random_generator.exponential(2.0, size=len(dates)), 3), 0.0),
+            }), district=district)
+        return weather_store
+
+    def popular_propositions(self, random_generator, size):
+        """
+        :return: the catalogue index of size propositions drawn with the Zipf popularity
+        """
+        return np.minimum(np.searchsorted(self.popularity_cdf, random_generator.random(size)),
+                          len(self.propositions) - 1)
+
+    def block(self, block_index):
+        """
+        generates the events and purchases of one block of clients
+        :param block_index: the number of the block, from 0 to n_blocks - 1
+        :return: tuple of the events and purchases tables of the clients of the block
+        """
+        random_generator = np.random.default_rng([self.seed, 1, block_index])
+        first_client = block_index * self.clients_per_block
+        clients = np.arange(first_client, min(first_client + self.clients_per_block, self.n_clients))
+        sizes = self.client_sizes[clients]
+
+        # the rows of the events, every client fills its sessions position by position
+        event_clients = np.repeat(clients, sizes)
+        row_in_client = np.arange(sizes.sum()) - np.repeat(self.client_event_offsets[clients]
+                                                           - self.client_event_offsets[first_client], sizes)
+        event_sessions = self.client_session_offsets[event_clients] + row_in_client // self.session_size
+        first_session = self.client_session_offsets[first_client]
+        n_sessions = self.client_session_offsets[clients[-1] + 1] - first_session
+        session_days = random_generator.integers(0, self.days, size=n_sessions)
+        session_sections = random_generator.integers(0, len(PAGE_SECTIONS), size=n_sessions)
+        session_of_event = event_sessions - first_session
+
+        event_propositions = self.popular_propositions(random_generator, len(event_clients))
+        event_days = session_days[session_of_event]
+        event_sections = session_sections[session_of_event]
+        promoted = (random_generator.random(len(event_clients)) < 0.1) & self.client_promotions_allowed[event_clients]
+        prices = self.proposition_prices[event_propositions]
+        devices = self.client_devices[event_clients]
+        events = pd.DataFrame({
+            "DATE": self.start_day + event_days,
+            "PRICE": prices.astype(np.float32),
+            "PROPOSITION": self.propositions[event_propositions],
+            "ARTICLE_CATEGORIE": categorical(self.proposition_categories[event_propositions], self.categories),
+            "PAGE_NAME": categorical(event_sections, PAGE_NAMES),
+            "PAGE_SECTION": categorical(event_sections, PAGE_SECTIONS),
+            "PAGE_SECTION_POSITION": (row_in_client % self.session_size + 1).astype(np.float32),
+            "PRODUCT_TYPE": categorical(promoted.astype(np.int8), PRODUCT_TYPES),
+            "PROMOTION_LABEL": categorical(np.where(promoted, 0, -1), ["Aanbieding"]),
+            "PROMOTION_PRICE": np.where(promoted, np.round(prices * 0.85, 4), np.nan).astype(np.float32),
+            "USER_CLIENT_NUMBER": self.client_ids[event_clients],
+            "USER_SESSION_ID": (event_sessions + 100_000).astype(np.int32),
+            **{column: categorical(device_codes[devices], device_categories)
+               for column, (device_codes, device_categories) in DEVICE_COLUMN_CODES.items()},
+            "USER_SALES_GROUP": categorical(self.client_sales_groups[event_clients], SALES_GROUPS),
+            "USER_SEGMENT": categorical(self.client_segments[event_clients], SEGMENTS),
+            "USER_SALES_DISTRICT": categorical(self.client_districts[event_clients], self.districts),
+            "USER_PROMOTIONS_ALLOWED": categorical(self.client_promotions_allowed[event_clients].astype(np.int8),
+                                                   ["N", "Y"]),
+        })
+        events = events.assign(**{column: values.astype(np.float32)
+                                  for column, values in self.weather_store.features(events).items()})
+
+        return events, self.block_purchases(random_generator, clients, event_propositions, event_days)
+
+    def block_purchases(self, random_generator, clients, event_propositions, event_days):
+        """
+        :return: the purchases of the clients of a block. Most purchases are of a proposition of an event of the
+        client, a few days after the event, the others are of popular propositions on a random day
+        """
+        sizes = self.client_sizes[clients]
+        purchase_counts = random_generator.poisson(self.purchases_per_event * sizes)
+        purchase_clients = np.repeat(clients, purchase_counts)
+        block_offsets = self.client_event_offsets[clients] - self.client_event_offsets[clients[0]]
+        seen_events = np.repeat(block_offsets, purchase_counts) + (
+                random_generator.random(len(purchase_clients)) * np.repeat(sizes, purchase_counts)).astype(np.int64)
+
+        unseen = random_generator.random(len(purchase_clients)) < self.unseen_purchase_share
+        purchase_propositions = np.where(unseen, self.popular_propositions(random_generator, len(purchase_clients)),
+                                         event_propositions[seen_events])
+        purchase_days = np.where(unseen, random_generator.integers(0, self.days, size=len(purchase_clients)),
+                                 event_days[seen_events] + random_generator.geometric(0.3, len(purchase_clients)) - 1)
+        quantities = random_generator.integers(1, 6, size=len(purchase_clients))
+        purchases = pd.DataFrame({
+            "USER_CLIENT_NUMBER": self.client_ids[purchase_clients],
+            "DATE": self.start_day + np.minimum(purchase_days, self.days - 1),
+            "PROPOSITION": self.propositions[purchase_propositions],
+            "AMOUNT": np.round(self.proposition_prices[purchase_propositions] * quantities, 2),
+            "ARTICLE_CATEGORIE": categorical(self.proposition_categories[purchase_propositions], self.categories),
+        })
+        # the purchases of a client are in date order, like the exports
+        order = np.lexsort((purchases["DATE"].to_numpy(), purchase_clients))
+        return purchases.take(order).reset_index(drop=True)
+
+    def blocks(self):
+        """
+        :return: iterator over the (events, purchases) of every block of clients
+        """
+        for block_index in range(self.n_blocks):
+            yield self.block(block_index)
+
+    def tables(self):
+        """
+        :return: tuple of the events and purchases tables of all clients, for the sizes that fit in memory
+        """
+        events_blocks, purchases_blocks = zip(*self.blocks())
+        return pd.concat(events_blocks, ignore_index=True), pd.concat(purchases_blocks, ignore_index=True)
+
+    def write(self, folder, storage="csv", events_file_name="processed_events", purchases_file_name="purchases"):
+        """
+        writes the events and purchases block by block, so the size of the tables is not limited by the memory. The
+        weather store is saved next to them as weather_features.npz
+        :param folder: the folder to write the tables to
+        :param storage: csv, written with the | separator of the processed files, or parquet with a row group per
+        block
+        :return: tuple of the paths of the events and purchases tables
+        """
+        os.makedirs(folder, exist_ok=True)
+        extension = get_table_storage(storage).extension
+        events_path = os.path.join(folder, events_file_name + extension)
+        purchases_path = os.path.join(folder, purchases_file_name + extension)
+        writers = [BlockTableWriter(events_path, storage), BlockTableWriter(purchases_path, storage)]
+        for block_index, tables in enumerate(self.blocks()):
+            for writer, table in zip(writers, tables):
+                writer.write(table)
+            if block_index % 100 == 0:
+                print(f"Written {block_index + 1}/{self.n_blocks} blocks of clients")
+        for writer in writers:
+            writer.close()
+        self.weather_store.save(os.path.join(folder, "weather_features.npz"))
+        return events_path, purchases_path
+
+
+class BlockTableWriter:
+    """
+    Appends the blocks of a generated table to one csv or parquet file
+    """
+
+    def __init__(self, path, storage="csv"):
+        self.path = path
+        self.storage = storage
+        self.parquet_writer = None
+        self.rows = 0
+        if storage == "parquet":
+            check_pyarrow_installed()
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def write(self, table):
+        if self.storage == "parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            arrow_table = pa.Table.from_pandas(table, preserve_index=False)
+            if self.parquet_writer is None:
+                self.parquet_writer = pq.ParquetWriter(self.path, arrow_table.schema)
+            self.parquet_writer.write_table(arrow_table)
+        else:
+            table.to_csv(self.path, sep="|", index=False, mode="a", header=self.rows == 0)
+        self.rows += len(table)
+
+    def close(self):
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+
+
+if __name__ == "__main__":
+    # writes a synthetic version of the processed events and purchases, see performance_benchmark.py
+    generator = SyntheticDataGenerator(n_events=1_000_000)
+    print(f"Generating {generator.n_events} events of {generator.n_clients} clients")
+    generator.write("synthetic_data")
@@ -0,0 +1,204 @@
+import numpy as np
+import pandas as pd
+
+from weather_features import weather_feature_columns
+
+# low cardinality text columns, stored as pandas categoricals: one small integer code per row instead of a python
+# string per row
+CATEGORICAL_COLUMNS = ["PAGE_NAME", "PAGE_SECTION", "PRODUCT_TYPE", "DEVICE_INFO_BRAND", "DEVICE_INFO_TYPE",
+                       "DEVICE_INFO_BROWSER", "PROMOTION_LABEL", "USER_SALES_GROUP", "USER_SEGMENT",
+                       "USER_SALES_DISTRICT", "USER_PROMOTIONS_ALLOWED", "EVENT", "ARTICLE_CATEGORIE"]
+
+# id columns, all ids fit in an int32
+INTEGER_COLUMNS = {
+    "USER_CLIENT_NUMBER": np.int32,
+    "USER_SESSION_ID": np.int32,
+    "PROPOSITION": np.int32,
+}
+# the count columns that the processing scripts add, for example purchases_7_day_after and
+# NUMBER_OF_TIMES_SEEN_30_days
+COUNT_COLUMN_PREFIXES = ("purchases_", "NUMBER_OF_TIMES_SEEN_")
+
+# prices, positions and the weather features are stored as float32 when that loses nothing: the tables are written
+# back to the client tree and processed_data, so a column is only downcast when every value is written the same from
+# a float32, see float32_is_lossless. AMOUNT and the total spend columns stay float64, they are summed over many
+# purchases
+FLOAT32_COLUMNS = ["PRICE", "PROMOTION_PRICE", "PAGE_SECTION_POSITION"] + weather_feature_columns(4)
+
+# DATE is parsed to datetime64, the timestamp columns to datetime64 with their time zone
+DATE_COLUMNS = ["DATE", "date"]
+TIMESTAMP_COLUMNS = ["TIMESTAMP_EVENT", "TIMESTAMP_PURCHASE"]
+DATETIME_COLUMNS = DATE_COLUMNS + TIMESTAMP_COLUMNS
+
+
+def column_kind(column):
+    """
+    :param column: the name of the column
+    :return: the kind of dtype of the column in the schema: category, integer, count, float32, date, timestamp, or
+    None for columns the schema does not change
+    """
+    if column in CATEGORICAL_COLUMNS:
+        return "category"
+    if column in INTEGER_COLUMNS:
+        return "integer"
+    if column.startswith(COUNT_COLUMN_PREFIXES):
+        return "count"
+    if column in FLOAT32_COLUMNS:
+        return "float32"
+    if column in DATE_COLUMNS:
+        return "date"
+    if column in TIMESTAMP_COLUMNS:
+        return "timestamp"
+    return None
+
+
+def read_dtypes():
+    """
+    :return: the dtypes that can already be given to pd.read_csv, so the text columns are never held as strings.
+    The other columns are converted after reading by apply_schema, because they may have missing values
+    """
+    return {column: "category" for column in CATEGORICAL_COLUMNS}
+
+
+def fits_in(values, dtype):
+    """
+    :return: True if all of the integer values fit in the integer dtype
+    """
+    if len(values) == 0:
+        return True
+    dtype_info = np.iinfo(dtype)
+    return dtype_info.min <= values.min() and values.max() <= dtype_info.max
+
+
+def float32_is_lossless(values):
+    """
+    float32 keeps about 7 significant digits. The prices and weather values of the data have fewer, so written from
+    a float32 (to_csv writes the shortest text that reads back as the same float32) they give the same text as the
+    original float64 values. Only the few distinct values are checked
+    :param values: numeric column
+    :return: True if every value reads back as the same float64 after it is written as a float32
+    """
+    unique_values = pd.unique(values.dropna().to_numpy(dtype=np.float64))
+    float32_text = unique_values.astype(np.float32).astype(str)
+    return bool(np.array_equal(float32_text.astype(np.float64), unique_values))
+
+
+def convert_column(values, kind):
+    """
+    converts one column to the dtype of the schema. Integer columns with missing values and values that do not fit
+    are left as they are
+    :param values: the column
+    :param kind: the kind of the column, see column_kind
+    :return: the converted column
+    """
+    if kind == "category":
+        return values if isinstance(values.dtype, pd.CategoricalDtype) else values.astype("category")
+    if kind in ("integer", "count"):
+        if not pd.api.types.is_integer_dtype(values.dtype):
+            if values.isna().any() or not pd.api.types.is_numeric_dtype(values.dtype):
+                return values
+            if not (values == values.round()).all():
+                return values
+        dtype = INTEGER_COLUMNS.get(values.name, np.int32)
+        return values.astype(dtype) if fits_in(values.to_numpy(), dtype) else values
+    if kind == "float32":
+        if values.dtype == np.float32 or not pd.api.types.is_numeric_dtype(values.dtype):
+            return values
+        # values with more digits than a float32 keeps stay float64, the tables are written back
+        return values.astype(np.float32) if float32_is_lossless(values) else values
+    if kind == "date":
+        if pd.api.types.is_datetime64_any_dtype(values.dtype):
+            return values
+        # the few distinct dates are parsed once and the rows get their date with a take
+        date_codes, unique_dates = pd.factorize(values, use_na_sentinel=False)
+        parsed_dates = pd.to_datetime(pd.Series(unique_dates)).to_numpy()
+        return pd.Series(parsed_dates.take(date_codes), index=values.index, name=values.name)
+    if kind == "timestamp":
+        if pd.api.types.is_datetime64_any_dtype(values.dtype):
+            return values
+        return pd.to_datetime(values, format="ISO8601")
+    return values
+
+
+def apply_schema(table, report=False, name="table"):
+    """
+    Converts the columns of an events, purchases or benchmark table to the dtypes of the schema. Columns that are
+    not in the schema are not changed
+    :param table: the table to convert, it is not changed itself
+    :param report: if True, the memory use before and after the conversion is printed
+    :param name: the name of the table in the report
+    :return: the converted table
+    """
+    memory_before = memory_usage(table) if report else 0
+    converted_columns = {}
+    for column in table.columns:
+        kind = column_kind(str(column))
+        if kind is not None:
+            converted = convert_column(table[column], kind)
+            if converted.dtype != table[column].dtype:
+                converted_columns[column] = converted
+    if converted_columns:
+        table = table.assign(**converted_columns)
+    if report:
+        print(memory_report(name, memory_before, memory_usage(table)))
+    return table
+
+
+def memory_usage(table):
+    """
+    :return: the memory use of the table in bytes, with the memory of the python strings
+    """
+    return int(table.memory_usage(deep=True).sum())
+
+
+def memory_report(name, memory_before, memory_after):
+    """
+    :param name: the name of the table
+    :param memory_before: the memory use in bytes before the conversion
+    :param memory_after: the memory use in bytes after the conversion
+    :return: line with the memory use before and after and the reduction
+    """
+    reduction = memory_before / memory_after if memory_after else float("inf")
+    return (f"Memory of {name}: {memory_before / 1024 ** 2:.1f} MB -> {memory_after / 1024 ** 2:.1f} MB "
+            f"({reduction:.1f}x smaller)")
+
+
+def dtype_report(table):
+    """
+    :param table: the table
+    :return: table with per column the dtype, the kind in the schema and the memory use in bytes
+    """
+    column_memory = table.memory_usage(deep=True, index=False)
+    return pd.DataFrame({
+        "dtype": table.dtypes.astype(str),
+        "schema_kind": [column_kind(str(column)) for column in table.columns],
+        "memory_bytes": column_memory,
+    }).sort_values("memory_bytes", ascending=False)
+
+
+def fill_missing(table, value=0):
+    """
+    fillna for tables with categorical columns, the value is added as a category first. The date and timestamp
+    columns are not filled, their missing values stay NaT like pd.to_datetime(errors="coerce") of the filled strings
+    :param table: the table
+    :param value: the value of the missing values
+    :return: the filled table
+    """
+    filled_columns = {}
+    for column in table.columns:
+        values = table[column]
+        if not values.hasnans or pd.api.types.is_datetime64_any_dtype(values.dtype):
+            continue
+        if isinstance(values.dtype, pd.CategoricalDtype) and value not in values.cat.categories:
+            values = values.cat.add_categories([value])
+        filled_columns[column] = values.fillna(value)
+    return table.assign(**filled_columns) if filled_columns else table
+
+
+if __name__ == "__main__":
+    # reports the memory use of the processed tables with and without the schema
+    from table_storage import CsvTableStorage
+
+    for table_path in ("processed_data/processed_events_final.csv", "processed_data/purchase_data_with_categories.csv"):
+        table = CsvTableStorage(sep="|", use_schema=False).read(table_path)
+        apply_schema(table, report=True, name=table_path)
@@ -0,0 +1,373 @@
+import os
+
+import pandas as pd
+
+from table_schema import DATETIME_COLUMNS, apply_schema, read_dtypes
+
+
+class CsvTableStorage:
+    """
+    Stores the tables as pipe delimited csv files, the format the client_data and processed_data folders have always
+    used. Column projection and filters are applied after reading, because a csv file can not skip rows.
+    The columns get the memory efficient dtypes of table_schema.py, the text columns are read as categoricals.
+    """
+    name = "csv"
+    extension = ".csv"
+
+    def __init__(self, sep="|", use_schema=True):
+        """
+        :param sep: the separator of the csv file
+        :param use_schema: if True, the columns get the dtypes of table_schema.py
+        """
+        self.sep = sep
+        self.use_schema = use_schema
+
+    def read_csv(self, path, columns=None, chunk_size=None):
+        """
+        :return: pd.read_csv of the file, with the categorical columns of the schema read as categoricals
+        """
+        return pd.read_csv(path, sep=self.sep, usecols=columns, chunksize=chunk_size,
+                           dtype=read_dtypes() if self.use_schema else None)
+
+    def read(self, path, columns=None, filters=None):
+        """
+        reads the table from the csv file
+        :param path: path of the csv file
+        :param columns: if given, only these columns are read
+        :param filters: list of (column, operator, value) tuples the rows have to match, see apply_filters
+        :return: the table
+        """
+        table = self.read_csv(path, columns=columns)
+        if self.use_schema:
+            table = apply_schema(table)
+        if filters:
+            table = apply_filters(table, filters)
+        return table
+
+    def write(self, table, path):
+        """
+        writes the table to the csv file
+        :param table: the table to write
+        :param path: path of the csv file
+        :return:
+        """
+        table.to_csv(path, sep=self.sep, index=False)
+
+    def read_chunks(self, path, chunk_size=100_000, columns=None):
+        """
+        reads the table from the csv file in chunks, so only one chunk is in memory at a time
+        :param path: path of the csv file
+        :param chunk_size: the maximum number of rows per chunk
+        :param columns: if given, only these columns are read
+        :return: iterator over the chunks of the table
+        """
+        with self.read_csv(path, columns=columns, chunk_size=chunk_size) as reader:
+            for chunk in reader:
+                yield apply_schema(chunk) if self.use_schema else chunk
+
+
+class ParquetTableStorage:
+    """
+    Stores the tables as parquet files. The dtypes of the columns are kept, only the requested columns are read and
+    the filters are pushed down to pyarrow, so row groups that can not match (for example on DATE or
+    USER_CLIENT_NUMBER) are skipped without reading them. Files that were written before the dtypes of
+    table_schema.py existed get them when they are read.
+    """
+    name = "parquet"
+    extension = ".parquet"
+
+    def __init__(self, row_group_size=None, use_schema=True):
+        """
+        :param row_group_size: the maximum number of rows per row group. Smaller row groups make the filters skip
+        more rows
+        :param use_schema: if True, the columns get the dtypes of table_schema.py
+        """
+        self.row_group_size = row_group_size
+        self.use_schema = use_schema
+        check_pyarrow_installed()
+
+    def read(self, path, columns=None, filters=None):
+        """
+        reads the table from the parquet file
+        :param path: path of the parquet file
+        :param columns: if given, only these columns are read
+        :param filters: list of (column, operator, value) tuples the rows have to match. They are pushed down to
+        pyarrow, for example [("USER_CLIENT_NUMBER", "==", 230), ("DATE", ">=", "2022-04-01")]. Dates can be given
+        as strings like for CsvTableStorage.read, see parquet_filters
+        :return: the table
+        """
+        if filters:
+            filters = parquet_filters(path, filters)
+        table = pd.read_parquet(path, engine="pyarrow", columns=columns, filters=filters or None)
+        return apply_schema(table) if self.use_schema else table
+
+    def write(self, table, path):
+        """
+        writes the table to the parquet file
+        :param table: the table to write
+        :param path: path of the parquet file
+        :return:
+        """
+        table.to_parquet(path, engine="pyarrow", index=False, row_group_size=self.row_group_size)
+
+    def read_chunks(self, path, chunk_size=100_000, columns=None):
+        """
+        reads the table from the parquet file in batches, so only one chunk is in memory at a time
+        :param path: path of the parquet file
+        :param chunk_size: the maximum number of rows per chunk
+        :param columns: if given, only these columns are read
+        :return: iterator over the chunks of the table
+        """
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=columns):
+            yield apply_schema(batch.to_pandas()) if self.use_schema else batch.to_pandas()
+
+
+# the column the client tables are partitioned on, its value is the name of the partition folder in the hive layout
+HIVE_PARTITION_COLUMN = "USER_CLIENT_NUMBER"
+
+TABLE_STORAGES = {
+    CsvTableStorage.name: CsvTableStorage,
+    ParquetTableStorage.name: ParquetTableStorage,
+}
+
+
+def check_pyarrow_installed():
+    """
+    The parquet storage needs pyarrow, which is not needed for the csv storage
+    """
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise ImportError("the parquet table storage needs pyarrow, install it with: pip install pyarrow")
+
+
+def get_table_storage(storage="csv"):
+    """
+    returns the table storage for the configured backend
+    :param storage: name of the backend (csv or parquet) or a table storage object
+    :return: table storage object
+    """
+    if not isinstance(storage, str):
+        return storage
+    if storage not in TABLE_STORAGES:
+        raise ValueError(f"Table storage {storage} not recognized, use one of {list(TABLE_STORAGES)}")
+    return TABLE_STORAGES[storage]()
+
+
+def get_table_storage_for_path(path):
+    """
+    returns the table storage that belongs to the extension of the file
+    :param path: path of the file, for example processed_data/processed_events.parquet
+    :return: table storage object
+    """
+    if path.endswith(ParquetTableStorage.extension):
+        return ParquetTableStorage()
+    return CsvTableStorage()
+
+
+def detect_csv_separator(path, separators=("|", ",", ";", "\t")):
+    """
+    detects the separator of a csv file from its header, the benchmark files for example use both | and ,
+    :param path: path of the csv file
+    :param separators: the separators to choose from
+    :return: the separator that splits the header in the most columns
+    """
+    with open(path, "r") as file:
+        header = file.readline()
+    return max(separators, key=header.count)
+
+
+def get_table_storage_for_file(path):
+    """
+    returns the table storage that can read the file, with the separator of the file for csv files
+    :param path: path of the file
+    :return: table storage object
+    """
+    if path.endswith(ParquetTableStorage.extension):
+        return ParquetTableStorage()
+    return CsvTableStorage(sep=detect_csv_separator(path))
+
+
+def client_table_layout(client_folder_path):
+    """
+    The client tables are stored in one of two layouts:
+    folder: client_data/<client id>/events.csv, a folder per client with its tables
+    hive: client_data/events/USER_CLIENT_NUMBER=<client id>/part-0.csv, a Hive-style partitioned dataset per table,
+    which pyarrow can also read as one dataset with partitioning="hive"
+    :param client_folder_path: the folder with the client tables
+    :return: hive if the folder has a partitioned events dataset, otherwise folder
+    """
+    if os.path.isdir(os.path.join(client_folder_path, "events")):
+        return "hive"
+    return "folder"
+
+
+def client_table_path(client_folder_path, client_id, table_name, extension=".csv", layout=None):
+    """
+    :param client_folder_path: the folder with the client tables
+    :param client_id: the id of the client
+    :param table_name: events or purchases
+    :param extension: the extension of the table storage
+    :param layout: folder or hive, by default the layout of the client folder, see client_table_layout
+    :return: the path of the table of the client
+    """
+    if layout is None:
+        layout = client_table_layout(client_folder_path)
+    if layout == "hive":
+        return os.path.join(client_folder_path, table_name, f"{HIVE_PARTITION_COLUMN}={client_id}",
+                            "part-0" + extension)
+    if layout == "folder":
+        return os.path.join(client_folder_path, str(client_id), table_name + extension)
+    raise ValueError(f"Client table layout {layout} not recognized, use folder or hive")
+
+
+def list_client_ids(client_folder_path, layout=None):
+    """
+    :param client_folder_path: the folder with the client tables
+    :param layout: folder or hive, by default the layout of the client folder
+    :return: list of the client ids in the client folder
+    """
+    if layout is None:
+        layout = client_table_layout(client_folder_path)
+    if layout == "hive":
+        partition_prefix = HIVE_PARTITION_COLUMN + "="
+        return [folder[len(partition_prefix):] for folder in os.listdir(os.path.join(client_folder_path, "events"))
+                if folder.startswith(partition_prefix)]
+    return [client_id for client_id in os.listdir(client_folder_path) if "." not in client_id]
+
+
+def partition_value(client_id):
+    """
+    :param client_id: the client id of a partition folder
+    :return: the value of the USER_CLIENT_NUMBER column, an int for the numeric client ids
+    """
+    client_id = str(client_id)
+    return int(client_id) if client_id.lstrip("-").isdigit() else client_id
+
+
+def parquet_filters(path, filters):
+    """
+    pyarrow can not compare the timestamp columns of a parquet file with strings, so the values of the filters on
+    the date and timestamp columns that the file stores as timestamps are converted to pd.Timestamp. Files that still
+    store the dates as text keep the filters as they are
+    :param path: path of the parquet file or dataset folder
+    :param filters: list of (column, operator, value) tuples
+    :return: the filters with the converted values
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    schema = ds.dataset(path, format="parquet").schema
+
+    def timestamp_value(value, time_zone):
+        timestamp = pd.Timestamp(value)
+        if time_zone is not None and timestamp.tzinfo is None:
+            timestamp = timestamp.tz_localize(time_zone)
+        return timestamp
+
+    converted_filters = []
+    for column, operator, value in filters:
+        if column in DATETIME_COLUMNS and column in schema.names and pa.types.is_timestamp(schema.field(column).type):
+            time_zone = schema.field(column).type.tz
+            if operator in ("in", "not in"):
+                value = [timestamp_value(single_value, time_zone) for single_value in value]
+            else:
+                value = timestamp_value(value, time_zone)
+        converted_filters.append((column, operator, value))
+    return converted_filters
+
+
+def apply_filters(table, filters):
+    """
+    Applies the filters to a table that is already in memory
+    :param table: the table to filter
+    :param filters: list of (column, operator, value) tuples. The operators are ==, !=, <, <=, >, >=, in and not in
+    :return: the rows of the table that match all of the filters
+    """
+    mask = pd.Series(True, index=table.index)
+    for column, operator, value in filters:
+        values = table[column]
+        if operator in ("==", "="):
+            mask &= values == value
+        elif operator == "!=":
+            mask &= values != value
+        elif operator == "<":
+            mask &= values < value
+        elif operator == "<=":
+            mask &= values <= value
+        elif operator == ">":
+            mask &= values > value
+        elif operator == ">=":
+            mask &= values >= value
+        elif operator == "in":
+            mask &= values.isin(value)
+        elif operator == "not in":
+            mask &= ~values.isin(value)
+        else:
+            raise ValueError(f"Filter operator {operator} not recognized")
+    return table[mask]
+
+
+def convert_csv_file_to_parquet(csv_path, parquet_path=None, sep="|", sort_by=None, row_group_size=None):
+    """
+    Converts one csv file to parquet
+    :param csv_path: path of the csv file
+    :param parquet_path: path of the parquet file, by default the csv path with the .parquet extension
+    :param sep: separator of the csv file
+    :param sort_by: optional columns to sort on before writing, for example ["USER_CLIENT_NUMBER", "DATE"]. Sorted
+    row groups let the filters on these columns skip most of the file
+    :param row_group_size: the maximum number of rows per row group
+    :return: path of the parquet file
+    """
+    if parquet_path is None:
+        parquet_path = os.path.splitext(csv_path)[0] + ParquetTableStorage.extension
+
+    table = CsvTableStorage(sep=sep).read(csv_path)
+    if "Unnamed: 0" in table.columns:
+        table = table.drop(columns=["Unnamed: 0"])
+    sort_by = [column for column in sort_by or [] if column in table.columns]
+    if sort_by:
+        table = table.sort_values(sort_by, kind="stable")
+
+    ParquetTableStorage(row_group_size=row_group_size).write(table, parquet_path)
+    return parquet_path
+
+
+def convert_csv_tree_to_parquet(client_folder_path="client_data", remove_csv=False):
+    """
+    One shot converter of the client folder tree. The events.csv and purchases.csv of every client are written as
+    events.parquet and purchases.parquet next to them
+    :param client_folder_path: the folder with a folder per client
+    :param remove_csv: if True, the csv files are removed after they are converted
+    :return: number of converted files
+    """
+    converted_files = 0
+    for index, client_id in enumerate(sorted(os.listdir(client_folder_path))):
+        client_folder = os.path.join(client_folder_path, client_id)
+        if not os.path.isdir(client_folder):
+            continue
+        if index % 1000 == 0:
+            print("Converting client: ", client_id)
+
+        for table_name in ("events", "purchases"):
+            csv_path = os.path.join(client_folder, table_name + CsvTableStorage.extension)
+            if not os.path.exists(csv_path):
+                continue
+            convert_csv_file_to_parquet(csv_path)
+            converted_files += 1
+            if remove_csv:
+                os.remove(csv_path)
+    return converted_files
+
+
+if __name__ == "__main__":
+    # converts the client folder tree and the processed data to parquet
+    convert_csv_tree_to_parquet("client_data")
+    for file_name in os.listdir("processed_data"):
+        if file_name.endswith(CsvTableStorage.extension):
+            print("Converting file: ", file_name)
+            convert_csv_file_to_parquet(os.path.join("processed_data", file_name),
+                                        sort_by=["USER_CLIENT_NUMBER", "DATE"],
+                                        row_group_size=1_000_000)
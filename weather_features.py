@@ -0,0 +1,240 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from sorted_window_index import SortedWindowIndex
+
+# the weather values per day and the name of their lead columns, in the column order of weather_data.ipynb
+WEATHER_VALUE_COLUMNS = ["temperature", "precipcover", "precip"]
+WEATHER_LEAD_COLUMN_NAMES = {
+    "temperature": "temperature_lead_{lead}",
+    "precipcover": "precipitation_coverage_lead_{lead}",
+    "precip": "precipitation_amount_lead_{lead}",
+}
+DEFAULT_DISTRICT = "default"
+
+
+def weather_feature_columns(leads=4):
+    """
+    :param leads: the number of days to look ahead
+    :return: the names of the weather feature columns, temperature, precipcover, precip and their lead columns
+    """
+    columns = list(WEATHER_VALUE_COLUMNS)
+    for lead in range(1, leads + 1):
+        columns += [WEATHER_LEAD_COLUMN_NAMES[column].format(lead=lead) for column in WEATHER_VALUE_COLUMNS]
+    return columns
+
+
+def select_transform_columns(weather_table):
+    """
+    Transforms the columns of the daily weather data (visualcrossing export) to the weather values, the temperature
+    is the feelslike temperature
+    :param weather_table: the weather data with a datetime, feelslike, precipcover and precip column
+    :return: table with a date, temperature, precipcover and precip column
+    """
+    if "date" in weather_table.columns and "temperature" in weather_table.columns:
+        return weather_table[["date"] + WEATHER_VALUE_COLUMNS]
+    new_table = weather_table.copy()
+    new_table["date"] = pd.to_datetime(new_table["datetime"])
+    new_table["temperature"] = new_table["feelslike"]
+    return new_table[["date"] + WEATHER_VALUE_COLUMNS]
+
+
+class WeatherFeatureStore:
+    """
+    Date indexed lookup array of the daily weather per district. The weather of district d on day t is stored at
+    values[d, t - first_day], so the weather and the lead features of a batch of events are found with integer date
+    offsets instead of a merge, and the lead features are never stored: lead k is the value at offset + k.
+
+    New weather days are written into the array with add_days, the events tables do not have to be rewritten. Events
+    of a district without its own weather station get the weather of the default district.
+    """
+
+    def __init__(self, leads=4, district_column="USER_SALES_DISTRICT"):
+        """
+        :param leads: the number of days to look ahead for the lead features
+        :param district_column: the column of the events with the district
+        """
+        self.leads = leads
+        self.district_column = district_column
+        self.districts = pd.Index([], dtype=object)
+        self.first_day = 0
+        self.values = np.full((0, 0, len(WEATHER_VALUE_COLUMNS)), np.nan, dtype=np.float64)
+        self._lead_values = None
+
+    @property
+    def days(self):
+        """
+        :return: the number of days from the first to the last day with weather
+        """
+        return self.values.shape[1]
+
+    def add_days(self, weather_table, district=DEFAULT_DISTRICT):
+        """
+        Writes the weather of new (or corrected) days into the lookup array. The array only grows when the days are
+        outside of the current date range
+        :param weather_table: the daily weather data, raw or transformed with select_transform_columns
+        :param district: the USER_SALES_DISTRICT of the weather station, districts are compared as strings. The default
+        district is used for all events of districts without their own station
+        :return: the number of days that were written
+        """
+        weather_table = select_transform_columns(weather_table)
+        days = SortedWindowIndex.dates_to_days(weather_table["date"])
+        valid_days = ~np.isnat(days)
+        days = days[valid_days].astype(np.int64)
+        if len(days) == 0:
+            return 0
+        weather_values = weather_table.loc[valid_days, WEATHER_VALUE_COLUMNS].to_numpy(dtype=np.float64)
+
+        district = str(district)
+        if district not in self.districts:
+            self.districts = self.districts.append(pd.Index([district], dtype=object))
+            self.values = np.concatenate((self.values, np.full((1,) + self.values.shape[1:], np.nan)), axis=0)
+
+        first_day = int(days.min()) if self.days == 0 else min(self.first_day, int(days.min()))
+        last_day = max(self.first_day + self.days - 1, int(days.max())) if self.days else int(days.max())
+        if first_day != self.first_day or last_day - first_day + 1 != self.days:
+            grown_values = np.full((len(self.districts), last_day - first_day + 1, len(WEATHER_VALUE_COLUMNS)),
+                                   np.nan, dtype=np.float64)
+            offset = self.first_day - first_day
+            grown_values[:, offset:offset + self.days] = self.values
+            self.values = grown_values
+            self.first_day = first_day
+
+        self.values[self.districts.get_loc(district), days - self.first_day] = weather_values
+        self._lead_values = None
+        return len(days)
+
+    def last_day(self):
+        """
+        :return: the last day with weather as datetime64[D], or None if the store is empty
+        """
+        if self.days == 0:
+            return None
+        return np.datetime64(self.first_day + self.days - 1, "D")
+
+    def district_codes(self, events):
+        """
+        :param events: the events with the district column
+        :return: the row in the lookup array of every event, the default district for unknown districts and -1 when
+        the store has no default district, those events get no weather
+        """
+        default_code = self.districts.get_indexer([DEFAULT_DISTRICT])[0]
+        if self.district_column not in events.columns:
+            return np.full(len(events), default_code, dtype=np.int64)
+        # only the few unique districts are looked up
+        event_codes, event_districts = pd.factorize(events[self.district_column], use_na_sentinel=False)
+        district_codes = self.districts.get_indexer(pd.Index(event_districts.astype(str), dtype=object))
+        district_codes[district_codes == -1] = default_code
+        return district_codes.take(event_codes)
+
+    def features(self, events, date_column="DATE"):
+        """
+        Looks up the weather features of a batch of events
+        :param events: the events with the date column and optionally the district column
+        :param date_column: the date column of the events
+        :return: dict with the weather feature column name as key and a numpy array with a value per event as value
+        """
+        # the events of a batch have few distinct dates, so only those are parsed
+        date_codes, event_dates = pd.factorize(events[date_column], use_na_sentinel=False)
+        event_days = SortedWindowIndex.dates_to_days(pd.Series(event_dates))
+        day_offsets = np.where(np.isnat(event_days), -1, event_days.astype(np.int64) - self.first_day).take(date_codes)
+        district_codes = self.district_codes(events)
+
+        found = (day_offsets >= 0) & (day_offsets < self.days) & (district_codes >= 0)
+        feature_values = np.full((len(events), len(WEATHER_VALUE_COLUMNS) * (self.leads + 1)), np.nan)
+        feature_values[found] = self.lead_values()[district_codes[found], day_offsets[found]]
+        return {name: feature_values[:, column_index]
+                for column_index, name in enumerate(weather_feature_columns(self.leads))}
+
+    def lead_values(self):
+        """
+        The weather and lead values of every district and day, built once from the lookup array and kept until new
+        days are added. Lead k of a day is the value of k days later, NaN after the last day with weather
+        :return: array with per district and day the values of the weather feature columns
+        """
+        if self._lead_values is None:
+            lead_values = np.full(self.values.shape[:2] + (len(WEATHER_VALUE_COLUMNS) * (self.leads + 1),), np.nan)
+            for lead in range(self.leads + 1):
+                lead_columns = slice(lead * len(WEATHER_VALUE_COLUMNS), (lead + 1) * len(WEATHER_VALUE_COLUMNS))
+                lead_values[:, :max(self.days - lead, 0), lead_columns] = self.values[:, lead:]
+            self._lead_values = lead_values
+        return self._lead_values
+
+    def attach(self, events, date_column="DATE"):
+        """
+        Adds the weather feature columns to a batch of events, the days without weather get NaN like the left merge
+        of weather_data.ipynb
+        :param events: the events with the date column and optionally the district column
+        :param date_column: the date column of the events
+        :return: the events with the weather feature columns
+        """
+        return events.assign(**self.features(events, date_column))
+
+    def save(self, path):
+        """
+        saves the lookup array as a npz file
+        :param path: path of the npz file
+        :return:
+        """
+        temporary_path = path + ".tmp.npz"
+        np.savez(temporary_path, values=self.values, first_day=self.first_day, leads=self.leads,
+                 districts=np.array(self.districts, dtype=str), district_column=self.district_column)
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        loads a store that was saved with save
+        :param path: path of the npz file
+        :return: WeatherFeatureStore
+        """
+        with np.load(path) as store_data:
+            store = cls(leads=int(store_data["leads"]), district_column=str(store_data["district_column"]))
+            store.values = store_data["values"]
+            store.first_day = int(store_data["first_day"])
+            store.districts = pd.Index(store_data["districts"].tolist(), dtype=object)
+        return store
+
+    def shared_arrays(self):
+        """
+        :return: dict with the lookup arrays of the store, to put in shared memory with shared_tables.SharedArrays.
+        The lead values are built here, so the workers do not each build their own
+        """
+        return {"values": self.values, "lead_values": self.lead_values(), "first_day": np.array(self.first_day),
+                "leads": np.array(self.leads), "districts": np.array(self.districts, dtype=str),
+                "district_column": np.array(self.district_column)}
+
+    @classmethod
+    def from_shared_arrays(cls, arrays):
+        """
+        builds a read-only store on arrays that were attached with shared_tables.attach_arrays, the lookup arrays are
+        used without a copy
+        :param arrays: dict returned by shared_arrays
+        :return: WeatherFeatureStore
+        """
+        store = cls(leads=int(arrays["leads"]), district_column=str(arrays["district_column"]))
+        store.values = arrays["values"]
+        store._lead_values = arrays["lead_values"]
+        store.first_day = int(arrays["first_day"])
+        store.districts = pd.Index(arrays["districts"].tolist(), dtype=object)
+        return store
+
+    @classmethod
+    def load_or_create(cls, path, leads=4, district_column="USER_SALES_DISTRICT"):
+        """
+        :return: the store that was saved at path, or an empty store if there is none yet
+        """
+        if os.path.exists(path):
+            return cls.load(path)
+        return cls(leads=leads, district_column=district_column)
+
+
+if __name__ == "__main__":
+    # adds the new days of the weather data to the cached store, the events get the features when they are used
+    weather_store = WeatherFeatureStore.load_or_create("processed_data/weather_features.npz")
+    weather_data = pd.read_csv("data/weather_utrecht_data_daily.csv", sep=",")
+    print("Weather days written: ", weather_store.add_days(weather_data))
+    print("Last day with weather: ", weather_store.last_day())
+    weather_store.save("processed_data/weather_features.npz")